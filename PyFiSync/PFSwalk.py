@@ -34,6 +34,7 @@ from functools import partial
 
 from . import utils
 from .dicttable import DictTable
+from .filerecord import FileRecord, json_default
 
 def fnmatch_mult(name,patterns):
     """
@@ -65,13 +66,20 @@ class file_list:
         self.empty = empty
         self.empties = set()
         
+        # Use memory-compact FileRecords rather than dicts
+        self.compact = getattr(config,'compact_file_records',False)
+        
         self._set_exclusions()
 
-    def files(self,parallel=False):
+    def files(self,parallel=False,sink=None):
         """
         Process the files. 
         if parallel is False or <= 1 will run hashes serially
         Otherwise specify True to use all cores or specify a number
+        
+        If sink is specified, each file is appended to it (e.g. a spool to
+        disk) and it is returned rather than a list. It must be iterable if
+        the hash_db is used.
         """
         
         # The hash_db is essentially the same as the filelist but it does
@@ -105,7 +113,12 @@ class file_list:
                 items = _map(partial(self.add_hash,hashname=attribute),zip(items,repeat(self.path)))
          
          # Run it!
-        result = list(items)
+        if sink is None:
+            result = list(items)
+        else:
+            result = sink
+            for item in items:
+                result.append(item)
      
         if pool is not None:
             pool.close()
@@ -252,7 +265,10 @@ class file_list:
         item,relpath = item_relpath
     
         stat_attributes = ['ino','size','mtime','birthtime']
-        file = {'path':relpath}
+        if self.compact:
+            file = FileRecord(path=relpath)
+        else:
+            file = {'path':relpath}
         
         
         follow_symlinks = not self.config.copy_symlinks_as_links
@@ -280,8 +296,13 @@ class file_list:
         """
         Use the exclusions to filter the old lists
         """
-        out_list = []
-        for ix,file in enumerate(old_list):
+        return list(self.filter_old(old_list))
+    
+    def filter_old(self,old_list):
+        """
+        Generate the files of old_list (any iterable) that are not excluded
+        """
+        for file in old_list:
             dirname,filename = os.path.split(file['path'])
 
             # file name only -- w/o glob
@@ -320,8 +341,7 @@ class file_list:
             if dflag:
                 continue
                 
-            out_list.append(file)
-        return out_list
+            yield file
     
 
     def add_hash(self,file_rootpath,hashname=None):
@@ -362,7 +382,16 @@ class file_list:
         except OSError:
             pass
         with open(hash_path,'wt',encoding='utf8') as F:
-            F.write(utils.to_unicode(json.dumps(files)))
+            if isinstance(files,list):
+                F.write(utils.to_unicode(json.dumps(files,default=json_default)))
+                return
+            # Do not build it all in memory
+            F.write('[')
+            for ii,file in enumerate(files):
+                if ii:
+                    F.write(', ')
+                F.write(utils.to_unicode(json.dumps(file,default=json_default)))
+            F.write(']')
                     
 def _relpath(*A,**K):
     """
@@ -3,5 +3,21 @@
 import sys
 sys.dont_write_bytecode = True
 
-from .main import __version__,__author__ 
-from .main import cli
+__version__ = '20211017.0'
+__author__ = 'Justin Winokur'
+__license__ = 'MIT'
+
+def cli(argv=None):
+    """
+    Command line entry. Remote `_api` calls go to the lean api module so they
+    do not import (and pay for) all of main
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['_api']:
+        from .api import cli as api_cli
+        api_cli(argv[1:])
+        sys.exit()
+    
+    from .main import cli as main_cli
+    return main_cli(argv)
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent remote agent.
+
+Rather than a new `ssh ... PyFiSync _api <mode>` for every remote call (each
+paying for the SSH setup, python startup, and imports), `_api serve` stays
+running for the whole sync and answers requests over stdin/stdout.
+
+Protocol:
+    The server first writes the MAGIC line. Anything before it (e.g. login
+    messages) is skipped. After that, every message in both directions is a
+    frame of
+
+        flags (1 byte) | length (4 bytes, big-endian) | payload
+
+    where the payload is UTF-8 JSON, zlib compressed if flags & FLAG_ZLIB.
+    Requests are {'cmd':<name>,...} and responses are {'ok':True,...} or
+    {'ok':False,'error':<message>}.
+
+    A response with 'stream' is followed by the data as it is made, in
+    frames with FLAG_DATA (raw bytes), and then an empty data frame. If it
+    fails partway, an error response is sent in place of the empty frame.
+
+    The first request must be 'hello' with the client's version. The server
+    replies with the version to use (the lower of the two) and the commands
+    it supports. If the client can't use that version it falls back to the
+    per-call mode, as it does for any command that is not supported.
+
+Commands (version 2. Version 1 sent the stream unframed):
+    hello        version                    --> version,commands
+    file_list    config (as _api file_list) --> files
+    file_list_stream config                 --> stream; then the files
+                                                follow. See stream_file_list
+    apply_queue  path,queue,backup,backup_method,force --> log (lines)
+    exit
+"""
+from __future__ import division, print_function, unicode_literals
+
+import sys
+import os
+import json
+import zlib
+import struct
+import subprocess
+import threading
+import itertools
+import datetime
+import random
+
+from . import utils
+from . import filerecord
+from . import listcodec
+
+VERSION = 2
+MIN_VERSION = 2
+MAGIC = b'PyFiSync-agent\n'
+
+KEEP_LISTINGS = 3 # Stored generations of the file list
+
+FLAG_ZLIB = 1
+FLAG_DATA = 2
+COMPRESS_ABOVE = 4096 # bytes
+COMPRESS_LEVEL = 6
+
+_HEADER = struct.Struct('>BI')
+
+class AgentError(Exception):
+    pass
+
+def write_frame(stream,obj,level=COMPRESS_LEVEL):
+    payload = json.dumps(obj,ensure_ascii=False,default=filerecord.json_default).encode('utf8')
+    flags = 0
+    if level and len(payload) > COMPRESS_ABOVE:
+        payload = zlib.compress(payload,level)
+        flags |= FLAG_ZLIB
+    stream.write(_HEADER.pack(flags,len(payload)) + payload)
+    stream.flush()
+
+def write_data(stream,data):
+    """ Write a data frame (see serve). Empty data ends the stream """
+    stream.write(_HEADER.pack(FLAG_DATA,len(data)) + data)
+    stream.flush()
+
+def read_frame(stream,object_hook=None):
+    """ Read a frame. Returns None at the end of the stream """
+    frame = _read_raw(stream)
+    if frame is None:
+        return None
+    flags,payload = frame
+    if flags & FLAG_DATA:
+        raise AgentError('Unexpected data frame')
+    return _decode_payload(flags,payload,object_hook)
+
+def _read_raw(stream):
+    """ Read a frame as (flags,payload) or None at the end of the stream """
+    header = stream.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise AgentError('Truncated frame header')
+    flags,length = _HEADER.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        raise AgentError('Truncated frame')
+    return flags,payload
+
+def _decode_payload(flags,payload,object_hook=None):
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    return json.loads(payload.decode('utf8'),object_hook=object_hook)
+
+class _DataStream(object):
+    """ 
+    File-like object of the data frames that follow a 'stream' response. An 
+    error response in place of the end raises AgentError
+    """
+    def __init__(self,stream):
+        self.stream = stream
+        self.buf = b''
+        self.done = False
+    
+    def _next(self):
+        frame = _read_raw(self.stream)
+        if frame is None:
+            self.done = True
+            raise AgentError('Agent exited during stream')
+        flags,payload = frame
+        if not flags & FLAG_DATA: # The error in place of the end
+            self.done = True
+            resp = _decode_payload(flags,payload)
+            raise AgentError(resp.get('error','unknown error'))
+        if not payload:
+            self.done = True
+        return payload
+    
+    def read(self,n):
+        while len(self.buf) < n and not self.done:
+            self.buf += self._next()
+        data,self.buf = self.buf[:n],self.buf[n:]
+        return data
+    
+    def drain(self):
+        """ Read (and drop) the rest of the stream """
+        self.buf = b''
+        while not self.done:
+            self._next()
+
+################################################################################
+## Server
+################################################################################
+
+def file_list(remote_config):
+    """ The (remote) file list for the remote_config of ssh_rsync.file_list """
+    from . import PFSwalk
+
+    path = remote_config['path']
+    config = utils.configparser()
+    config.pathA = path
+
+    config.copy_symlinks_as_links = remote_config['copy_symlinks_as_links']
+    config.excludes = list(set(remote_config['excludes'])) # do *not* use default excludes
+    config.use_hash_db = remote_config['use_hash_db']
+
+    log = utils.logger(silent=True,path=None)
+    _tmp = PFSwalk.file_list(path,config,log,
+                             attributes=remote_config['attributes'],
+                             empty=remote_config['empty'],
+                             use_hash_db=config.use_hash_db)
+    return _tmp.files()
+
+def _listing_key(remote_config):
+    """ The settings that change the list. A stored listing must match them """
+    return json.dumps([sorted(set(remote_config[k])) if k in ('excludes','attributes') 
+                       else remote_config[k] 
+                       for k in ('excludes','attributes','copy_symlinks_as_links','use_hash_db')])
+
+def _load_listing(listdir,generation,key):
+    """ Load the stored listing of that generation or None """
+    if not generation or os.sep in generation or generation.startswith('.'):
+        return None
+    info = {}
+    try:
+        with open(os.path.join(listdir,generation),'rb') as stream:
+            files = list(listcodec.decode(stream,info=info))
+    except (IOError,OSError,ValueError,zlib.error):
+        return None
+    if info.get('key') != key:
+        return None
+    return files
+
+def _save_listing(listdir,files,key):
+    """ Store the listing as a new generation (and prune old ones) """
+    try:
+        os.makedirs(listdir)
+    except OSError:
+        pass
+    generation = '{}_{:08x}'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'),
+                                    random.getrandbits(32))
+    path = os.path.join(listdir,generation)
+    with open(path + '.tmp','wb') as stream:
+        listcodec.dump(files,stream,level=1,info={'key':key})
+    os.rename(path + '.tmp',path)
+
+    stored = sorted(name for name in os.listdir(listdir) if not name.endswith('.tmp'))
+    for name in stored[:-KEEP_LISTINGS]:
+        try:
+            os.remove(os.path.join(listdir,name))
+        except OSError:
+            pass
+    return generation
+
+def stream_file_list(remote_config,files=None):
+    """
+    Return an iterator of the encoded (see listcodec) file list (which is
+    generated if files is not given).
+
+    If remote_config has 'since' (even if None), the list is stored as a new
+    generation. If the listing of generation 'since' is stored, only the
+    changed (or new) files are sent, followed by a second stream of the
+    removed paths. The header info says which:
+        {'generation':<new generation>,'base':<since or None if the full list>}
+    """
+    if files is None:
+        files = file_list(remote_config)
+    level = remote_config.get('compression',listcodec.DEFAULT_LEVEL)
+    if 'since' not in remote_config: # Older local version
+        return listcodec.encode(files,level=level)
+
+    listdir = os.path.join(remote_config['path'],'.PyFiSync','listings')
+    key = _listing_key(remote_config)
+    base = _load_listing(listdir,remote_config['since'],key)
+    info = {'generation':_save_listing(listdir,files,key),'base':None}
+    if base is None:
+        return listcodec.encode(files,level=level,info=info)
+
+    info['base'] = remote_config['since']
+    base = dict((file['path'],file) for file in base)
+    changed = []
+    for file in files:
+        if base.pop(file['path'],None) != file:
+            changed.append(file)
+    removed = [{'path':path} for path in base]
+    return itertools.chain(listcodec.encode(changed,level=level,info=info),
+                           listcodec.encode(removed,level=level))
+
+def apply_queue(path,queue,backup=True,backup_method=None,force=False,log=None):
+    """ Apply the queue on the (remote) path """
+    from . import main
+
+    config = utils.configparser()
+    config.pathA = path
+    config.backup = backup
+    config.force = force
+    if backup_method:
+        config.backup_method = backup_method
+    main.config = config # Place the config into PyFiSync
+
+    if log is None:
+        log = utils.logger(path=path,silent=False)
+    main.apply_action_queue(path,queue,log=log)
+
+class _CaptureLog(utils.logger):
+    """ Write the log file (as usual) but also keep the lines to return """
+    def __init__(self,path):
+        super(_CaptureLog,self).__init__(path=path,silent=True)
+        self.lines = []
+    def add(self,text,end='\n',return_out=False):
+        if text is None:
+            return
+        self.lines.extend(self.prepend + ' '*self.space + l for l in text.split('\n'))
+        return super(_CaptureLog,self).add(text,end=end,return_out=return_out)
+
+def _hello(req):
+    version = min(req.get('version',0),VERSION)
+    if version < MIN_VERSION:
+        raise AgentError('Unsupported protocol version {}'.format(req.get('version')))
+    return {'version':version,'commands':sorted(HANDLERS)}
+
+def _file_list(req):
+    return {'files':file_list(req['config'])}
+
+def _file_list_stream(req):
+    return {'stream':stream_file_list(req['config'])}
+
+def _apply_queue(req):
+    log = _CaptureLog(req['path'])
+    log.add('Successfully loading action queue of {:d} items'.format(len(req['queue'])))
+    apply_queue(req['path'],req['queue'],backup=req.get('backup',True),
+                backup_method=req.get('backup_method'),force=req.get('force',False),
+                log=log)
+    return {'log':log.lines}
+
+HANDLERS = {'hello':_hello,'file_list':_file_list,'file_list_stream':_file_list_stream,
+            'apply_queue':_apply_queue}
+
+def serve(stdin=None,stdout=None):
+    """ Answer requests until 'exit' or the end of stdin """
+    if stdin is None:
+        stdin = getattr(sys.stdin,'buffer',sys.stdin)
+    if stdout is None:
+        stdout = getattr(sys.stdout,'buffer',sys.stdout)
+
+    # Nothing else may write to stdout
+    sys.stdout = sys.stderr
+
+    stdout.write(MAGIC)
+    stdout.flush()
+    while True:
+        req = read_frame(stdin)
+        if req is None or req.get('cmd') == 'exit':
+            break
+        try:
+            resp = HANDLERS[req['cmd']](req)
+            resp['ok'] = True
+        except Exception as E:
+            resp = _error(E)
+        
+        stream = resp.pop('stream',None)
+        if stream is not None:
+            resp['stream'] = True
+        write_frame(stdout,resp)
+        if stream is not None:
+            try:
+                for data in stream:
+                    write_data(stdout,data)
+            except Exception as E:
+                write_frame(stdout,_error(E)) # In place of the end
+            else:
+                write_data(stdout,b'')
+
+def _error(E):
+    return {'ok':False,'error':'{}: {}'.format(type(E).__name__,E)}
+
+################################################################################
+## Client
+################################################################################
+
+class Client(object):
+    """
+    Start the agent with cmd (e.g. ssh ... PyFiSync _api serve) and say
+    hello. Raises AgentError if it can't be used
+    """
+    def __init__(self,cmd):
+        self.proc = subprocess.Popen(cmd,stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         shell=False)
+        # Collect stderr in a thread so it can't fill up and block
+        self._stderr = []
+        self._stderr_thread = threading.Thread(target=self._read_stderr)
+        self._stderr_thread.daemon = True
+        self._stderr_thread.start()
+
+        try:
+            for line in iter(self.proc.stdout.readline,b''):
+                if line == MAGIC:
+                    break
+            else:
+                raise AgentError('Agent did not start')
+
+            resp = self.request('hello',version=VERSION)
+            if resp['version'] < MIN_VERSION:
+                raise AgentError('Unsupported protocol version {}'.format(resp['version']))
+        except:
+            self.close(kill=True)
+            raise
+        self.version = resp['version']
+        self.commands = set(resp['commands'])
+
+    def _read_stderr(self):
+        for line in iter(self.proc.stderr.readline,b''):
+            self._stderr.append(utils.to_unicode(line))
+
+    def stderr(self):
+        """ Return (and clear) anything written to stderr so far """
+        err,self._stderr = ''.join(self._stderr),[]
+        return err
+
+    def request(self,cmd,object_hook=None,**kwargs):
+        kwargs['cmd'] = cmd
+        try:
+            write_frame(self.proc.stdin,kwargs)
+            resp = read_frame(self.proc.stdout,object_hook=object_hook)
+        except (IOError,OSError,ValueError) as E:
+            raise AgentError('Communication failed: {}'.format(E))
+        if resp is None:
+            raise AgentError('Agent exited')
+        if not resp.pop('ok',False):
+            raise AgentError(resp.get('error','unknown error'))
+        return resp
+
+    def read_stream(self,reader):
+        """ 
+        Return reader(stream) for the stream that follows a 'stream' response.
+        The rest of the stream is read even if reader fails so the agent can
+        still be used
+        """
+        stream = _DataStream(self.proc.stdout)
+        try:
+            try:
+                return reader(stream)
+            finally:
+                stream.drain()
+        except (IOError,OSError,ValueError,zlib.error) as E:
+            raise AgentError('Could not read stream: {}'.format(E))
+
+    def close(self,kill=False):
+        """ Stop the agent. kill if it may be in the middle of a response """
+        if kill and self.proc.poll() is None:
+            self.proc.kill()
+        if self.proc.poll() is None:
+            try:
+                write_frame(self.proc.stdin,{'cmd':'exit'})
+                self.proc.stdin.close()
+            except (IOError,OSError):
+                pass
+        self.proc.wait()
+        self.proc.stdout.close()
+        self._stderr_thread.join()
+        self.proc.stderr.close()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Lean entry point for the remote calls (`PyFiSync _api <mode> ...`).
+
+These are run on the remote for every sync (or every call in per-call mode)
+so they should start quickly. Only the standard library needed to dispatch is
+imported here. Each mode imports what it needs when it runs (e.g. file_list
+never imports main or the engines).
+
+Modes:
+    file_list <sentinel>: read the remote config from stdin (after the
+        sentinel) and write the sentinel and then the file list
+    apply_queue [--force] [--no-backup] [--backup-method M] <path> <sentinel>:
+        read the queue from stdin (after the sentinel) and apply it
+    serve: run the persistent agent. See agent.py
+"""
+from __future__ import division, print_function, unicode_literals
+
+import sys
+
+def _stdio():
+    """ Binary stdin and stdout (for python3) """
+    stdin,stdout = sys.stdin,sys.stdout
+    if hasattr(stdin,'buffer'):
+        stdin = stdin.buffer
+    if hasattr(stdout,'buffer'):
+        stdout = stdout.buffer
+    return stdin,stdout
+
+def _read_after(stream,sentinel):
+    data = stream.read()
+    return data[data.find(sentinel)+len(sentinel):].decode('utf8')
+
+def file_list(argv):
+    import json
+    from . import agent
+    
+    sentinel = argv[0].encode('ascii')
+    stdin,stdout = _stdio()
+    
+    remote_config = json.loads(_read_after(stdin,sentinel))
+    
+    # Generate the list. This may raise errors so do not start
+    # capture until later
+    flist = agent.file_list(remote_config)
+    
+    if remote_config.get('format') == 'stream':
+        stdout.write(sentinel)
+        for data in agent.stream_file_list(remote_config,files=flist):
+            stdout.write(data)
+    else:
+        import zlib
+        from . import filerecord
+        out = json.dumps(flist,ensure_ascii=False,default=filerecord.json_default)
+        out = zlib.compress(out.encode('utf8'),9) # Compress it
+        
+        stdout.write(sentinel + out) # write the bytes
+
+def apply_queue(argv):
+    import json
+    import getopt  # Even though it is "old school" use getopt here 
+                   # since it is easier and this interface is never 
+                   # exposed to the user
+    from . import agent
+    
+    stdin,_ = _stdio()
+    try:
+        opts, args = getopt.getopt(argv, "",['force','no-backup','backup-method='])
+    except getopt.GetoptError as err:
+        print(str(err)) #print error
+        sys.exit(2)
+    
+    path,sentinel = args
+    
+    backup,backup_method,force = True,None,False
+    for opt,val in opts:
+        if opt == '--force':
+            force = True
+        if opt == '--no-backup':
+            backup = False
+        if opt == '--backup-method':
+            backup_method = val
+    
+    sys.stdout.write('START>>>>>>>\n')
+    
+    # Get the queue from stdin
+    try:
+        queue = json.loads(_read_after(stdin,sentinel.encode('ascii')))
+    except Exception as E:
+        sys.stderr.write('could not parse input. Error: "{}"'.format(E))
+        sys.exit(2)
+    
+    print('Successfully loading action queue of {:d} items'.format(len(queue)))
+    
+    agent.apply_queue(path,queue,backup=backup,backup_method=backup_method,force=force)
+    
+    sys.stdout.write('\n<<<<<<<END')
+
+def serve(argv):
+    from . import agent
+    agent.serve()
+
+MODES = {'file_list':file_list,
+         'apply_queue':apply_queue,
+         'serve':serve}
+
+def cli(argv):
+    """
+    Run the mode. argv is everything after `_api`
+    """
+    mode = MODES.get(argv[0]) if argv else None
+    if mode is None:
+        sys.stderr.write('Unknown _api mode: {}\n'.format(' '.join(argv[:1])))
+        sys.exit(2)
+    mode(argv[1:])
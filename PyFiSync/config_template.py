@@ -26,10 +26,78 @@ ssh_port = 22
 # This works in practice but has not been as thouroughly tested.
 persistant = True
 
+# Keep the master SSH connection open for this many seconds after the run (with
+# ssh's ControlPersist) on a socket for the user@host:port so that the next
+# run reuses it rather than connecting again. A healthy existing master is
+# reused and a stale socket is removed. 0 closes it at the end of each run.
+# Requires persistant = True
+ssh_control_persist = 0
+
 # Specify the remote executable. If it is installed, it is just 'PyFiSync'. 
 # Otherwise it may be something like '/path/to/python /path/to/PyFiSync.py'.
 # Make sure the paths work via SSH. See the FAQs for details
 remote_exe = 'PyFiSync'
+
+# Start one long-running PyFiSync process on the remote (`_api serve`) and send
+# it all of the requests rather than a new SSH call for each. Falls back to
+# one call per request if the remote version does not support it
+remote_agent = True
+
+# zlib compression level (0-9) for the remote file list. It is sent in blocks
+# that are read as they arrive. Lower is faster but sends more data; 0 is off.
+remote_list_compression = 6
+
+# How to list the files on the remote:
+#   'python': With PyFiSync (`_api file_list`)
+#   'find':   With GNU find. Much faster on a slow remote. Python is still
+#             needed on the remote to apply moves and deletions. Cannot
+#             compute hashes so 'python' is used if any are set
+remote_lister = 'python'
+
+# Stream the queues and transfers: Apply moves, backups, and deletions and
+# start rsync on files as soon as they are decided rather than after all
+# decisions are made. A file is never transferred before a pending move,
+# backup, or deletion on its path. May help with a large number of changes.
+# (also used for local syncs)
+streaming_transfer = False
+
+# How to transfer files when B is a local path:
+#   'rsync':  With rsync (as for a remote)
+#   'python': Copy them directly (copy_file_range where possible) on
+#             `local_copy_threads` threads. Does not need rsync
+local_transfer = 'rsync'
+local_copy_threads = 8
+
+# rsync settings for the connection:
+#   'default': `-az` (compressed). Same as older versions
+#   'local':   No compression and whole files (no deltas) since the data does
+#              not cross a network
+#   'lan':     No compression and a fast SSH cipher (set on the persistant
+#              connection too)
+#   'wan':     Compression except for already-compressed types (jpg, zip,
+#              mp4, etc). Needs rsync 3 on both sides
+#   'auto':    'local' if B is a local path. Otherwise measures the round trip
+#              time and bandwidth (sending 2 MB) over an open ssh session and
+#              picks 'lan' or 'wan'
+# The profile and flags are written to the log
+rsync_profile = 'default'
+
+# How long (in seconds) to reuse the profile that 'auto' measured for a host
+# before measuring again. Stored in .PyFiSync/rsync_profiles. 0 measures on
+# every sync
+rsync_profile_ttl = 7*24*60*60
+
+# Number of rsync processes to run at once in each direction. The files are
+# split into groups with about the same total size and A >>> B and A <<< B run
+# at the same time. May help fill a fast or high-latency link. With a
+# persistant connection they all share it; note that sshd limits the sessions
+# per connection (MaxSessions, default 10). Set to 1 to run one rsync at a time
+transfer_processes = 1
+
+# Send new files (not on the other side) smaller than this many bytes as one
+# tar stream rather than with rsync which has a high per-file cost. Needs `tar`
+# on the remote. Falls back to rsync on failure. 0 to always use rsync
+tar_transfer_below = 0
 # </rsync>
 
 # <rclone>
@@ -175,6 +243,31 @@ copy_symlinks_as_links = True
 ## Other settings
 backup = True    # Backup before deletion or overwriting
 
+# How to back up a file before it is overwritten. (Deletions are always moved
+# into the backup). Options:
+#   'copy':     A full copy of the file
+#   'reflink':  A copy-on-write clone that does not copy any data. Needs a
+#               filesystem that supports it (e.g. btrfs, XFS) on Linux
+#   'hardlink': A hard link. Does not copy any data but is only safe because
+#               rsync replaces (rather than modifies) files when transferring
+#   'auto':     'reflink' if possible
+# All of them fall back to a copy if they are not possible (or if the remote
+# PyFiSync is too old to know this option)
+backup_method = 'auto'
+
+# When every file in a directory is moved to the same new directory, move the
+# directory with one rename rather than file-by-file. Similarly, when every file
+# in a directory is deleted, delete (or move to the backup) the directory at
+# once. A directory that (when applied) holds anything else, such as excluded
+# files, or that is a link is still done file-by-file
+collapse_directories = False
+
+# Number of moves, backups, and deletions to apply at once. Actions on the
+# same path (or a parent or child of it) are still applied in order and
+# directory moves and deletions are applied alone. Can help a lot on network
+# filesystems. 1 applies one at a time
+apply_threads = 1
+
 # If a file is deleted but a new one is in the same place, do not treat it as 
 # a delete. Useful when programs overwrite rather than update files. Final 
 # sync will look the same but this will optimize using rsync on that file
@@ -186,6 +279,35 @@ check_new_on_delete = True
 # case, though rare
 use_hash_db = True
 
+# Set the engine used to compare the file lists and determine moves, deletions,
+# and transfers. Options are 'python', 'numpy' (must be installed), or 'auto' to
+# use numpy if it is available. Results are identical but numpy is faster for
+# large numbers of files.
+#
+# For *very* large trees, 'external' will sort the file lists on disk (in 
+# .PyFiSync/) and only keep the changes in memory. It is slower but uses
+# far less memory. The local and old lists are written to disk as they are
+# read but a remote listing is first received in full. 'parallel' splits the work across multiple processes
+# (not available on Windows)
+reconcile_engine = 'auto'
+
+# Number of processes for the 'parallel' engine. 0 to use all CPUs
+reconcile_processes = 0
+
+# Approximate memory (in MB) for the sort buffers of the 'external' engine
+reconcile_memory_mb = 512
+
+# Store each file as a compact record (with shared directory names) rather
+# than a full dictionary. This can *greatly* reduce memory for very large 
+# numbers of files at the cost of being a bit slower
+compact_file_records = False
+
+# Keep a cache of up to this many file list query results so that identical
+# queries (e.g. the same path looked up repeatedly) are not recomputed. The
+# cache is invalidated whenever the list changes. Set to 0 to disable. The
+# hit/miss counts are written to the log to see if it helps
+query_cache_size = 0
+
 ## Exclusions.
 # * If an item ends in `/` it is a folder exclusion
 # * If an item starts with `/` it is a full path relative to the root
@@ -5,11 +5,16 @@ __version__ = "20200825"
 __author__ = "Justin Winokur"
 
 import copy
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import uuid
 import types
 import sys
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 if sys.version_info[0] > 2:
     unicode = str
 
@@ -42,6 +47,11 @@ class DictTable(object):
     exclude_attributes [ *empty* ] (list)
         Attributes that shouldn't ever be added even if attributes=None for 
         dynamic addition of attributes.
+    
+    cache_size [0] (int)
+        If > 0, keep up to this many results of keyword/dictionary queries in
+        a least-recently-used cache. The cache is tied to the modify counter 
+        so *any* change through the DB invalidates it. See cache_info()
         
     Multiple Values per attribute
     -----------------------------
@@ -64,12 +74,21 @@ class DictTable(object):
     * You can simply dump the DB with JSON using the DB.items()
       and then reload it with a new DB
     
+    * Or use DB.save(path) and DictTable.load(path) to save and reload it
+      *with* the indexes so nothing needs to be rebuilt
+    
+    * Only specify the attributes that are actually queried in 
+      fixed_attributes to save time and memory on large tables
+    
+    * DictTable.from_columns() can build a table from {attribute:[values]}
+    
     * There is also an attribute called `_index` which can be used to
       query by index.
 
     """
     def __init__(self, items=None, 
-                 fixed_attributes=None,exclude_attributes=None):
+                 fixed_attributes=None,exclude_attributes=None,
+                 cache_size=0):
         
         # These are used to make sure the DB.Query is (a) from this DB and (b)
         # the DB hasn't changed. This *should* always be the case
@@ -99,10 +118,93 @@ class DictTable(object):
 
         self._empty = _emptyList()
         self._ix = set()
+        
+        # Query result cache. Only valid for self._cache_c == self._c
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_c = self._c
+        self.cache_hits = 0
+        self.cache_misses = 0
 
         # Add the items
-        for item in items:
-            self.add(item)
+        self._bulk_add(items)
+    
+    @classmethod
+    def from_columns(cls,columns,**kwargs):
+        """
+        Create a DictTable from column arrays of the form
+        
+            {'attribute1':[val0,val1,...],'attribute2':[val0,val1,...]}
+        
+        where all columns are the same length. The indexes are built directly 
+        from the columns. Other keyword arguments are passed to DictTable
+        """
+        keys = list(columns.keys())
+        cols = [columns[key] for key in keys]
+        
+        if len(set(len(col) for col in cols)) > 1:
+            raise ValueError('All columns must be the same length')
+        
+        DB = cls(**kwargs)
+        DB._list = [dict(zip(keys,row)) for row in zip(*cols)]
+        DB.N = len(DB._list)
+        DB._ix = set(range(DB.N))
+        
+        for key,col in zip(keys,cols):
+            if DB.fixed_attributes and key not in DB.fixed_attributes:
+                continue
+            if key in DB.exclude_attributes:
+                continue
+            DB._index_column(key,enumerate(col))
+        
+        DB._c += 1
+        return DB
+    
+    def _bulk_add(self,items):
+        """
+        Add many items at once. The indexes are built column-wise (one 
+        attribute at a time) rather than item-by-item like add()
+        """
+        if not isinstance(items,list):
+            items = list(items)
+        if not items:
+            return
+        
+        ix0 = len(self._list)
+        
+        if self.fixed_attributes:
+            attribs = self.fixed_attributes
+        else:
+            attribs = set()
+            for item in items:
+                attribs.update(item)
+        
+        for attrib in attribs:
+            if attrib in self.exclude_attributes:
+                continue
+            self._index_column(attrib,
+                ((ix,item[attrib]) for ix,item in enumerate(items,ix0) if attrib in item))
+        
+        self._list.extend(items)
+        self.N += len(items)
+        self._ix.update(range(ix0,ix0 + len(items)))
+        self._c += 1
+        
+    def _index_column(self,attrib,ix_vals):
+        """
+        Add (ix,value) pairs to the attrib lookup. Does NOT update the modify
+        counter. Caller must!
+        """
+        lookup = self._lookup[attrib]
+        empty = self._empty
+        for ix,value in ix_vals:
+            if isinstance(value,list):
+                for val in value:
+                    lookup[val].append(ix)
+                if len(value) == 0:
+                    lookup[empty].append(ix)
+            else:
+                lookup[value].append(ix)
 
     def add(self,item):
         """
@@ -168,6 +270,20 @@ class DictTable(object):
         except StopIteration:
             return None
 
+    def query_first(self,*args,**kwargs):
+        """
+        Return the first item (in the order they were added) from a query. 
+        Unlike query_one, this does not depend on the order of the internal
+        sets so it is well defined when more than one item matches. See 
+        "query" for more details.
+        
+        Returns None if nothing matches
+        """
+        ixs = self._ixs(*args,**kwargs)
+        if not ixs:
+            return None
+        return self._list[min(ixs)]
+
     def count(self,*args,**kwargs):
         """
         Return the number of matched rows for a given query. See "query" for
@@ -204,14 +320,12 @@ class DictTable(object):
         if any(a in self.exclude_attributes for a in attributes):
             raise ValueError('Cannot reindex an excluded attribute')
 
-        for attribute in attributes:
-            self._lookup[attribute] = defaultdict(list) # Reset
-        
-        for ix,item in enumerate(self._list):
-            if item is None: continue
-            for attrib in attributes:
-                if attrib in item:
-                    self._append(attrib,item[attrib],ix)
+        for attrib in attributes:
+            self._lookup[attrib] = defaultdict(list) # Reset
+            self._index_column(attrib,
+                ((ix,item[attrib]) for ix,item in enumerate(self._list) 
+                                   if item is not None and attrib in item))
+        self._c += 1
     
     def update(self,*args,**queryKWs):
         """
@@ -286,20 +400,78 @@ class DictTable(object):
                 
             item.update(updated_dict) # Update the item
     
-    def add_fixed_attribute(self,attrib,force=False):
+    def update_many(self,updates):
+        """
+        Apply many updates in a single pass without needing to reindex.
+        
+        Usage:
+        ------
+        
+        >>> DB.update_many([(query1,updated_dict1),(query2,updated_dict2)])
+        
+        Inputs:
+        -------
+        
+        updates : iterable of (query,updated_dict) tuples where query is
+                  either a dictionary or a Query object and updated_dict is
+                  as in update(). 
+        
+        Notes:
+        ------
+            * Updates are applied *in order* so a later query will see the 
+              results of an earlier update (e.g. a->b followed by b->c).
+            * Dictionary queries are resolved directly against the lookup
+              rather than building Query objects and the modify counter is 
+              only incremented once. This is *much* faster than many calls to 
+              update() for large numbers of simple queries.
+            * Like update(), raises a ValueError if any query does not match.
+              Query objects are evaluated when they are built so they see the
+              table as it was *before* this call
+        """
+        attributes = set(self.attributes)
+        changed = False
+        for query,updated_dict in updates:
+            if not isinstance(updated_dict,dict):
+                raise ValueError('Must specify updated values as a dictionary')
+            
+            if isinstance(query,Query):
+                ixs = self._ixs(query)
+            elif isinstance(query,dict):
+                ixs = self._dict_ixs(query)
+            else:
+                raise ValueError('Unrecognized query {}. Must be a dict or Query'.format(type(query)))
+            
+            if len(ixs) == 0:
+                raise ValueError('Query did not match any results')
+            
+            update_attribs = attributes.intersection(updated_dict.keys())
+            for ix in ixs:
+                item = self._list[ix]
+                for attrib in update_attribs:
+                    self._remove(attrib,item[attrib],ix,_count=False)
+                    self._append(attrib,updated_dict[attrib],ix,_count=False)
+                item.update(updated_dict)
+            changed = True
+        
+        if changed:
+            self._c += 1
+    
+    def add_fixed_attribute(self,attrib,force=False,reindex=True):
         """
         Adds a fixed attribute. If there are NO fixed attributes (i.e. it is
         dynamic attributes), do *NOT* add them unless force.
         
-        Will reindex either way
+        Will reindex either way unless reindex=False. Use that to add many
+        and then call reindex(*attributes) once.
         """
         if attrib in self.exclude_attributes:
             raise ExcludedAttributeError("'{}' is excludes".format(attrib))
         
-        if self.fixed_attributes or force and attrib not in self.fixed_attributes: # Must already be filled or forced
+        if (self.fixed_attributes or force) and attrib not in self.fixed_attributes: # Must already be filled or forced
             self.fixed_attributes.append(attrib)
         
-        self.reindex(attrib)
+        if reindex:
+            self.reindex(attrib)
           
     def remove(self,*args,**kwargs):
         """
@@ -329,10 +501,108 @@ class DictTable(object):
             self._ix.difference_update([ix])
             self.N -= 1
     
+    def remove_many(self,queries):
+        """
+        Remove all items matching any of the queries in a single pass. Each
+        query is a dictionary or Query (see query()). 
+        
+        All queries are resolved *before* anything is removed. Raises a
+        ValueError if any query does not match any items (like remove())
+        """
+        ixs = set()
+        for query in queries:
+            if isinstance(query,Query):
+                qixs = self._ixs(query)
+            elif isinstance(query,dict):
+                qixs = self._dict_ixs(query)
+            else:
+                raise ValueError('unrecognized input of type {:s}'.format(str(type(query))))
+            if len(qixs) == 0:
+                raise ValueError('No matching items')
+            ixs.update(qixs)
+        
+        if not ixs:
+            return
+        
+        attributes = self.attributes
+        for ix in ixs:
+            item = self._list[ix]
+            for attrib in attributes:
+                if attrib in item:
+                    self._remove(attrib,item[attrib],ix,_count=False)
+            self._list[ix] = None
+        
+        self._ix.difference_update(ixs)
+        self.N -= len(ixs)
+        self._c += 1
+    
+    def save(self,path):
+        """
+        Save the DB *with* its indexes to path so that it can be reloaded 
+        with DictTable.load(path) without reindexing. 
+        
+        Uses pickle so only load trusted files!
+        """
+        state = {'version':_SAVE_VERSION,
+                 'list':self._list,
+                 'lookup':self._lookup,
+                 'ix':self._ix,
+                 'N':self.N,
+                 'fixed_attributes':self.fixed_attributes,
+                 'exclude_attributes':self.exclude_attributes}
+        with open(path,'wb') as F:
+            pickle.dump(state,F,protocol=pickle.HIGHEST_PROTOCOL)
+    
+    @classmethod
+    def load(cls,path,cache_size=0):
+        """
+        Load a DictTable saved with save(). Raises a ValueError if the file
+        was not saved with a compatible version
+        """
+        with open(path,'rb') as F:
+            state = pickle.load(F)
+        
+        if not isinstance(state,dict) or state.get('version') != _SAVE_VERSION:
+            raise ValueError('Not a (compatible) saved DictTable')
+        
+        DB = cls(fixed_attributes=state['fixed_attributes'],
+                 exclude_attributes=state['exclude_attributes'],
+                 cache_size=cache_size)
+        DB._list = state['list']
+        DB._lookup = state['lookup']
+        DB._ix = state['ix']
+        DB.N = state['N']
+        
+        # The empty-list placeholder is only matched by identity so replace the 
+        # unpickled one with this DB's
+        for lookup in DB._lookup.values():
+            for key in list(lookup.keys()):
+                if isinstance(key,_emptyList):
+                    lookup[DB._empty] = lookup.pop(key)
+        DB._c += 1
+        return DB
+    
+    def cache_info(self):
+        """
+        Return a dictionary of the query cache statistics
+        """
+        return {'hits':self.cache_hits,
+                'misses':self.cache_misses,
+                'size':len(self._cache),
+                'cache_size':self.cache_size}
+    
+    def cache_clear(self):
+        """
+        Clear the query cache and reset the statistics
+        """
+        self._cache.clear()
+        self.cache_hits = self.cache_misses = 0
+    
     def copy(self):
         return DictTable(self,
                          exclude_attributes=copy.copy(self.exclude_attributes),
-                         fixed_attributes=copy.copy(self.fixed_attributes))
+                         fixed_attributes=copy.copy(self.fixed_attributes),
+                         cache_size=self.cache_size)
     __copy__ = copy
             
     @property
@@ -360,12 +630,14 @@ class DictTable(object):
         kwargs = defaultdict(list,kwargs)
         
         Q = Query(self) # Empty object
+        cacheable = self.cache_size > 0
         for arg in args:
             if isinstance(arg,Query):
                 if arg._id != self._id:
                     raise ValueError("Cannot use another DictTable's Query object")
                 
                 Q = Q & arg # Will add these conditions. If Q is empty, will just be arg
+                cacheable = False # Already evaluated
                 continue
             if isinstance(arg,dict):
                 for key,val in arg.items(): # Add it rather than update in case it is already specified
@@ -373,6 +645,13 @@ class DictTable(object):
             else:
                 raise ValueError('unrecognized input of type {:s}'.format(str(type(arg))))
         
+        if cacheable:
+            cache_key = self._cache_key(kwargs)
+            if cache_key is not None:
+                ixs = self._cache_get(cache_key)
+                if ixs is not None:
+                    return list(ixs)
+        
         # Construct a query for kwargs
         for key,value in kwargs.items():
             if isinstance(value,list) and len(value) == 0:
@@ -383,8 +662,70 @@ class DictTable(object):
                 Q = Q & (Qtmp == val)
 
         ixs = Q._ixs
+        if cacheable and cache_key is not None:
+            self._cache_set(cache_key,ixs)
         return list(ixs)
+    
+    def _cache_key(self,kwargs):
+        """
+        Normalized (and hashable) key of the {attrib:[vals]} query or None if 
+        it cannot be cached
+        """
+        key = tuple((attrib,tuple(vals)) for attrib,vals in sorted(kwargs.items()))
+        try:
+            hash(key)
+        except TypeError: # Unhashable values (e.g. lists)
+            return None
+        return key
+    
+    def _cache_get(self,key):
+        if self._cache_c != self._c: # Changed since cached. Invalidate
+            self._cache.clear()
+            self._cache_c = self._c
+        try:
+            ixs = self._cache.pop(key)
+        except KeyError:
+            self.cache_misses += 1
+            return None
+        self._cache[key] = ixs # Move to the end (most recent)
+        self.cache_hits += 1
+        return ixs
+        
+    def _cache_set(self,key,ixs):
+        self._cache[key] = tuple(ixs)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False) # least recently used
         
+    def _dict_ixs(self,query):
+        """
+        Get the set of indices matching a simple {attrib:val} dictionary 
+        directly from the lookup. Equivalent to _ixs(query) but does not 
+        construct any Query objects
+        """
+        if self.N == 0:
+            return set()
+        
+        ixs = None
+        for attrib,value in query.items():
+            values = _makelist(value)
+            if len(values) == 0:
+                values = [self._empty]
+            for val in values:
+                if attrib == '_index':
+                    match = self._index(val)
+                else:
+                    match = self._lookup[attrib].get(val,())
+                if ixs is None:
+                    ixs = set(match)
+                else:
+                    ixs.intersection_update(match)
+                if not ixs:
+                    return set()
+        
+        if ixs is None: # Empty query matches everything
+            return set(self._ix)
+        return ixs
+    
     def _index(self,ix):
         """
         Return ix if it hasn't been deleted
@@ -398,9 +739,10 @@ class DictTable(object):
             return []
         return [ix]
     
-    def _append(self,attrib,value,ix):
+    def _append(self,attrib,value,ix,_count=True):
         """
-        Add to the lookup and update the modify time
+        Add to the lookup and update the modify time (unless _count=False 
+        in which case the caller must)
         """
         # Final check but we should be guarded from this
         if attrib in self.exclude_attributes:
@@ -413,11 +755,13 @@ class DictTable(object):
         if len(valueL) == 0:
             self._lookup[attrib][self._empty].append(ix) # empty list
         
-        self._c += 1
+        if _count:
+            self._c += 1
     
-    def _remove(self,attrib,value,ix):
+    def _remove(self,attrib,value,ix,_count=True):
         """
-        Remove from the lookup and update the modify time
+        Remove from the lookup and update the modify time (unless _count=False 
+        in which case the caller must)
         """
         valueL = _makelist(value)
         for val in valueL:
@@ -428,7 +772,8 @@ class DictTable(object):
         if len(valueL) == 0:
             self._lookup[attrib][self._empty].remove(ix) # empty list
     
-        self._c += 1
+        if _count:
+            self._c += 1
     
     def __contains__(self,check_diff):
         if not ( isinstance(check_diff,dict) or isinstance(check_diff,Query)):
@@ -476,6 +821,8 @@ class DictTable(object):
         attribs.sort()
         return attribs
     
+_SAVE_VERSION = 1
+
 def _makelist(input):
     if isinstance(input,list):
         return input
@@ -17,6 +17,10 @@ def apply_action_queue(queue,log,name,config):
         action,path = list(action_dict.items())[0]
         if action == 'move':
             log.add('(DRY-RUN) move: ' + utils.move_txt(path[0],path[1]))
+        elif action == 'movedir':
+            log.add('(DRY-RUN) move dir: ' + utils.move_txt(path[0],path[1]))
+        elif action == 'deletedir':
+            log.add('(DRY-RUN) delete dir (w/{} backup): {}'.format('' if config.backup else 'o',path[0]))
         elif action in ['backup','delete']:
             if action == 'backup' and config.backup:
                 log.add('(DRY-RUN) backup: ' + path)
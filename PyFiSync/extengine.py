@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bounded-memory (external merge) reconciliation engine.
+
+Rather than building four fully-indexed DictTables, the current and previous
+file lists are spooled to disk as soon as they are available and then sorted
+into on-disk runs (of at most the memory cap) that are merged with a k-way
+merge. The file_track classification is a sequence of merge joins:
+
+    1. untouched: join on prev_attributes + mtime
+    2. newmod:    join on prev_attributes (unmatched from 1)
+    3. moved:     join on move_attributes (unmatched from 2). The sorted
+                  move_attributes runs are the (spillable) secondary index
+    4. new:       everything left
+
+The matched old files are themselves sorted and merged against the old list
+to find the deletions. Finally, the classified current lists are merged by
+path and only the files that can play any part in the rest of the sync are
+kept:
+
+* Anything not untouched, the other side of it, and the paths they were
+  moved from
+* The paths of deleted files
+* Paths missing on one side or that do not agree on mod_attributes
+* Existing conflict-tag names (e.g. 'file.machineA.txt') of any of the above
+
+The rest (untouched on both sides and agreeing) would never be looked at by
+compare_queue_moves, apply_move_queues_theoretical, or
+determine_file_transfers so the existing in-memory code is run on just the
+reduced lists and the queues are the same as the in-memory engines (up to
+order). Memory is therefore the sort buffers plus the size of the change set.
+
+If an old file can't be uniquely determined (e.g. two old files with the
+same move_attributes), the first one in the old list is used as in every
+engine. The reduced lists are in their original order so later ties (e.g.
+two files moved from the same path) are also resolved the same.
+
+Values must be None, numbers, or strings (DictTable list matching is not
+supported). Otherwise, a ValueError is raised.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import heapq
+import shutil
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from . import utils
+
+NAME = 'external'
+
+if sys.version_info[0] > 2:
+    unicode = str
+    long = int
+
+class Spool(object):
+    """
+    Append-only, on-disk sequence of items. Pickled in chunks
+    """
+    def __init__(self,dirpath,chunk=1000,on_append=None):
+        fd,self.path = tempfile.mkstemp(dir=dirpath,suffix='.spool')
+        self._F = os.fdopen(fd,'wb')
+        self._buffer = []
+        self.chunk = chunk
+        self.on_append = on_append
+        self.N = 0
+
+    def append(self,item):
+        if self.on_append is not None:
+            self.on_append(item)
+        self._buffer.append(item)
+        self.N += 1
+        if len(self._buffer) >= self.chunk:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            pickle.dump(self._buffer,self._F,protocol=pickle.HIGHEST_PROTOCOL)
+            self._buffer = []
+
+    def close(self):
+        if self._F is not None:
+            self._flush()
+            self._F.close()
+            self._F = None
+        return self
+
+    def __iter__(self):
+        self.close()
+        with open(self.path,'rb') as F:
+            while True:
+                try:
+                    chunk = pickle.load(F)
+                except EOFError:
+                    return
+                for item in chunk:
+                    yield item
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def external_sort(items,key,run_size,dirpath):
+    """
+    Sort (seq,item) pairs by (key(item),seq) with at most run_size in memory
+    at once. Yields (key,seq,item). If key(item) is None, it is dropped.
+
+    The seq must be unique so that items themselves are never compared. It
+    also means ties are in order of seq.
+    """
+    runs = []
+    buf = []
+    for seq,item in items:
+        k = key(item)
+        if k is None:
+            continue
+        buf.append((k,seq,item))
+        if len(buf) >= run_size:
+            buf.sort()
+            run = Spool(dirpath)
+            for b in buf:
+                run.append(b)
+            runs.append(run.close())
+            buf = []
+    buf.sort()
+
+    try:
+        for item in heapq.merge(*([iter(run) for run in runs] + [iter(buf)])):
+            yield item
+    finally:
+        for run in runs:
+            run.remove()
+
+def _sortable(val):
+    """
+    Make values of different types sortable while keeping equality the same
+    as dictionary lookups (e.g. 1 == 1.0)
+    """
+    if val is None:
+        return (0,0)
+    if isinstance(val,(int,long,float)):
+        return (1,val)
+    if isinstance(val,(str,unicode)):
+        return (2,val)
+    raise ValueError('The external engine cannot compare {!r}'.format(val))
+
+def keyfunc(attributes,required=False):
+    """
+    Return a function of the sortable key for attributes. If an attribute
+    is missing, will return None (not included) unless required in which case
+    the KeyError is raised (as would happen in main.file_track)
+    """
+    attributes = list(attributes)
+    def key(item):
+        vals = []
+        for attrib in attributes:
+            try:
+                val = item[attrib]
+            except KeyError:
+                if required:
+                    raise
+                return None
+            vals.append(_sortable(val))
+        return tuple(vals)
+    return key
+
+def join(new_sorted,old_sorted):
+    """
+    Merge-join two sorted streams (from external_sort). Yields (seq,item,old)
+    for each new item where old is the (seq,item) of the *first* old with the
+    same key or None
+    """
+    old_sorted = iter(old_sorted)
+    cur = next(old_sorted,None)
+    for k,seq,item in new_sorted:
+        while cur is not None and cur[0] < k:
+            cur = next(old_sorted,None)
+        if cur is not None and cur[0] == k:
+            yield seq,item,(cur[1],cur[2])
+        else:
+            yield seq,item,None
+
+def tag_sources(path,names):
+    """
+    Return the set of paths that main.determine_file_transfers would tag as
+    `path` for any of names. e.g. 'dir/file.nameA.1.txt' --> 'dir/file.txt'
+    """
+    sources = set()
+    for name in names:
+        tag = '.' + name
+        start = path.find(tag)
+        while start >= 0:
+            root = path[:start]
+            rest = path[start+len(tag):]
+
+            exts = [rest] # '{root}.{name}{ext}'
+            num,dot,tail = rest[1:].partition('.')
+            if rest.startswith('.') and num.isdigit(): # '{root}.{name}.{ii}{ext}'
+                exts.append(dot + tail)
+
+            for ext in exts:
+                source = root + ext
+                if os.path.splitext(source) == (root,ext):
+                    sources.add(source)
+            start = path.find(tag,start + 1)
+    return sources
+
+class Reconciler(object):
+    """
+    Collects the file lists and reduces them to what the sync needs.
+
+    Usage:
+        recon = Reconciler(config,tmpdir)
+        recon.add_files('A',filesA)  # Spooled to disk. The list can be freed
+        walker.files(sink=recon.sink('B')) # or as they are listed
+        ...
+        filesA,filesB,filesA_old,filesB_old = recon.reduce()
+        recon.close()
+    """
+    def __init__(self,config,tmpdir=None,memory_mb=None,exclude_if_present=None):
+        self.config = config
+        if memory_mb is None:
+            memory_mb = getattr(config,'reconcile_memory_mb',512)
+        self.memory_bytes = memory_mb * 2**20
+        self.exclude_if_present = exclude_if_present
+        self.exclude_dirs = set()
+
+        self.tmpdir = tempfile.mkdtemp(prefix='PyFiSync_reconcile_',dir=tmpdir)
+        self.spools = {}
+        self.item_bytes = 0
+        self.stats = {}
+
+    def add_files(self,AB,files,old=False):
+        """
+        Spool files for side AB ('A' or 'B'). Set old=True for the previous
+        list
+        """
+        spool = self.sink(AB,old=old)
+        for item in files:
+            spool.append(item)
+        spool.close()
+
+    def sink(self,AB,old=False):
+        """
+        Return a Spool to append the files of side AB to as they are produced
+        (e.g. with PFSwalk.files(sink=...)) so the full list is never in 
+        memory. Same as add_files otherwise
+        """
+        spool = Spool(self.tmpdir,on_append=lambda item:self._added(item,old))
+        self.spools[(AB,old)] = spool
+        return spool
+
+    def _added(self,item,old):
+        if not self.item_bytes:
+            self.item_bytes = _estimate_size(item)
+        if not old and self.exclude_if_present:
+            dirname,filename = os.path.split(item['path'])
+            if filename == self.exclude_if_present:
+                self.exclude_dirs.add(dirname)
+
+    @property
+    def run_size(self):
+        # The buffer holds the items and their keys
+        return max(100,int(self.memory_bytes // (2*max(self.item_bytes,1))))
+
+    def _sort(self,items,key):
+        return external_sort(items,key,self.run_size,self.tmpdir)
+
+    def _current(self,AB):
+        """ Yield (seq,item) of the current list w/ exclusions and defaults"""
+        exclude_dirs = tuple(self.exclude_dirs)
+        N = size = 0
+        for seq,item in enumerate(self.spools[(AB,False)]):
+            if exclude_dirs and item['path'].startswith(exclude_dirs):
+                continue
+            item['newmod'] = False
+            item['new'] = False
+            item['untouched'] = False
+            item['moved'] = False
+            item['prev_path'] = None
+            N += 1
+            size += item.get('size',0)
+            yield seq,item
+        self.stats[AB] = (N,size)
+
+    def summary(self,AB):
+        N,size = self.stats[AB]
+        size = utils.bytes2human(size)
+        return "{:d} files, {:0.2f} {:s}".format(N,size[0],size[1])
+
+    def track(self,AB,prev_attributes,move_attributes):
+        """
+        Classify the files (as main.file_track). Returns a Spool of (seq,item)
+        for the current files, the list of deleted old files, and the set
+        of paths involved in any change
+        """
+        old = self.spools[(AB,True)]
+        classified = Spool(self.tmpdir)
+        matched = Spool(self.tmpdir)
+        changed = set()
+
+        stages = [('untouched',list(prev_attributes) + ['mtime']),
+                  ('newmod',list(prev_attributes)),
+                  ('moved',list(move_attributes))]
+
+        items = self._current(AB)
+        unmatched = None
+        for stage,attributes in stages:
+            new_sorted = self._sort(items,keyfunc(attributes,required=True))
+            old_sorted = self._sort(enumerate(old),keyfunc(attributes))
+
+            unmatched = Spool(self.tmpdir)
+            for seq,item,old_item in join(new_sorted,old_sorted):
+                if old_item is None:
+                    unmatched.append((seq,item))
+                    continue
+                old_seq,old_item = old_item
+                matched.append(old_seq)
+
+                if stage == 'untouched':
+                    item['prev_path'] = item['path']
+                    item['untouched'] = True
+                elif stage == 'newmod':
+                    item['prev_path'] = item['path']
+                    item['newmod'] = True
+                else:
+                    item['prev_path'] = old_item['path']
+                    item['moved'] = True
+                    if not old_item['mtime'] == item['mtime']:
+                        item['newmod'] = True
+
+                if stage != 'untouched':
+                    changed.add(item['path'])
+                    changed.add(item['prev_path'])
+                classified.append((seq,item))
+
+            if isinstance(items,Spool):
+                items.remove()
+            items = unmatched.close()
+
+        # It must be new
+        for seq,item in unmatched:
+            item['newmod'] = True
+            item['new'] = True
+            changed.add(item['path'])
+            classified.append((seq,item))
+        unmatched.remove()
+
+        # Deleted. Merge the sorted matched with the old (in order)
+        matched_sorted = self._sort(((s,None) for s in matched.close()),lambda _:())
+        matched_seqs = (seq for _,seq,_ in matched_sorted)
+
+        deleted = []
+        cur = next(matched_seqs,None)
+        for seq,item in enumerate(old):
+            while cur is not None and cur < seq:
+                cur = next(matched_seqs,None)
+            if cur == seq:
+                continue
+            item['deleted'] = True
+            deleted.append(item)
+            changed.add(item['path'])
+        matched.remove()
+
+        return classified.close(),deleted,changed
+
+    def reduce(self):
+        """
+        Returns filesA,filesB,filesA_old,filesB_old lists with the tracking
+        attributes set where filesX_old is *only* the deleted files.
+        """
+        config = self.config
+        classifiedA,deletedA,changed = self.track('A',config.prev_attributesA,config.move_attributesA)
+        classifiedB,deletedB,changedB = self.track('B',config.prev_attributesB,config.move_attributesB)
+        changed.update(changedB)
+
+        keyer = keyfunc(['path'])
+        sortedA = ((k[0][1],(seq,item)) for k,seq,item in self._sort(classifiedA,keyer))
+        sortedB = ((k[0][1],(seq,item)) for k,seq,item in self._sort(classifiedB,keyer))
+
+        mod_attributes = [tuple(m) for m in config.mod_attributes]
+        names = [config.nameA,config.nameB]
+
+        filesA,filesB,tagged = [],[],[] # (seq,item)
+        for path,seqitemA,seqitemB in _merge_paths(sortedA,sortedB):
+            itemA = seqitemA[1] if seqitemA is not None else None
+            itemB = seqitemB[1] if seqitemB is not None else None
+            keep = (path in changed
+                    or itemA is None or itemB is None
+                    or not _agree(itemA,itemB,mod_attributes,config.mod_resolution))
+            if keep:
+                changed.add(path) # for the tag check
+            else:
+                sources = tag_sources(path,names)
+                if sources:
+                    tagged.append((sources,seqitemA,seqitemB))
+                continue
+
+            if seqitemA is not None:
+                filesA.append(seqitemA)
+            if seqitemB is not None:
+                filesB.append(seqitemB)
+
+        # Keep conflict tag names if they may be needed to pick a new name
+        for sources,seqitemA,seqitemB in tagged:
+            if sources.intersection(changed):
+                filesA.append(seqitemA) # Both exist or it would have been kept
+                filesB.append(seqitemB)
+
+        classifiedA.remove()
+        classifiedB.remove()
+        
+        # Back in the original order so that ties (see query_first) are 
+        # resolved as with the full lists
+        filesA = [item for _,item in sorted(filesA,key=lambda seqitem:seqitem[0])]
+        filesB = [item for _,item in sorted(filesB,key=lambda seqitem:seqitem[0])]
+        return filesA,filesB,deletedA,deletedB
+
+    def close(self):
+        for spool in self.spools.values():
+            spool.remove()
+        shutil.rmtree(self.tmpdir,ignore_errors=True)
+
+def _merge_paths(sortedA,sortedB):
+    """
+    Merge two (path,item) sorted streams yielding (path,itemA,itemB) where
+    either may be None
+    """
+    sortedA,sortedB = iter(sortedA),iter(sortedB)
+    curA = next(sortedA,None)
+    curB = next(sortedB,None)
+    while curA is not None or curB is not None:
+        if curB is None or (curA is not None and curA[0] < curB[0]):
+            yield curA[0],curA[1],None
+            curA = next(sortedA,None)
+        elif curA is None or curB[0] < curA[0]:
+            yield curB[0],None,curB[1]
+            curB = next(sortedB,None)
+        else:
+            yield curA[0],curA[1],curB[1]
+            curA = next(sortedA,None)
+            curB = next(sortedB,None)
+
+def _agree(itemA,itemB,mod_attributes,mod_resolution):
+    """
+    Whether untouched items agree on the mod_attributes. Anything that
+    can't be compared does not
+    """
+    if not (itemA['untouched'] and itemB['untouched']):
+        return False
+    try:
+        itemA['mtime'],itemB['mtime']
+        for attribA,attribB in mod_attributes:
+            if (attribA,attribB) == ('mtime','mtime'):
+                if abs(itemA['mtime'] - itemB['mtime']) <= mod_resolution:
+                    return True
+            elif itemA[attribA] == itemB[attribB]:
+                return True
+    except KeyError:
+        pass
+    return False
+
+def _estimate_size(item):
+    """ Rough in-memory size of an item (plus its sort key) in bytes """
+    return 3*len(pickle.dumps(dict(item),protocol=pickle.HIGHEST_PROTOCOL)) + 200
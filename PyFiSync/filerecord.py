@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact, dict-compatible file records.
+
+Every file is normally a python dict which is *very* memory hungry for
+millions of files. A FileRecord stores the common attributes in __slots__ and
+the path as (directory,name) where the directory strings are interned so all
+files in a directory share the same string. Anything else (e.g. hashes) goes
+into a small dict that is only created if needed.
+
+They behave like (mutable) dictionaries so they can be used anywhere a file
+dict is (PFSwalk, DictTable, the main reconciliation, etc). Use
+`json_default` and `object_hook` to (de)serialize them with json.
+
+Note that the full path string is built every time 'path' is accessed.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import sys
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError: # python2
+    from collections import Mapping, MutableMapping
+
+if sys.version_info[0] > 2:
+    unicode = str
+
+# Attributes stored directly in slots. Order is the key order
+_FIELDS = ('ino','size','mtime','birthtime',
+           'newmod','new','untouched','moved','deleted')
+_FIELDS_SET = frozenset(_FIELDS)
+
+try:
+    _intern = sys.intern
+except AttributeError: # python2's intern() only takes bytes
+    _intern = None
+
+def _intern_dir(dirname):
+    """
+    Return the shared copy of dirname. This is used instead of an integer
+    ID so that records can be pickled to other processes (e.g. hashing).
+    
+    sys.intern does not keep the string alive so nothing accumulates in a
+    long-lived process (e.g. the agent) across listings. On python2 the
+    directories are not shared.
+    """
+    if _intern is None:
+        return dirname
+    return _intern(dirname)
+
+class _Same(object):
+    """Sentinel for prev_path being the same as path"""
+    __slots__ = ()
+_SAME = _Same()
+
+class FileRecord(MutableMapping):
+    __slots__ = ('_dir','_name','_prev_path','_extra') + _FIELDS
+
+    def __init__(self,*args,**kwargs):
+        self._extra = None
+        if args or kwargs:
+            self.update(*args,**kwargs)
+
+    def _path(self):
+        try:
+            dirname = self._dir
+        except AttributeError:
+            raise KeyError('path')
+        if dirname:
+            return dirname + '/' + self._name
+        return self._name
+
+    def __getitem__(self,key):
+        if key == 'path':
+            return self._path()
+        if key in _FIELDS_SET:
+            try:
+                return getattr(self,key)
+            except AttributeError:
+                raise KeyError(key)
+        if key == 'prev_path':
+            try:
+                prev_path = self._prev_path
+            except AttributeError:
+                raise KeyError(key)
+            if prev_path is _SAME:
+                return self._path()
+            return prev_path
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self,key,value):
+        if key == 'path':
+            # Make sure prev_path keeps the *old* path
+            if getattr(self,'_prev_path',None) is _SAME:
+                self._prev_path = self._path()
+            dirname,_,name = value.rpartition('/')
+            self._dir = _intern_dir(dirname)
+            self._name = name
+        elif key in _FIELDS_SET:
+            setattr(self,key,value)
+        elif key == 'prev_path':
+            if value is not None and hasattr(self,'_dir') and value == self._path():
+                value = _SAME # Do not store another copy
+            self._prev_path = value
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self,key):
+        try:
+            if key == 'path':
+                if getattr(self,'_prev_path',None) is _SAME:
+                    self._prev_path = self._path()
+                del self._dir
+                del self._name
+            elif key in _FIELDS_SET:
+                delattr(self,key)
+            elif key == 'prev_path':
+                del self._prev_path
+            elif self._extra is not None:
+                del self._extra[key]
+            else:
+                raise KeyError(key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self,key):
+        if key == 'path':
+            return hasattr(self,'_dir')
+        if key in _FIELDS_SET:
+            return hasattr(self,key)
+        if key == 'prev_path':
+            return hasattr(self,'_prev_path')
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        if hasattr(self,'_dir'):
+            yield 'path'
+        for key in _FIELDS:
+            if hasattr(self,key):
+                yield key
+        if hasattr(self,'_prev_path'):
+            yield 'prev_path'
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self,other):
+        if not isinstance(other,Mapping):
+            return NotImplemented
+        return dict(self) == dict(other)
+
+    def __ne__(self,other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = None # Mutable
+
+    def __reduce__(self):
+        return (FileRecord,(dict(self),))
+
+    def copy(self):
+        return FileRecord(self)
+
+    def __repr__(self):
+        return 'FileRecord({!r})'.format(dict(self))
+
+def json_default(obj):
+    """
+    Use as json.dumps(...,default=json_default) to serialize FileRecords
+    """
+    if isinstance(obj,FileRecord):
+        return dict(obj)
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+def object_hook(obj):
+    """
+    Use as json.loads(...,object_hook=object_hook) to load file dicts as
+    FileRecords
+    """
+    return FileRecord(obj)
+
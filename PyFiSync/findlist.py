@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+List files with GNU `find -printf` rather than PyFiSync on the remote. This
+is much faster on a weak remote and doesn't need python there (but it can't
+compute hashes).
+
+The exclusions are turned into find predicates (pruning excluded directories)
+when they mean the same thing to find. Anything else is filtered afterwards
+with PFSwalk's filter_old_list.
+
+Symlinks are handled as PFSwalk does:
+    * copy_symlinks_as_links=False: `find -L` follows everything and reports
+      the referent
+    * copy_symlinks_as_links=True: `find -H` reports the link itself for
+      symlinked files. Symlinked directories are not followed by find so they
+      are returned (see parse) and must be listed again as starting points.
+
+Every item is printed as three NUL-terminated fields:
+
+    <type><type followed> <ino> <size> <mtime>
+    <starting point>
+    <path relative to the starting point>
+"""
+from __future__ import division, print_function, unicode_literals
+
+import sys
+
+try:
+    from shlex import quote
+except ImportError: # python2
+    from pipes import quote
+
+from . import utils
+
+FORMAT = r'%y%Y %i %s %T@\0%H\0%P\0'
+GLOBS = '*?[]!'
+MAX_ROUNDS = 40 # Levels of symlinked directories. Also stops loops
+
+if sys.version_info[0] > 2:
+    xrange = range
+
+def split_excludes(excludes):
+    """
+    Split the excludes (see PFSwalk._set_exclusions) into those find can do
+    and those it can't. Returns (dir_predicates,file_predicates,others)
+    where the predicates are lists of find arguments
+    """
+    dir_preds,file_preds,others = [],[],[]
+    for e in excludes:
+        e = utils.to_unicode(e)
+        if '\\' in e or e in ['/','//']: # find treats '\' as an escape
+            others.append(e)
+            continue
+        if e.endswith('/'):
+            preds,e = dir_preds,e[:-1]
+        else:
+            preds = file_preds
+        if e.startswith('/'):
+            preds.append(['-path','.' + e])
+        elif '/' in e: # would never match a name for PFSwalk either
+            continue
+        else:
+            preds.append(['-name',e])
+    return dir_preds,file_preds,others
+
+def _or(preds):
+    args = ['(']
+    for ii,pred in enumerate(preds):
+        if ii:
+            args.append('-o')
+        args.extend(pred)
+    return args + [')']
+
+def command(root,starts,dir_preds,file_preds,follow):
+    """
+    The shell command to list starts (paths relative to root that begin
+    with './') on the remote.
+    """
+    typ = '-type' if follow else '-xtype' # Directories and files are followed
+
+    args = ['find','-L' if follow else '-H'] + list(starts)
+    if dir_preds:
+        args += ['(',typ,'d'] + _or(dir_preds) + ['-prune',')','-o']
+    if file_preds:
+        args += ['(',typ,'f'] + _or(file_preds) + [')','-o']
+    args += ['-printf',FORMAT]
+    return 'cd {} && {}'.format(quote(root),' '.join(quote(a) for a in args))
+
+def _tokens(stream,bufsize=1024**2):
+    rest = b''
+    while True:
+        data = stream.read(bufsize)
+        if not data:
+            break
+        parts = (rest + data).split(b'\0')
+        rest = parts.pop()
+        for part in parts:
+            yield part
+
+def _mtime(text):
+    """
+    Convert the %T@ seconds the same way python does for st_mtime (so that
+    the same file gets the same float)
+    """
+    sec,_,frac = text.partition('.')
+    return int(sec) + int((frac[:9] or '0').ljust(9,'0'))*1e-9
+
+def parse(stream):
+    """
+    Generate (kind,path,info) from the output of command(). kind is:
+        'f': file. info is {'ino','size','mtime'}
+        'd': directory
+        'l': symlinked directory to list again
+        'b': broken link
+    Anything else (e.g. sockets) is skipped as in PFSwalk
+    """
+    tokens = _tokens(stream)
+    for head,start,path in zip(tokens,tokens,tokens):
+        head = utils.to_unicode(head)
+        start,path = utils.to_unicode(start),utils.to_unicode(path)
+        if start != '.':
+            start = start[2:] # Remove './'
+            path = start + '/' + path if path else start
+
+        kind,followed = head[0],head[1]
+        if followed == 'd':
+            yield ('l' if kind == 'l' else 'd'),path,None
+        elif followed == 'f':
+            _,ino,size,mtime = head.split(' ')
+            yield 'f',path,{'ino':int(ino),'size':int(size),'mtime':_mtime(mtime)}
+        elif kind == 'l' or followed in 'NL':
+            yield 'b',path,None
+
+def empty_dirs(dirs,paths):
+    """
+    The dirs with no file (in paths) anywhere under them. Same as PFSwalk
+    where a directory is empty if nothing is listed from it.
+    """
+    full = set()
+    for path in paths:
+        for parent in utils.parent_dirs(path):
+            if parent in full:
+                break
+            full.add(parent)
+    return set(d for d in dirs if d and d not in full)
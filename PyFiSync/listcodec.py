@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact, streamed encoding of file lists (e.g. the remote file list).
+
+JSON of the full list repeats every key for every file and the whole string
+(plus the compressed copy) has to be in memory before anything can be done
+with it. Instead, the records are sorted by path and written in blocks that
+can be decoded as they arrive:
+
+    MAGIC | header length (4 bytes) | header JSON
+    block length (4 bytes) | block
+    ...
+    0 (4 bytes)
+
+The header has the columns (name and type) and the compression level. Each
+block is zlib compressed (unless the level is 0) and stored by column:
+
+    number of records
+    flags (one byte per record)
+    shared path prefix length and suffix length (per record)
+    length of all path suffixes | all path suffixes
+    values of each column
+    JSON of irregular records
+
+Paths are front-coded (the bytes in common with the previous path are not
+repeated). Integers are zigzag varints, floats are 8 byte doubles, and
+strings are all of the varint lengths followed by all of the UTF-8. If a
+record does not match the columns (missing or extra keys, or different
+types), its flag is 1 and the rest of the record is JSON. Otherwise, its
+values are in the columns.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import sys
+import json
+import zlib
+import struct
+from operator import itemgetter
+from itertools import repeat
+
+if sys.version_info[0] > 2:
+    unicode = str
+    long = int
+    _buffer = bytes # Indexing gives ints
+else:
+    _buffer = bytearray
+
+VERSION = 1
+MAGIC = b'PFSL'
+BLOCK_RECORDS = 4096
+DEFAULT_LEVEL = 6
+
+_LEN = struct.Struct('>I')
+_FLOAT = struct.Struct('>d')
+
+class _Irregular(Exception):
+    pass
+
+def _column_type(value):
+    if isinstance(value,bool):
+        return 'j'
+    if isinstance(value,(int,long)):
+        return 'i'
+    if isinstance(value,float):
+        return 'f'
+    if isinstance(value,unicode):
+        return 's'
+    return 'j'
+
+def _put_varint(out,n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _get_varint(buf,pos):
+    b = buf[pos]
+    if b < 0x80:
+        return b,pos+1
+    n,shift = b & 0x7f,7
+    while True:
+        pos += 1
+        b = buf[pos]
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n,pos+1
+        shift += 7
+
+def _put_str(out,text):
+    data = text.encode('utf8')
+    _put_varint(out,len(data))
+    out.extend(data)
+
+def _common_prefix(a,b):
+    n = min(len(a),len(b))
+    ii = 0
+    while ii < n and a[ii] == b[ii]:
+        ii += 1
+    return ii
+
+def _get_varints(buf,pos,count):
+    out = []
+    append = out.append
+    for _ in range(count):
+        b = buf[pos]
+        pos += 1
+        if b < 0x80:
+            append(b)
+            continue
+        n,shift = b & 0x7f,7
+        while True:
+            b = buf[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        append(n)
+    return out,pos
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def _encode_block(files,columns,prev):
+    """ Encode the block. Returns the block and the last path """
+    ncol = len(columns) + 1
+    flags,shared,suffixes,irregular = bytearray(),bytearray(),bytearray(),[]
+    values = [[] for _ in columns]
+    for file in files:
+        path = file['path'].encode('utf8')
+        n = _common_prefix(prev,path)
+        _put_varint(shared,n)
+        _put_varint(shared,len(path) - n)
+        suffixes.extend(path[n:])
+        prev = path
+
+        row = []
+        try:
+            if len(file) != ncol:
+                raise _Irregular()
+            for name,typ in columns:
+                value = file[name]
+                if typ == 'i' and type(value) not in (int,long) \
+                or typ == 'f' and type(value) is not float \
+                or typ == 's' and not isinstance(value,unicode):
+                    raise _Irregular()
+                row.append(value)
+        except (_Irregular,KeyError):
+            flags.append(1)
+            irregular.append(json.dumps(dict((k,v) for k,v in file.items() if k != 'path'),
+                                        ensure_ascii=False))
+            continue
+        flags.append(0)
+        for col,value in zip(values,row):
+            col.append(value)
+
+    block = bytearray()
+    _put_varint(block,len(flags))
+    block.extend(flags)
+    block.extend(shared)
+    _put_varint(block,len(suffixes))
+    block.extend(suffixes)
+    for (name,typ),col in zip(columns,values):
+        if typ == 'i':
+            for value in col:
+                _put_varint(block,_zigzag(value))
+        elif typ == 'f':
+            block.extend(struct.pack('>{}d'.format(len(col)),*col))
+        else:
+            if typ == 'j':
+                col = [json.dumps(value,ensure_ascii=False) for value in col]
+            _put_strs(block,col)
+    _put_strs(block,irregular)
+    return bytes(block),prev
+
+def _put_strs(out,texts):
+    data = [text.encode('utf8') for text in texts]
+    for d in data:
+        _put_varint(out,len(d))
+    for d in data:
+        out.extend(d)
+
+def _get_strs(buf,pos,count):
+    lengths,pos = _get_varints(buf,pos,count)
+    out = []
+    for n in lengths:
+        out.append(buf[pos:pos+n].decode('utf8'))
+        pos += n
+    return out,pos
+
+def encode(files,level=DEFAULT_LEVEL,block_records=BLOCK_RECORDS,info=None):
+    """
+    Generate the encoded bytes (in pieces) for files, an iterable of file
+    dicts (or FileRecords). They are written in path order. The columns are
+    those of the first file (other than 'path').
+
+    level: zlib compression level of each block. 0 to not compress
+    info: Optional (JSON-able) dict stored in the header. See decode
+    """
+    files = sorted(files,key=itemgetter('path'))
+
+    columns = []
+    if files:
+        columns = [(key,_column_type(value)) for key,value in sorted(files[0].items())
+                   if key != 'path']
+
+    header = {'version':VERSION,'level':level,'columns':columns,'info':info or {}}
+    header = json.dumps(header,ensure_ascii=False).encode('utf8')
+    yield MAGIC + _LEN.pack(len(header)) + header
+
+    prev = b''
+    for ii in range(0,len(files),block_records):
+        block,prev = _encode_block(files[ii:ii+block_records],columns,prev)
+        if level:
+            block = zlib.compress(block,level)
+        yield _LEN.pack(len(block)) + block
+    yield _LEN.pack(0)
+
+def dump(files,stream,**kwargs):
+    """ Write the encoded files to the (binary) stream """
+    for data in encode(files,**kwargs):
+        stream.write(data)
+    stream.flush()
+
+def _read(stream,n):
+    data = stream.read(n)
+    if len(data) < n:
+        raise ValueError('Truncated file list')
+    return data
+
+def _decode_block(buf,columns,prev):
+    """ Decode the block. Returns the file dicts and the last path """
+    count,pos = _get_varint(buf,0)
+    flags = buf[pos:pos+count]
+    pos += count
+    shared,pos = _get_varints(buf,pos,2*count)
+    n,pos = _get_varint(buf,pos)
+    suffixes = buf[pos:pos+n]
+    pos += n
+
+    paths = []
+    append = paths.append
+    start = 0
+    for ii in range(0,2*count,2):
+        end = start + shared[ii+1]
+        prev = prev[:shared[ii]] + suffixes[start:end]
+        start = end
+        append(prev)
+    
+    nreg = count - sum(flags) # flags are 0 or 1
+    cols = []
+    for name,typ in columns:
+        if typ == 'i':
+            col,pos = _get_varints(buf,pos,nreg)
+            col = [(v >> 1) ^ -(v & 1) for v in col]
+        elif typ == 'f':
+            col = struct.unpack_from('>{}d'.format(nreg),buf,pos)
+            pos += 8*nreg
+        else:
+            col,pos = _get_strs(buf,pos,nreg)
+            if typ == 'j':
+                col = [json.loads(v) for v in col]
+        cols.append(col)
+    irregular,pos = _get_strs(buf,pos,count - nreg)
+
+    keys = ['path'] + [name for name,_ in columns]
+    if not irregular:
+        files = [dict(zip(keys,row)) for row in zip([p.decode('utf8') for p in paths],*cols)]
+    else:
+        files = []
+        regular = iter(zip(*cols)) if cols else repeat(())
+        irregular = iter(irregular)
+        for path,flag in zip(paths,bytearray(flags)):
+            if flag:
+                file = json.loads(next(irregular))
+                file['path'] = path.decode('utf8')
+            else:
+                file = dict(zip(keys,(path.decode('utf8'),) + tuple(next(regular))))
+            files.append(file)
+    return files,prev
+
+def decode(stream,object_hook=None,check_magic=True,info=None):
+    """
+    Generate the files from the (binary) stream as they are read. Set
+    check_magic=False if MAGIC has already been read off the stream.
+
+    object_hook: Called with each file dict (e.g. filerecord.object_hook)
+    info: Optional dict to update with the info from the header. It is
+          updated before the first file
+    """
+    if check_magic and _read(stream,len(MAGIC)) != MAGIC:
+        raise ValueError('Not an encoded file list')
+    length, = _LEN.unpack(_read(stream,_LEN.size))
+    header = json.loads(_read(stream,length).decode('utf8'))
+    if header['version'] > VERSION:
+        raise ValueError('Unsupported file list version {}'.format(header['version']))
+    level = header['level']
+    columns = [tuple(c) for c in header['columns']]
+    if info is not None:
+        info.update(header.get('info',{}))
+
+    prev = b''
+    while True:
+        length, = _LEN.unpack(_read(stream,_LEN.size))
+        if length == 0:
+            break
+        block = _read(stream,length)
+        if level:
+            block = zlib.decompress(block)
+        files,prev = _decode_block(_buffer(block),columns,prev)
+        for file in files:
+            yield object_hook(file) if object_hook else file
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copy files between two local directories without rsync (for local syncs).
+
+rsync's delta algorithm reads both copies in full and it runs as a separate
+process with the file list in a temp file. For a local copy, the kernel can
+do it directly:
+
+    os.copy_file_range (Linux, python 3.8+. May be a reflink or server-side
+                        copy on some filesystems)
+    os.sendfile        (Linux)
+    shutil.copyfileobj (everywhere else)
+
+The first that works is used from then on. The files are copied on a thread
+pool since the copies are mostly waiting on I/O.
+
+As with rsync, every file is written to a temp file in the destination
+directory and then renamed over the destination. Files are never modified in
+place (hardlink backups depend on that). The mode and the mtime (and owner if
+root) are copied, also for the directories made for the files. Symlinks are
+copied as links or followed based on copy_symlinks_as_links.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import errno
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+if sys.version_info[0] > 2:
+    xrange = range
+
+CHUNK = 8*1024**2
+
+# Copy methods to try in order. One that fails (e.g. not supported by the
+# filesystem) is removed
+_METHODS = []
+if hasattr(os,'copy_file_range'):
+    _METHODS.append('copy_file_range')
+if hasattr(os,'sendfile') and sys.platform.startswith('linux'):
+    _METHODS.append('sendfile')
+
+_UTIME_FD = os.utime in getattr(os,'supports_fd',()) # Not on python2
+
+_UNSUPPORTED = (errno.ENOSYS,errno.EXDEV,errno.EINVAL,errno.EOPNOTSUPP,
+                getattr(errno,'ENOTSUP',errno.EOPNOTSUPP))
+
+def _copy_data(fsrc,fdst):
+    """ Copy all of fsrc to fdst (both at position 0) """
+    for method in list(_METHODS):
+        infd,outfd = fsrc.fileno(),fdst.fileno()
+        try:
+            if method == 'copy_file_range':
+                while os.copy_file_range(infd,outfd,CHUNK):
+                    pass
+            else:
+                offset = 0
+                while True:
+                    sent = os.sendfile(outfd,infd,offset,CHUNK)
+                    if not sent:
+                        break
+                    offset += sent
+            return
+        except OSError as E:
+            if E.errno not in _UNSUPPORTED:
+                raise
+            try:
+                _METHODS.remove(method)
+            except ValueError: # Another thread did
+                pass
+            # Start over. Nothing may have been written but make sure
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+    shutil.copyfileobj(fsrc,fdst,CHUNK)
+
+def _tempname(dst):
+    dirname,name = os.path.split(dst)
+    fd,tmp = tempfile.mkstemp(dir=dirname,prefix='.' + name + '.',suffix='.PyFiSync')
+    return fd,tmp
+
+def copy_file(src,dst,follow_symlinks=True):
+    """
+    Copy src to dst by way of a temp file. Returns the os.stat of (the new)
+    dst
+    """
+    if not follow_symlinks and os.path.islink(src):
+        return _copy_link(src,dst)
+    
+    with open(src,'rb') as fsrc:
+        st = os.fstat(fsrc.fileno())
+        fd,tmp = _tempname(dst)
+        try:
+            with os.fdopen(fd,'wb') as fdst:
+                _copy_data(fsrc,fdst)
+                fdst.flush()
+                _set_stat(fdst.fileno(),st)
+            if not _UTIME_FD: # Must be by name after it is written
+                os.utime(tmp,(st.st_atime,st.st_mtime))
+            new = os.stat(tmp)
+            os.rename(tmp,dst)
+        except BaseException:
+            _remove(tmp)
+            raise
+    return new
+
+def _copy_link(src,dst):
+    st = os.lstat(src)
+    fd,tmp = _tempname(dst)
+    os.close(fd)
+    os.remove(tmp) # Need the (unique) name only
+    try:
+        os.symlink(os.readlink(src),tmp)
+        _set_link_stat(tmp,st)
+        new = os.lstat(tmp)
+        os.rename(tmp,dst)
+    except BaseException:
+        _remove(tmp)
+        raise
+    return new
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _chown(fd_or_link,st):
+    """ Set the owner if root (like rsync -a) """
+    if not hasattr(os,'geteuid') or os.geteuid() != 0:
+        return
+    try:
+        if isinstance(fd_or_link,int):
+            os.fchown(fd_or_link,st.st_uid,st.st_gid)
+        else:
+            os.lchown(fd_or_link,st.st_uid,st.st_gid)
+    except OSError:
+        pass
+
+def _set_stat(fd,st):
+    """ Set the mode, (owner), and times of the open file """
+    _chown(fd,st)
+    os.fchmod(fd,st.st_mode & 0o7777)
+    if _UTIME_FD:
+        os.utime(fd,ns=(st.st_atime_ns,st.st_mtime_ns))
+
+def _set_link_stat(path,st):
+    _chown(path,st)
+    if os.utime not in getattr(os,'supports_follow_symlinks',()):
+        return # Can't set a link's mtime here
+    os.utime(path,ns=(st.st_atime_ns,st.st_mtime_ns),follow_symlinks=False)
+
+def _set_dir_stat(path,st):
+    """ Set the mode, (owner), and times of the directory """
+    _chown(path,st)
+    os.chmod(path,st.st_mode & 0o7777)
+    if _UTIME_FD:
+        os.utime(path,ns=(st.st_atime_ns,st.st_mtime_ns))
+    else:
+        os.utime(path,(st.st_atime,st.st_mtime))
+
+def make_dirs(dst_root,paths):
+    """ 
+    Create the parent directories of paths (once each). Returns the 
+    directories that were made (parents first) and {directory:error} of 
+    those that could not be
+    """
+    dirs = set()
+    for path in paths:
+        dirname = os.path.dirname(path)
+        while dirname and dirname not in dirs:
+            dirs.add(dirname)
+            dirname = os.path.dirname(dirname)
+    made,failed = [],{}
+    for dirname in sorted(dirs): # Parents first
+        parent = os.path.dirname(dirname)
+        if parent in failed:
+            failed[dirname] = failed[parent]
+            continue
+        full = os.path.join(dst_root,dirname)
+        if not os.path.isdir(full): # Also follows dir links (--keep-dirlinks)
+            try:
+                os.mkdir(full)
+                made.append(dirname)
+            except OSError as E:
+                if not os.path.isdir(full):
+                    failed[dirname] = E
+    return made,failed
+
+def copy_files(paths,src_root,dst_root,follow_symlinks=True,threads=8):
+    """
+    Copy paths (relative) from src_root to dst_root. Generates
+    (path,record,error) as each finishes where record is a dict of the
+    copied file's path, size, mtime, and ino or None if there was an error.
+    
+    The directories that are made get the mode and times of the source ones
+    once all files are copied. Errors doing so are generated as 
+    (directory + os.sep,None,error)
+    """
+    made,failed = make_dirs(dst_root,paths)
+
+    def _copy(path):
+        dirname = os.path.dirname(path)
+        if dirname in failed:
+            return path,None,failed[dirname]
+        try:
+            st = copy_file(os.path.join(src_root,path),os.path.join(dst_root,path),
+                           follow_symlinks=follow_symlinks)
+        except (OSError,IOError) as E:
+            return path,None,E
+        return path,{'path':path,'size':st.st_size,'mtime':st.st_mtime,'ino':st.st_ino},None
+
+    if threads <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield _copy(path)
+    else:
+        pool = ThreadPool(min(threads,len(paths)))
+        try:
+            for res in pool.imap_unordered(_copy,paths,chunksize=16):
+                yield res
+        finally:
+            pool.terminate()
+    
+    # Last since copying into them changes the mtimes. Children first
+    for dirname in reversed(made):
+        try:
+            st = os.stat(os.path.join(src_root,dirname))
+            _set_dir_stat(os.path.join(dst_root,dirname),st)
+        except OSError as E:
+            yield dirname + os.sep,None,E
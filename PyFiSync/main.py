@@ -3,9 +3,7 @@
 from __future__ import division, print_function, unicode_literals
 from io import open
 
-__version__ = '20211017.0'
-__author__ = 'Justin Winokur'
-__license__ = 'MIT'
+from . import __version__,__author__,__license__
 
 import os
 import sys
@@ -19,6 +17,8 @@ import itertools
 import re
 import copy
 import json
+import threading
+from multiprocessing.pool import ThreadPool
 
 if sys.version_info[0]<3:
     range = xrange
@@ -33,9 +33,14 @@ if self_path not in sys.path:
 
 from . import utils
 from . import PFSwalk
+from . import filerecord
 from .dicttable import DictTable
 from . import dry_run
 from . import remote_interfaces
+from . import npengine
+from . import extengine
+from . import parengine
+from . import streaming
 
 def init(path,remote='rsync'):
     """
@@ -106,12 +111,10 @@ def reset_tracking(backup=True,empty='reset',set_time=False):
         
         log.prepend = ''
     else:
-        filesA = PFSwalker.files()
-        
-        log.add('  Parsing files for B (local)')
+        log.add('  Parsing files for B (local, concurrently)')
         _tmp = PFSwalk.file_list(config.pathB,config,log,attributes=attribB,empty=empty,
                                  use_hash_db=config.use_hash_db)
-        filesB = _tmp.files()
+        filesA,filesB = local_walks(PFSwalker,_tmp)
         
     filesA_old = os.path.join(config.pathA,'.PyFiSync','filesA.old')
     filesB_old = os.path.join(config.pathA,'.PyFiSync','filesB.old')
@@ -131,14 +134,26 @@ def reset_tracking(backup=True,empty='reset',set_time=False):
 
     # Dump the json (see http://stackoverflow.com/a/28032808/3633154)
     with open(filesA_old,'w',encoding='utf8') as F:
-        data = json.dumps(filesA,ensure_ascii=False)
+        data = json.dumps(filesA,ensure_ascii=False,default=filerecord.json_default)
         F.write(utils.to_unicode(data))
         txt = 'saved ' + filesA_old
     with open(filesB_old,'w',encoding='utf8') as F:
-        data = json.dumps(filesB,ensure_ascii=False)
+        data = json.dumps(filesB,ensure_ascii=False,default=filerecord.json_default)
         F.write(utils.to_unicode(data))
         txt = 'saved ' + filesB_old
     
+    # Record which remote listing this is so that next time only the changes
+    # need to be sent. See remote_interfaces.ssh_rsync.file_list
+    genpath = os.path.join(config.pathA,'.PyFiSync','filesB.gen')
+    generation = getattr(remote_interface,'generation',None) if remote else None
+    if generation:
+        st = os.stat(filesB_old) # So it is known to be unchanged without reading it
+        with open(genpath,'w') as F:
+            F.write(utils.to_unicode(json.dumps({'generation':generation,
+                                                 'size':st.st_size,'mtime':st.st_mtime})))
+    elif os.path.exists(genpath):
+        os.remove(genpath)
+    
     # This is really *not* needed and slows things down but I will keep it
     # for now
     
@@ -225,9 +240,20 @@ def main(mode):
     PFSwalker = PFSwalk.file_list(config.pathA,config,log,
                                   attributes=attribA,empty='store',
                                   use_hash_db=config.use_hash_db)
+    
+    engine = get_engine()
+    
+    # The external engine spools the lists to disk as they are made
+    recon = sinkA = sinkB = None
+    if engine is extengine:
+        recon = extengine.Reconciler(config,
+                                     tmpdir=os.path.join(config.pathA,'.PyFiSync'),
+                                     exclude_if_present=config.exclude_if_present)
+        sinkA,sinkB = recon.sink('A'),recon.sink('B')
+    
     if remote:
         # Multithread it
-        loc_walk_thread = utils.ReturnThread(target=PFSwalker.files)
+        loc_walk_thread = utils.ReturnThread(target=PFSwalker.files,kwargs={'sink':sinkA})
         loc_walk_thread.daemon = True
         loc_walk_thread.start()
         
@@ -238,17 +264,25 @@ def main(mode):
         filesA = loc_walk_thread.join()
 
         if filesB is None:
+            if recon is not None:
+                recon.close()
             sys.stderr.write('Error on remote call. See logged warnings\n')
             sys.exit(2)
         
+        if sinkB is not None:
+            for file in filesB:
+                sinkB.append(file)
+            filesB = sinkB
+        
         log.prepend = ''
     else:
-        filesA = PFSwalker.files()
-        
-        log.add('  Parsing files for B (local)')
+        log.add('  Parsing files for B (local, concurrently)')
         _tmp = PFSwalk.file_list(config.pathB,config,log,attributes=attribB,empty='store',
                                  use_hash_db=config.use_hash_db)
-        filesB = _tmp.files()
+        filesA,filesB = local_walks(PFSwalker,_tmp,sinks=(sinkA,sinkB))
+
+    # Directory actions need the full lists (see collapse_dir_moves)
+    collapse_dirs = getattr(config,'collapse_directories',False) and engine is not extengine
 
     ## Get file lists
     log.line()
@@ -256,37 +290,71 @@ def main(mode):
 
     filesA_old = os.path.join(config.pathA,'.PyFiSync','filesA.old')
     filesB_old = os.path.join(config.pathA,'.PyFiSync','filesB.old')
-
-    with open(filesA_old,encoding='utf8') as F:
-        filesA_old = json.loads(F.read())
-
-    with open(filesB_old,encoding='utf8') as F:
-        filesB_old = json.loads(F.read())
-
-    filesA_old = PFSwalker.filter_old_list(filesA_old)
-    filesB_old = PFSwalker.filter_old_list(filesB_old)
-    
-    log.line()
-    log.add('Creating DB objects')
-    filesA     = DictTable(filesA    )
-    filesB     = DictTable(filesB    )
-    filesA_old = DictTable(filesA_old)
-    filesB_old = DictTable(filesB_old)
     
-    if config.exclude_if_present:
-        PFSwalk.exclude_if_present(filesA,filesB,config.exclude_if_present) # in place
+    # The remote may have already read filesB.old to get the file list
+    old_listB = getattr(remote_interface,'old_list',None) if remote else None
+
+    if engine is extengine:
+        log.add('  Using the external (bounded-memory) engine')
+        del filesA,filesB # The sinks
+        try:
+            # Stream the old lists to disk too
+            recon.add_files('A',_iter_old_list(filesA_old,PFSwalker),old=True)
+            if old_listB is not None:
+                recon.add_files('B',PFSwalker.filter_old(old_listB),old=True)
+            else:
+                recon.add_files('B',_iter_old_list(filesB_old,PFSwalker),old=True)
+            
+            log.line()
+            log.add('Using old file lists to determine moves and deletions\n')
+            filesA,filesB,filesA_old,filesB_old = recon.reduce()
+        finally:
+            recon.close()
+        
+        log.add('  Local:  {}'.format(recon.summary('A')))
+        log.add('  Remote: {}'.format(recon.summary('B')))
+        log.add('  Reduced to {} (A) and {} (B) files to reconcile'.format(
+                len(filesA),len(filesB)))
+        log.prepend = '  '
+        
+        cache_size = config.query_cache_size
+        filesA     = DictTable(filesA    ,cache_size=cache_size,fixed_attributes=['path'] + TRACK_ATTRIBUTES)
+        filesB     = DictTable(filesB    ,cache_size=cache_size,fixed_attributes=['path'] + TRACK_ATTRIBUTES)
+        filesA_old = DictTable(filesA_old,cache_size=cache_size,fixed_attributes=['path','deleted'])
+        filesB_old = DictTable(filesB_old,cache_size=cache_size,fixed_attributes=['path','deleted'])
+        engine = None # The rest is the in-memory python code
+    else:
+        filesA_old = _load_old_list(filesA_old,PFSwalker)
+        filesB_old = _load_old_list(filesB_old,PFSwalker,files_old=old_listB)
     
-    log.add('')
-    log.add('  Local:  {}'.format(utils.file_summary(filesA)))
-    log.add('  Remote: {}'.format(utils.file_summary(filesB)))
+        log.line()
+        log.add('Creating DB objects')
+        # Only index what will actually be queried. The tracking attributes are
+        # added in file_track
+        cache_size = config.query_cache_size
+        filesA     = DictTable(filesA    ,cache_size=cache_size,fixed_attributes=['path'])
+        filesB     = DictTable(filesB    ,cache_size=cache_size,fixed_attributes=['path'])
+        filesA_old = DictTable(filesA_old,cache_size=cache_size,
+                               fixed_attributes=_old_attributes(config.prev_attributesA,config.move_attributesA))
+        filesB_old = DictTable(filesB_old,cache_size=cache_size,
+                               fixed_attributes=_old_attributes(config.prev_attributesB,config.move_attributesB))
+        
+        if config.exclude_if_present:
+            PFSwalk.exclude_if_present(filesA,filesB,config.exclude_if_present) # in place
+        
+        log.add('')
+        log.add('  Local:  {}'.format(utils.file_summary(filesA)))
+        log.add('  Remote: {}'.format(utils.file_summary(filesB)))
+        
+        ## Compare to old to determine new, modified, deleted
+        log.line()
+        log.add('Using old file lists to determine moves and deletions\n')
+        log.prepend = '  '
     
-    ## Compare to old to determine new, modified, deleted
-    log.line()
-    log.add('Using old file lists to determine moves and deletions\n')
-    log.prepend = '  '
-
-    file_track(filesA_old,filesA,config.prev_attributesA,config.move_attributesA)
-    file_track(filesB_old,filesB,config.prev_attributesB,config.move_attributesB)
+        log.add('Reconciliation engine: {}'.format(getattr(engine,'NAME','python')))
+        
+        file_track(filesA_old,filesA,config.prev_attributesA,config.move_attributesA,engine=engine)
+        file_track(filesB_old,filesB,config.prev_attributesB,config.move_attributesB,engine=engine)
     
     ## Determine deletions on both sides (with conflict resolution)
     ## Determine moves on both sides (with conflict resolution)
@@ -301,6 +369,9 @@ def main(mode):
 
     ## Apply them theoretically so as to save a transfer. Everything will
     #  be done in order later
+    if collapse_dirs:
+        move_queueA = collapse_dir_deletes(filesA,collapse_dir_moves(filesA,move_queueA))
+        move_queueB = collapse_dir_deletes(filesB,collapse_dir_moves(filesB,move_queueB))
     move_queueA = apply_move_queues_theoretical(filesA,move_queueA,AB='A')
     move_queueB = apply_move_queues_theoretical(filesB,move_queueB,AB='B')
 
@@ -311,30 +382,51 @@ def main(mode):
     log.add('Determining, resolving conflicts, and queueing file transfers\nbased on modification times\n')
     log.space = 2
     
-    action_queueA,action_queueB,tqA2B,tqB2A = determine_file_transfers(
-        filesA,filesB)
+    paths = transfer_candidates(filesA,filesB,engine=engine)
+    log.add('{} paths to compare\n'.format(len(paths)))
+    
+    # We will use the rsync (via the ssh_rsync) interface. 
+    if not remote:
+        config.persistant = False # Make sure this is off
+        remote_interface = remote_interfaces.ssh_rsync(config,log)
+    
+    pipeline = None
+    if getattr(config,'streaming_transfer',False) and not config._DRYRUN:
+        if hasattr(remote_interface,'transfer_stream'):
+            log.add('Streaming: applying queues and transferring while determining\n')
+            pipeline = streaming.Pipeline(config,log,apply_action_queue,
+                                          remote_interface,remote=remote)
+            pipeline.start(move_queueA,move_queueB)
+        else:
+            log.add("Streaming transfers are not supported with '{}'\n".format(config.remote))
+    
+    try:
+        action_queueA,action_queueB,tqA2B,tqB2A = determine_file_transfers(
+            filesA,filesB,paths=paths,pipeline=pipeline)
+    except:
+        if pipeline is not None:
+            pipeline.close(abort=True) # Stop applying and transferring
+        raise
+    
+    if pipeline is not None:
+        log.space = 0
+        log.line()
+        log.add('Applied queues and transferred (streaming)')
+        log.space = 2
+        pipeline.close()
     
     ## Apply moves/deletions/backups for real
-    log.space = 0
-    log.line()
-    log.add('Applying queues')
-    log.space = 2
+    if pipeline is None:
+        log.space = 0
+        log.line()
+        log.add('Applying queues')
+        log.space = 2
     
     if config._DRYRUN:
         dry_run.apply_action_queue(move_queueA + action_queueA,log,config.nameA,config)
         dry_run.apply_action_queue(move_queueB + action_queueB,log,config.nameB,config)  
-    else:
-        apply_action_queue(config.pathA,move_queueA + action_queueA)
-
-        if remote:
-            remote_interface.apply_queue(move_queueB + action_queueB)
-        else:
-            apply_action_queue(config.pathB,move_queueB + action_queueB)
-        
-    # We will use the rsync (via the ssh_rsync) interface. 
-    if not remote:
-        config.persistant = False # Make sure this is off
-        remote_interface = remote_interfaces.ssh_rsync(config,log)
+    elif pipeline is None:
+        apply_queues(move_queueA + action_queueA,move_queueB + action_queueB,remote)
     
     log.space = 0;log.prepend = ''
     log.line()
@@ -350,8 +442,16 @@ def main(mode):
     log.space=2
     if config._DRYRUN:
         dry_run.transfer(tqA2B,tqB2A,log,filesA,filesB)
+    elif pipeline is None:
+        remote_interface.transfer(tqA2B,tqB2A,filesA=filesA,filesB=filesB)
     else:
-        remote_interface.transfer(tqA2B,tqB2A)
+        log.add('(already transferred while streaming)')
+    
+    if cache_size > 0:
+        log.space = 0
+        log.add('\nQuery cache (hits/misses):')
+        for name,files in [('A',filesA),('B',filesB),('A (old)',filesA_old),('B (old)',filesB_old)]:
+            log.add('  {:8s} {hits:d}/{misses:d}'.format(name,**files.cache_info()))
     
     ## Get updated lists
     log.space = 0
@@ -365,34 +465,159 @@ def main(mode):
     log.space = 0
     log.add_close()
 
-def file_track(files_old,files_new,prev_attributes,move_attributes):
+def local_walks(walkerA,walkerB,sinks=(None,None)):
+    """
+    Walk A and B at the same time (they are often on different disks). 
+    Threads are fine since most of the time is spent in the filesystem calls
+    and hashing, both of which release the GIL.
+    
+    Each walk logs to its own buffer that is added to the log (A then B) 
+    when both are done so the messages are not mixed together.
+    
+    The sinks are passed to PFSwalk.files
+    """
+    logs = []
+    for walker,AB in [(walkerA,'A'),(walkerB,'B')]:
+        logs.append(walker.log)
+        walker.log = utils.bufferedlog(walker.log,AB)
+    
+    try:
+        walk_threadB = utils.ReturnThread(target=walkerB.files,kwargs={'sink':sinks[1]})
+        walk_threadB.daemon = True
+        walk_threadB.start()
+        
+        try:
+            filesA = walkerA.files(sink=sinks[0])
+        finally:
+            filesB = walk_threadB.join() # Always wait for B
+    finally:
+        for walker,log0 in zip([walkerA,walkerB],logs):
+            walker.log.flush()
+            walker.log = log0
+    
+    return filesA,filesB
+
+def apply_queues(queueA,queueB,remote):
+    """
+    Apply the action queues on A and B at the same time. They are on different
+    machines (or at least directories) and do not depend on each other.
+    
+    As with local_walks, each logs to its own buffer that is added to the log
+    (A then B) when both are done.
+    """
+    logA = utils.bufferedlog(log,'A')
+    logB = utils.bufferedlog(log,'B')
+    
+    def applyB():
+        if remote:
+            remote_interface.apply_queue(queueB)
+        else:
+            apply_action_queue(config.pathB,queueB,log=logB)
+    
+    if remote:
+        log0 = remote_interface.log
+        remote_interface.log = logB
+    try:
+        apply_threadB = utils.ReturnThread(target=applyB)
+        apply_threadB.daemon = True
+        apply_threadB.start()
+        
+        try:
+            apply_action_queue(config.pathA,queueA,log=logA)
+        finally:
+            apply_threadB.join() # Always wait for B
+    finally:
+        if remote:
+            remote_interface.log = log0
+        logA.flush()
+        logB.flush()
+
+def _load_old_list(path,PFSwalker,files_old=None):
+    """
+    Load the old file list at path (unless files_old, the already loaded 
+    list, is given) and apply the (current) exclusions
+    """
+    if files_old is None:
+        object_hook = filerecord.object_hook if config.compact_file_records else None
+        with open(path,encoding='utf8') as F:
+            files_old = json.loads(F.read(),object_hook=object_hook)
+    return PFSwalker.filter_old_list(files_old)
+
+def _iter_old_list(path,PFSwalker):
+    """
+    Generate the files of the old list at path (with the current exclusions)
+    without loading all of it. See _load_old_list
+    """
+    object_hook = filerecord.object_hook if config.compact_file_records else None
+    with open(path,encoding='utf8') as F:
+        for file in PFSwalker.filter_old(utils.iter_json_list(F,object_hook=object_hook)):
+            yield file
+
+def _old_attributes(prev_attributes,move_attributes):
+    """
+    The attributes of the old file lists that are queried in file_track
+    """
+    attributes = ['path','mtime']
+    for attrib in prev_attributes + move_attributes:
+        if attrib not in attributes:
+            attributes.append(attrib)
+    return attributes
+
+TRACK_ATTRIBUTES = ['newmod','new','untouched','moved','prev_path']
+
+def file_track(files_old,files_new,prev_attributes,move_attributes,engine=None):
+    """
+    Determine the status of each file in files_new (and whether those in 
+    files_old were deleted). If an engine (e.g. npengine) is specified, it
+    will be used unless it raises that it cannot handle the lists.
+    """
 
     # Add certain fields to the DBs. Do it this way so that they get set with defaults
     for file in files_new:
-        for attrib,val in zip(['newmod','new','untouched','moved','prev_path'],
+        for attrib,val in zip(TRACK_ATTRIBUTES,
                               [False,   False,False      ,False  ,None,]):
             file[attrib] = val
     for file in files_old:
         file['deleted'] = True
     
-    for attrib in ['newmod','new','untouched','moved','prev_path']:
-        files_new.add_fixed_attribute(attrib)
+    # Only the tracking attributes are new so only (re)index them. All at once
+    for attrib in TRACK_ATTRIBUTES:
+        files_new.add_fixed_attribute(attrib,reindex=False)
+    files_old.add_fixed_attribute('deleted',reindex=False)
     
-    files_old.add_fixed_attribute('deleted')
+    files_new.reindex(*TRACK_ATTRIBUTES)
+    files_old.reindex('deleted')
+
+    done = False
+    if engine is not None:
+        try:
+            engine.file_track(files_old,files_new,prev_attributes,move_attributes)
+            done = True
+        except npengine.Unsupported:
+            pass # Use python
+
+    if not done:
+        _file_track_loop(files_old,files_new,prev_attributes,move_attributes)
     
-    files_new.reindex()
-    files_old.reindex()    
+    # Reindex the DBs. Only the tracking attributes were changed
+    files_old.reindex('deleted')
+    files_new.reindex(*TRACK_ATTRIBUTES)
 
-    # Main loop
+def _file_track_loop(files_old,files_new,prev_attributes,move_attributes):
+    """
+    Pure-python main loop of file_track. If more than one old file matches,
+    the first in the old list is used (as by every engine)
+    """
     for file in files_new.items():
 
         # is it untouched
         query_dict = {a:file[a] for a in prev_attributes + ['mtime']}
-        if query_dict in files_old:
+        file_old = files_old.query_first(query_dict)
+        if file_old is not None:
             file['prev_path'] = file['path']
             file['untouched'] = True
 
-            files_old.query_one(query_dict)['deleted'] = False
+            file_old['deleted'] = False
             continue
 
         # is it the same exact file but modified?
@@ -400,19 +625,19 @@ def file_track(files_old,files_new,prev_attributes,move_attributes):
         # account for cases when the file is marked as new via some attribute
         # but was just modified (e.g. size,sha1)
         query_dict = {a:file[a] for a in prev_attributes}
-        if query_dict in files_old:
+        file_old = files_old.query_first(query_dict)
+        if file_old is not None:
             # The mtime MUST have changed since it didn't match the past check
             file['prev_path'] = file['path']
             file['newmod'] = True
-            files_old.query_one(query_dict)['deleted'] = False
+            file_old['deleted'] = False
             continue
 
         # has it been moved?
         query_dict = {a:file[a] for a in move_attributes}
-        if query_dict in files_old:
+        file_old = files_old.query_first(query_dict)
+        if file_old is not None:
             # file was moved
-            file_old = files_old.query_one(query_dict)
-
             file['prev_path'] = file_old['path']
             file['moved'] = True
             file_old['deleted'] = False
@@ -428,9 +653,27 @@ def file_track(files_old,files_new,prev_attributes,move_attributes):
         file['newmod'] = True
         file['new'] = True
 
-    # Reindex the DBs
-    files_old.reindex()
-    files_new.reindex()
+def get_engine():
+    """
+    Return the reconciliation engine module based on config.reconcile_engine
+    or None for pure-python
+    """
+    name = getattr(config,'reconcile_engine','python')
+    if name == 'external':
+        return extengine
+    if name == 'parallel':
+        if not parengine.AVAILABLE:
+            raise ValueError("reconcile_engine = 'parallel' is not supported on this system")
+        return parengine.Engine(getattr(config,'reconcile_processes',0) or None)
+    if name == 'auto':
+        return npengine if npengine.AVAILABLE else None
+    elif name == 'numpy':
+        if not npengine.AVAILABLE:
+            raise ValueError("reconcile_engine = 'numpy' but numpy is not installed")
+        return npengine
+    elif name == 'python':
+        return None
+    raise ValueError('Unrecognized reconcile_engine {}'.format(name))
 
 def compare_queue_moves(filesA,filesB,filesA_old,filesB_old):
     """
@@ -465,6 +708,11 @@ def compare_queue_moves(filesA,filesB,filesA_old,filesB_old):
     txt += '         transfers\n'
     txt += '           File: {path:s}'
 
+    # Deletions are collected and removed in one pass *after* each loop. Each
+    # loop only queries the table it removes from by the (unique) old paths
+    removeA = []
+    removeB = []
+
     # Process deletions on A.
     for fileA_old in filesA_old.query(deleted=True):
         path = fileA_old['path']
@@ -484,7 +732,9 @@ def compare_queue_moves(filesA,filesB,filesA_old,filesB_old):
 
         # Delete file B and apply it before comparing moves later
         queueB.append({'delete':path} )
-        filesB.remove(path=path)
+        removeB.append({'path':path})
+    
+    filesB.remove_many(removeB)
 
     # Process deletions on B
     for fileB_old in filesB_old.query(deleted=True):
@@ -505,7 +755,9 @@ def compare_queue_moves(filesA,filesB,filesA_old,filesB_old):
 
         # Delete file B and apply it before comparing moves later
         queueA.append({'delete':path} )
-        filesA.remove(path=path)
+        removeA.append({'path':path})
+    
+    filesA.remove_many(removeA)
 
     # We loop through all possible prev_paths and handle it that way
     # Every file that is marked as moved also has a prev path
@@ -517,8 +769,9 @@ def compare_queue_moves(filesA,filesB,filesA_old,filesB_old):
     log.space = 2
 
     for prev_path in prev_paths:
-        fileA = filesA.query_one(prev_path=prev_path)
-        fileB = filesB.query_one(prev_path=prev_path)
+        # If more than one, use the first (so it doesn't depend on the engine)
+        fileA = filesA.query_first(prev_path=prev_path)
+        fileB = filesB.query_first(prev_path=prev_path)
 
         # Check if one was deleted. Both can't be.
         # If deleted, make sure to set it as mod
@@ -564,10 +817,160 @@ def compare_queue_moves(filesA,filesB,filesA_old,filesB_old):
     # and we don't care about them anymore
     return queueA,queueB
 
+def collapse_dir_moves(files,queue):
+    """
+    Replace the moves of *every* file in a directory to the same relative
+    path in another (new) directory with a single 
+        {'movedir': [src_dir,dest_dir,names]}
+    so that it is done with one rename. Uses the highest such directory.
+    names are the moved files relative to src_dir.
+    
+    files is the file list that the queue will be applied to. It must be the
+    full list of files.
+    
+    A directory is only collapsed if nothing else in the queue moves into
+    or out of it, nothing moves out of the destination, and the destination
+    does not exist. The files are still moved one at a time if, when applied,
+    the directory has anything else in it (e.g. excluded files) or is a link
+    (see apply_action_queue)
+    """
+    global log
+    moves = [a['move'] for a in queue if 'move' in a]
+    if not moves:
+        return queue
+    
+    # Count the moves for each candidate (src_dir,dest_dir) and how many
+    # moves go into and out of each directory
+    pairs = {}
+    moved_from = {}
+    moved_to = {}
+    for src,dest in moves:
+        for pair in _dir_pairs(src,dest):
+            pairs.setdefault(pair,[]).append(src[len(pair[0])+1:])
+        for parent in utils.parent_dirs(src):
+            moved_from[parent] = moved_from.get(parent,0) + 1
+        for parent in utils.parent_dirs(dest):
+            moved_to[parent] = moved_to.get(parent,0) + 1
+    if not pairs:
+        return queue
+    
+    # Count the files in each source and see which destinations exist
+    src_dirs = set(src_dir for src_dir,_ in pairs)
+    dest_dirs = set(dest_dir for _,dest_dir in pairs)
+    counts = {}
+    occupied = set()
+    for file in files:
+        path = file['path']
+        if path in dest_dirs or path in src_dirs:
+            occupied.add(path) # A file. Not a directory
+        for parent in utils.parent_dirs(path):
+            if parent in src_dirs:
+                counts[parent] = counts.get(parent,0) + 1
+            if parent in dest_dirs:
+                occupied.add(parent)
+    
+    def valid(src_dir,dest_dir):
+        N = len(pairs[(src_dir,dest_dir)])
+        return (counts.get(src_dir,0) == N 
+            and moved_from.get(src_dir,0) == N 
+            and src_dir not in moved_to
+            and dest_dir not in moved_from
+            and dest_dir not in occupied
+            and src_dir not in occupied
+            and not (dest_dir + os.sep).startswith(src_dir + os.sep)
+            and not (src_dir + os.sep).startswith(dest_dir + os.sep))
+    
+    outqueue = []
+    done = set()
+    for action_dict in queue:
+        if 'move' not in action_dict:
+            outqueue.append(action_dict)
+            continue
+        src,dest = action_dict['move']
+        for pair in reversed(list(_dir_pairs(src,dest))): # Highest first
+            if valid(*pair):
+                if pair not in done:
+                    done.add(pair)
+                    outqueue.append({'movedir':list(pair) + [pairs[pair]]})
+                    log.add('Directory moved: {} ({} files)'.format(
+                        utils.move_txt(*pair),len(pairs[pair])))
+                break
+        else:
+            outqueue.append(action_dict)
+    return outqueue
+
+def collapse_dir_deletes(files,queue):
+    """
+    Replace the deletions of *every* file in a directory with a single
+        {'deletedir': [dir,names]}
+    so that it is done with one rename into the backups (or one removal).
+    Uses the highest such directory. names are the deleted files relative 
+    to dir.
+    
+    files is the file list that the queue will be applied to with the 
+    deleted files already removed (see compare_queue_moves). It must be the
+    full list of files. As with moves, the files are still deleted one at a
+    time if, when applied, the directory has anything else in it (e.g. 
+    excluded files) or is a link (see apply_action_queue)
+    """
+    global log
+    deletes = [a['delete'] for a in queue if 'delete' in a]
+    if not deletes:
+        return queue
+    
+    counts = {} # Deleted names in each directory
+    for path in deletes:
+        for parent in utils.parent_dirs(path):
+            counts.setdefault(parent,[]).append(path[len(parent)+1:])
+    
+    # Directories with anything left in them (or moved out of them) can't go
+    occupied = set()
+    remaining = [f['path'] for f in files]
+    remaining.extend(a['move'][0] for a in queue if 'move' in a)
+    for path in remaining:
+        if path in counts:
+            occupied.add(path) # A file. Not a directory
+        for parent in utils.parent_dirs(path):
+            if parent in counts:
+                occupied.add(parent)
+    
+    outqueue = []
+    done = set()
+    for action_dict in queue:
+        if 'delete' not in action_dict:
+            outqueue.append(action_dict)
+            continue
+        for parent in reversed(utils.parent_dirs(action_dict['delete'])): # Highest first
+            if parent not in occupied:
+                if parent not in done:
+                    done.add(parent)
+                    outqueue.append({'deletedir':[parent,counts[parent]]})
+                    log.add('Directory deleted: {} ({} files)'.format(parent,len(counts[parent])))
+                break
+        else:
+            outqueue.append(action_dict)
+    return outqueue
+
+def _dir_pairs(src,dest):
+    """
+    Yield (src_dir,dest_dir) from lowest to highest where the rest of the
+    path is the same:
+        'a/b/f' --> 'c/b/f' yields ('a/b','c/b') then ('a','c')
+    """
+    src = src.split(os.sep)
+    dest = dest.split(os.sep)
+    k = 1
+    while k < min(len(src),len(dest)) and src[-k] == dest[-k]:
+        yield os.sep.join(src[:-k]),os.sep.join(dest[:-k])
+        k += 1
+
 def apply_move_queues_theoretical(files,queue,AB='AB'):
     """
     Apply the move queues to the file lists as if they were performed
-    to make sure they do not overwrite and to reset the names
+    to make sure they do not overwrite and to reset the names.
+    
+    Directory moves are applied by rewriting the prefix of the paths. If any
+    of them would overwrite, it is split back into file moves
     """
     global log
 
@@ -576,28 +979,116 @@ def apply_move_queues_theoretical(files,queue,AB='AB'):
     txt += '          {result:s}'
     
     outqueue = []
+    updates = []
+    
+    # The updates are applied all at once at the end so keep track of which
+    # paths exist as the moves are (theoretically) applied
+    exists = {}
+    def _exists(path):
+        if path in exists:
+            return exists[path]
+        return {'path':path} in files
+    
+    def _move(src,dest):
+        if not _exists(dest):
+            updates.append(({'path':src},{'path':dest})) # Update the paths to consider
+            exists[src] = False
+            exists[dest] = True
+            return True
+        
+        # If you can't do the move, you need to update BOTH files that there is a conflict of sorts
+        updates.append(({'path':src},{'newmod':True}))
+        updates.append(({'path':dest},{'newmod':True}))
+        log.add(txt.format(src=src,dest=dest,result='Skipping'))
+        return False
+    
     for action_dict in queue:
         action,path = list(action_dict.items())[0]
         if action == 'move':
-            src,dest = path
-            if ( {'path':dest} not in files ):
-                files.update({'path':dest},{'path':src}) # Update the paths to consider114
-            else:    
-                # If you can't do the move, you need to update BOTH files that there is a conflict of sorts
-                files.update({'newmod':True},{'path':src})
-                files.update({'newmod':True},{'path':dest})
-                log.add(txt.format(src=src,dest=dest,result='Skipping'))
+            if not _move(*path):
                 continue # so it doesn't get added to the queue
+        elif action == 'movedir':
+            src_dir,dest_dir,names = path
+            file_moves = [(os.path.join(src_dir,name),os.path.join(dest_dir,name)) 
+                          for name in names]
+            if any(_exists(dest) for _,dest in file_moves):
+                # Move them one at a time like before the collapse
+                for src,dest in file_moves:
+                    if _move(src,dest):
+                        outqueue.append({'move':[src,dest]})
+                continue
+            for src,dest in file_moves:
+                _move(src,dest)
         
         outqueue.append(action_dict)
-        
+    
+    files.update_many(updates)
+    
     return outqueue
 
-def determine_file_transfers(filesA,filesB):
+def transfer_candidates(filesA,filesB,engine=None):
+    """
+    Return the set of paths that determine_file_transfers must look at. 
+    
+    These are the paths that are new, newmod, or moved on either side (per
+    file_track and the theoretical moves) or missing on either side. Paths 
+    that are untouched on *both* sides are only included if they do not agree
+    on the mod_attributes (e.g. a prior transfer failed) or cannot be 
+    compared. Everything left out would not have been transferred.
+    
+    If the files were not tracked, all paths are returned.
+    """
+    if engine is not None:
+        try:
+            return engine.transfer_candidates(filesA,filesB,
+                        config.mod_attributes,config.mod_resolution)
+        except npengine.Unsupported:
+            pass
+    
+    if not all('untouched' in files.attributes for files in (filesA,filesB)):
+        paths =  set(fileA['path'] for fileA in filesA.items())
+        paths.update(fileB['path'] for fileB in filesB.items())
+        return paths
+    
+    # Changed on either side. Comes from the index so only costs the changes
+    paths = set(file['path'] for file in filesA.query(untouched=False))
+    paths.update(file['path'] for file in filesB.query(untouched=False))
+    
+    mod_attributes = [tuple(m) for m in config.mod_attributes]
+    untouchedB = dict((file['path'],file) for file in filesB.query(untouched=True))
+    for fileA in filesA.query(untouched=True):
+        path = fileA['path']
+        fileB = untouchedB.pop(path,None)
+        if fileB is None: # Missing or changed on B
+            paths.add(path)
+            continue
+        try:
+            fileA['mtime'],fileB['mtime'] # Needed to compare
+            for attribA,attribB in mod_attributes:
+                if (attribA,attribB) == ('mtime','mtime'):
+                    if abs(fileA['mtime'] - fileB['mtime']) <= config.mod_resolution:
+                        break
+                elif fileA[attribA] == fileB[attribB]:
+                    break
+            else:
+                paths.add(path) # Disagree 
+        except KeyError: # Let determine_file_transfers handle it
+            paths.add(path)
+    
+    paths.update(untouchedB) # Untouched on B and not on A
+    return paths
+
+def determine_file_transfers(filesA,filesB,paths=None,pipeline=None):
     """
     Determine transfers
 
     Note: we only look at new or modified files as per tracking
+    
+    paths: The paths to consider. Defaults to transfer_candidates(). Any path
+           left out MUST be on both sides and agree on mod_attributes (i.e. it
+           would not be transferred).
+    pipeline: Optional streaming.Pipeline to send the queues to as they are
+           determined
     """
     global log
 
@@ -617,8 +1108,10 @@ def determine_file_transfers(filesA,filesB):
 
     global tqA2B,tqB2A
 
-    paths =  set(fileA['path'] for fileA in filesA.items())
-    paths.update(fileB['path'] for fileB in filesB.items())
+    if paths is None:
+        paths = transfer_candidates(filesA,filesB)
+    if pipeline is not None:
+        paths = pipeline.watch(paths,action_queueA,action_queueB,tqA2B,tqB2A)
     for path in paths:
 
         fileA = filesA.query_one(path=path)
@@ -745,18 +1238,31 @@ def determine_file_transfers(filesA,filesB):
 
     return action_queueA,action_queueB,tqA2B,tqB2A
 
-def apply_action_queue(dirpath,queue):
+def apply_action_queue(dirpath,queue,applied=None,log=None,threads=None):
     """
     * queue is the action queue that takes the following form
         * {'backup':[file_path]}  # Make a copy to the backup
         * {'move': [src,dest]}    # Move the file
         * {'delete': [file_path]} # Move the file into the backup. Essentially a backup
+        * {'movedir': [src_dir,dest_dir,names]} # Move the directory (or the 
+                                  # names in it if anything else is there)
+        * {'deletedir': [dir,names]} # Delete the directory (or the names in it)
+      It may be any iterable (e.g. one that is still being filled)
+    * applied: Optional function called with each action once it is applied
+    * log: Optional log to use in place of the global one
+    * threads: Number of actions to apply at once. Defaults to 
+      config.apply_threads. See _apply_parallel
     
     Notes:
         * conflciting/overwriting moves have already been removed at this point
         * Delete should backup first if set config.backup == True
         * Backup should NOT happen if config.backup == False
+        * The log is written (in queue order) at the end
     """
+    if log is None:
+        log = globals()['log']
+    if threads is None:
+        threads = getattr(config,'apply_threads',1)
 
     log.space=2
     log.add('Applying queues on: {:s}'.format(dirpath))
@@ -764,51 +1270,114 @@ def apply_action_queue(dirpath,queue):
     
     backup_path = os.path.join(dirpath,'.PyFiSync','backups',
         datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S'))
-
-    if config.backup:
+    
+    made = set() # Directories already made
+    def makedirs(path):
+        if path in made:
+            return
         try:
-            os.makedirs(backup_path)
+            os.makedirs(path)
         except OSError:
             pass
+        made.add(path)
+    
+    def forget(path):
+        """ path was moved or deleted so it (or under it) must be made again """
+        prefix = path + os.sep
+        for made_path in [p for p in made if p == path or p.startswith(prefix)]:
+            made.discard(made_path)
+    
+    if config.backup:
+        makedirs(backup_path)
 
-    for action_dict in queue:
+    def apply(action_dict):
+        """ Apply the action and return the log message """
         action,path = list(action_dict.items())[0]
         if action == 'move':
             src = os.path.join(dirpath,path[0])
             dest = os.path.join(dirpath,path[1])
-            dest_dir = os.path.split(dest)[0]
-            
-            try:
-                os.makedirs(dest_dir)
-            except OSError:
-                pass
+            makedirs(os.path.dirname(dest))
 
             shutil.move(src,dest)
-            log.add('move: ' + utils.move_txt(path[0],path[1]))
+            return 'move: ' + utils.move_txt(path[0],path[1])
+        
+        if action == 'movedir':
+            src_dir,dest_dir,names = path
+            src = os.path.join(dirpath,src_dir)
+            dest = os.path.join(dirpath,dest_dir)
+            if not _dir_holds_only(src,names):
+                # Something else is in it (e.g. excluded files) or it is a
+                # link. Move the files so that is left alone
+                messages = ['move dir: {} has untracked files or is a link. '
+                            'Moving files'.format(src_dir)]
+                messages.extend(apply({'move':[os.path.join(src_dir,name),
+                                               os.path.join(dest_dir,name)]}) 
+                                for name in names)
+                return '\n'.join(messages)
+            makedirs(os.path.dirname(dest))
+            
+            if os.path.exists(dest): # e.g. an empty or excluded directory
+                _merge_dirs(src,dest)
+            else:
+                shutil.move(src,dest)
+            forget(src)
+            return 'move dir: ' + utils.move_txt(src_dir,dest_dir)
+
+        if action == 'deletedir':
+            src_dir,names = path
+            src = os.path.join(dirpath,src_dir)
+            if not _dir_holds_only(src,names):
+                # Something else is in it (e.g. excluded files) or it is a
+                # link. Delete the files so that is left alone
+                messages = ['delete dir: {} has untracked files or is a link. '
+                            'Deleting files'.format(src_dir)]
+                messages.extend(apply({'delete':os.path.join(src_dir,name)}) 
+                                for name in names)
+                return '\n'.join(messages)
+            
+            dest = os.path.join(backup_path,src_dir) if config.backup else None
+            if dest:
+                makedirs(os.path.dirname(dest))
+                shutil.move(src,dest)
+            else:
+                shutil.rmtree(src)
+            forget(src)
+            return 'delete dir (w/{} backup): {}'.format('' if dest else 'o',src_dir)
 
         if action in ['backup','delete']:
             src = os.path.join(dirpath,path)
-            
             dest = os.path.join(backup_path,path)
-            dest_dir = os.path.split(dest)[0]
-
-            try:
-                os.makedirs(dest_dir)
-            except OSError:
-                pass
+            
+            if config.backup:
+                makedirs(os.path.dirname(dest))
 
             if action == 'backup' and config.backup:
-                shutil.copy2(src,dest)
-                log.add('backup: ' + path)
+                utils.backup_copy(src,dest,method=getattr(config,'backup_method','copy'))
+                return 'backup: ' + path
             elif action=='delete' and config.backup:
                 shutil.move(src,dest)
-                log.add('delete (w/ backup): ' + path)
+                return 'delete (w/ backup): ' + path
             elif action=='delete' and not config.backup:
                 os.remove(src)
-                log.add('delete (w/o backup): ' + path)
+                return 'delete (w/o backup): ' + path
             else:
                 pass # Do nothing for now
     
+    messages = []
+    try:
+        if threads > 1:
+            _apply_parallel(apply,queue,threads,applied,messages)
+        else:
+            for action_dict in queue:
+                messages.append(apply(action_dict))
+                if applied is not None:
+                    applied(action_dict)
+    finally:
+        # One write rather than one per action
+        messages = [m for m in messages if m is not None]
+        if messages:
+            log.add('\n'.join(messages))
+    
     # Remove the backup directory if it was never used
     try:
         os.rmdir(backup_path)
@@ -816,6 +1385,139 @@ def apply_action_queue(dirpath,queue):
         if config.backup:
             log.add('\nBackups saved in: {}'.format(backup_path))
 
+def _apply_parallel(apply,queue,threads,applied,messages):
+    """
+    Call apply() on each action of the queue in a thread pool and append the
+    results to messages in queue order. This mostly helps when each file 
+    operation is slow (e.g. network filesystems).
+    
+    Each action waits for the earlier actions that touch any of the same paths
+    (e.g. a backup before a move onto it or a move out of a path before a move
+    into it), or a parent or child of them, so the result is the same as in 
+    order. Since the dependencies are always earlier in the queue, they are
+    already running or done when an action is started.
+    
+    Directory actions ('movedir' and 'deletedir') act on whole subtrees so 
+    they, and any action on a path that shares a prefix with one of them, are
+    applied alone: after everything before and before anything after. The
+    directories are collected before starting if the queue is a list and 
+    otherwise as they come (they are all in the move queue at the start).
+    
+    After an error, actions not yet started are skipped and the first error 
+    (in queue order) is raised.
+    """
+    stop = threading.Event()
+    
+    def _apply(action_dict,deps):
+        for dep in deps:
+            dep.wait()
+        if stop.is_set():
+            return None
+        try:
+            message = apply(action_dict)
+        except:
+            stop.set()
+            raise
+        if applied is not None:
+            applied(action_dict)
+        return message
+    
+    dirs = set()        # Paths of the directory actions
+    dir_parents = set() # and their parents
+    def add_dirs(action_dict):
+        if _is_dir_action(action_dict):
+            for path in streaming.action_paths(action_dict):
+                dirs.add(path)
+                dir_parents.update(utils.parent_dirs(path))
+    
+    def shares_prefix(path):
+        return (path in dirs or path in dir_parents 
+                or any(p in dirs for p in utils.parent_dirs(path)))
+    
+    if isinstance(queue,(list,tuple)):
+        for action_dict in queue:
+            add_dirs(action_dict)
+    
+    pool = ThreadPool(threads)
+    last = {}  # path: result of the last action on it
+    under = {} # directory: results of all actions on paths under it
+    barrier = None # The last action that was applied alone
+    since = []     # and the results since
+    results = []
+    try:
+        for action_dict in queue:
+            add_dirs(action_dict)
+            paths = streaming.action_paths(action_dict)
+            
+            if any(shares_prefix(path) for path in paths):
+                deps = since + ([barrier] if barrier is not None else []) # Everything before
+                res = pool.apply_async(_apply,(action_dict,deps))
+                barrier,since = res,[]
+                last.clear()
+                under.clear()
+                results.append(res)
+                if stop.is_set():
+                    break
+                continue
+            
+            deps = [barrier] if barrier is not None else []
+            for path in paths:
+                parents = utils.parent_dirs(path)
+                deps.extend(last[p] for p in [path] + parents if p in last)
+                deps.extend(under.get(path,[]))
+            
+            res = pool.apply_async(_apply,(action_dict,deps))
+            
+            for path in paths:
+                last[path] = res
+                for parent in utils.parent_dirs(path):
+                    under.setdefault(parent,[]).append(res)
+            since.append(res)
+            results.append(res)
+            if stop.is_set():
+                break
+    finally:
+        pool.close()
+        pool.join()
+    
+    for res in results:
+        messages.append(res.get()) # Raises the first error
+
+def _is_dir_action(action_dict):
+    return 'movedir' in action_dict or 'deletedir' in action_dict
+
+def _dir_holds_only(path,names):
+    """
+    Whether path is a directory (and not a link to one) whose files are 
+    exactly names (relative to path). Empty directories are fine but 
+    anything else (e.g. untracked files or linked directories) is not
+    """
+    if os.path.islink(path) or not os.path.isdir(path):
+        return False
+    names = set(os.path.normpath(name) for name in names)
+    found = 0
+    for dirpath,dirnames,filenames in os.walk(path):
+        if any(os.path.islink(os.path.join(dirpath,d)) for d in dirnames):
+            return False
+        rel = os.path.relpath(dirpath,path)
+        for filename in filenames:
+            if os.path.normpath(os.path.join(rel,filename)) not in names:
+                return False
+            found += 1
+    return found == len(names)
+
+def _merge_dirs(src,dest):
+    """ Move everything in src into the existing dest and remove src """
+    for dirpath,dirnames,filenames in os.walk(src,topdown=False):
+        destpath = os.path.join(dest,os.path.relpath(dirpath,src))
+        try:
+            os.makedirs(destpath)
+        except OSError:
+            pass
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath,d))]:
+            shutil.move(os.path.join(dirpath,name),os.path.join(destpath,name))
+        os.rmdir(dirpath)
+
 def search_up_PyFiSync(path):
     path = os.path.abspath(path) # nothing relative
     
@@ -963,7 +1665,8 @@ def cli(argv=None):
         #       and this was easier. But this should be fixed if more remotes
         #       are ever added and they need to communicate
 
-        remote_interfaces.ssh_rsync.cli(argv[1:])
+        from . import api
+        api.cli(argv[1:])
         sys.exit()
     
     args = parser_main.parse_args(argv)
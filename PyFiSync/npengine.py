@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+NumPy columnar reconciliation engine (optional).
+
+The file lists are converted to structured arrays where every attribute
+(including the path) is integer coded. The classification of file_track and
+the comparison in determine_file_transfers are then done as vectorized
+sort/searchsorted joins rather than per-file DictTable queries.
+
+The *decisions* must be identical to the pure-Python engine in main. To
+ensure that:
+
+* Anything that cannot be handled (unhashable values, missing attributes on
+  the new files, etc) raises Unsupported and the caller falls back to Python.
+* If a file matches more than one old file, the old file is picked with the
+  same DictTable query as the Python engine.
+* determine_file_transfers is still run in Python but only on the candidate
+  paths from transfer_candidates(). The rest are on both sides and agree.
+
+If numpy is not installed, AVAILABLE is False.
+"""
+from __future__ import division, print_function, unicode_literals
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+AVAILABLE = np is not None
+NAME = 'numpy'
+
+class Unsupported(ValueError):
+    """Cannot be done with this engine. Use the pure-Python one"""
+    pass
+
+# Classifications
+_NEW,_UNTOUCHED,_NEWMOD,_MOVED = 0,1,2,3
+
+def _codes(files,attrib,factor,required=False):
+    """
+    Integer code the attrib values of files with the factor dict (shared
+    between lists). Missing values are -1 or raise Unsupported if required
+    """
+    codes = np.empty(len(files),dtype=np.int64)
+    for ix,file in enumerate(files):
+        try:
+            val = file[attrib]
+        except KeyError:
+            if required:
+                raise Unsupported('Missing {}'.format(attrib))
+            codes[ix] = -1
+            continue
+        try:
+            codes[ix] = factor.setdefault(val,len(factor))
+        except TypeError: # unhashable
+            raise Unsupported('Unhashable {}'.format(attrib))
+    return codes
+
+def _keys(files,attributes,factors,required=False):
+    """
+    Structured array of the integer codes for attributes and a mask of rows
+    where all are present.
+    """
+    dtype = [(str('f{}'.format(ii)),np.int64) for ii in range(len(attributes))]
+    keys = np.empty(len(files),dtype=dtype)
+    valid = np.ones(len(files),dtype=bool)
+    for ii,attrib in enumerate(attributes):
+        factor = factors.setdefault(attrib,{})
+        codes = _codes(files,attrib,factor,required=required)
+        keys[str('f{}'.format(ii))] = codes
+        valid &= codes >= 0
+    return keys,valid
+
+def _join(old_keys,old_valid,new_keys):
+    """
+    For each new key, find the number of matching (valid) old keys and the
+    index of the first one
+    """
+    oix = np.nonzero(old_valid)[0]
+    count = np.zeros(len(new_keys),dtype=np.int64)
+    first = np.zeros(len(new_keys),dtype=np.int64)
+    if len(oix) == 0 or len(new_keys) == 0:
+        return count,first
+
+    okeys = old_keys[oix]
+    order = np.argsort(okeys,kind='mergesort')
+    okeys = okeys[order]
+
+    left = np.searchsorted(okeys,new_keys,side='left')
+    right = np.searchsorted(okeys,new_keys,side='right')
+    count = right - left
+    first = oix[order[np.minimum(left,len(okeys)-1)]]
+    return count,first
+
+def file_track(files_old,files_new,prev_attributes,move_attributes):
+    """
+    Vectorized version of the main file_track loop. The tracking attributes
+    must already be set to their defaults (and indexed) as in main.file_track.
+
+    Sets the flags on the items of files_new and files_old. Raises
+    Unsupported *before* changing anything if it cannot be done.
+    """
+    if np is None:
+        raise Unsupported('numpy is not available')
+
+    old = list(files_old)
+    new = list(files_new)
+
+    factors = {}
+    checks = [list(prev_attributes) + ['mtime'],
+              list(prev_attributes),
+              list(move_attributes)]
+
+    # The new files must have every attribute (the python engine would
+    # raise a KeyError). The old files just won't match if missing
+    matches = []
+    for attributes in checks:
+        new_keys,_ = _keys(new,attributes,factors,required=True)
+        old_keys,old_valid = _keys(old,attributes,factors)
+        matches.append(_join(old_keys,old_valid,new_keys))
+
+    (count1,first1),(count2,first2),(count3,first3) = matches
+
+    cls = np.full(len(new),_NEW,dtype=np.int8)
+    m3 = count3 > 0
+    cls[m3] = _MOVED
+    m2 = count2 > 0
+    cls[m2] = _NEWMOD
+    m1 = count1 > 0
+    cls[m1] = _UNTOUCHED
+
+    first = np.where(m1,first1,np.where(m2,first2,first3))
+
+    def _old_file(ix):
+        # If ambiguous, this is the first in the old list as the python engine
+        return old[first[ix]]
+
+    for ix,(file,c) in enumerate(zip(new,cls.tolist())):
+        if c == _UNTOUCHED:
+            file['prev_path'] = file['path']
+            file['untouched'] = True
+            _old_file(ix)['deleted'] = False
+        elif c == _NEWMOD:
+            file['prev_path'] = file['path']
+            file['newmod'] = True
+            _old_file(ix)['deleted'] = False
+        elif c == _MOVED:
+            file_old = _old_file(ix)
+            file['prev_path'] = file_old['path']
+            file['moved'] = True
+            file_old['deleted'] = False
+            if not file_old['mtime'] == file['mtime']:
+                file['newmod'] = True
+        else:
+            file['newmod'] = True
+            file['new'] = True
+
+def transfer_candidates(filesA,filesB,mod_attributes,mod_resolution):
+    """
+    Return the set of paths that determine_file_transfers must look at.
+    These are paths missing on either side and those where none of the
+    mod_attributes agree (or cannot be compared here).
+
+    Every other path is on both sides and agrees so it would not be
+    transferred.
+    """
+    if np is None:
+        raise Unsupported('numpy is not available')
+
+    A = list(filesA)
+    B = list(filesB)
+
+    factors = {}
+    pathA = _codes(A,'path',factors.setdefault('path',{}),required=True)
+    pathB = _codes(B,'path',factors['path'],required=True)
+    npaths = len(factors['path'])
+
+    if len(np.unique(pathA)) != len(A) or len(np.unique(pathB)) != len(B):
+        raise Unsupported('Duplicate paths')
+
+    # Row in A for each path code (-1 if not on A)
+    rowA = np.full(npaths,-1,dtype=np.int64)
+    rowA[pathA] = np.arange(len(A))
+    ixA = rowA[pathB]             # For each B row, the A row
+    both = ixA >= 0
+    ixA = ixA[both]
+    ixB = np.nonzero(both)[0]
+
+    # Rows that agree on *any* mod_attribute are skipped. Rows where
+    # something is missing are left for python
+    agree = np.zeros(len(ixB),dtype=bool)
+    missing = np.zeros(len(ixB),dtype=bool)
+
+    mtimeA = _floats(A,'mtime')
+    mtimeB = _floats(B,'mtime')
+    missing |= np.isnan(mtimeA[ixA]) | np.isnan(mtimeB[ixB]) # needed to log
+
+    for mod_attribute in mod_attributes:
+        attribA,attribB = tuple(mod_attribute)
+        if (attribA,attribB) == ('mtime','mtime'):
+            with np.errstate(invalid='ignore'):
+                agree |= np.abs(mtimeA[ixA] - mtimeB[ixB]) <= mod_resolution
+            continue
+        factor = factors.setdefault(('mod',attribA,attribB),{})
+        codesA = _codes(A,attribA,factor)[ixA]
+        codesB = _codes(B,attribB,factor)[ixB]
+        miss = (codesA < 0) | (codesB < 0)
+        missing |= miss & ~agree # Only matters if not already agreed
+        agree |= (codesA == codesB) & ~miss
+
+    skip = agree & ~missing
+
+    skipB = np.zeros(len(B),dtype=bool)
+    skipB[ixB[skip]] = True
+
+    candidates = set(file['path'] for file,s in zip(B,skipB.tolist()) if not s)
+    onB = set(file['path'] for file in B) # Everything else on A is a candidate
+    candidates.update(file['path'] for file in A if file['path'] not in onB)
+    return candidates
+
+def _floats(files,attrib):
+    """Float array of attrib with NaN for missing (or non-numeric)"""
+    vals = np.empty(len(files),dtype=np.float64)
+    for ix,file in enumerate(files):
+        try:
+            vals[ix] = file[attrib]
+        except (KeyError,TypeError,ValueError):
+            vals[ix] = np.nan
+    return vals
+
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Multi-process (sharded) reconciliation engine.
+
+Same interface as npengine. The expensive, per-file parts of file_track and
+transfer_candidates are done as a hash-partitioned join in a process pool:
+
+1. "Map": each worker takes a slice of the (forked, not copied) file lists
+   and computes the join keys. The keys are partitioned by hash so that
+   equal keys always end up in the same shard. For file_track, there is a
+   key for each of the untouched, newmod, and moved checks so a file and
+   the old file it was moved from are always in the same shard of the move
+   check even if their paths are in different ones.
+2. "Reduce": each shard is joined independently.
+3. The parent then applies the results in file order. The precedence of
+   the checks, and anything ambiguous (more than one matching old file),
+   is resolved exactly as the serial engine so the results are the same and
+   do not depend on the number of processes.
+
+compare_queue_moves and determine_file_transfers then only work on the
+changes (see main.transfer_candidates) so they are left serial. That is also
+where moves across shards (e.g. a moved file and the other side's copy) come
+together.
+
+The workers must be forked so this is only available where that is
+possible. Otherwise (or if the values can't be hashed) Unsupported is raised
+and the caller falls back to the serial engine.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import multiprocessing
+
+from .npengine import Unsupported
+
+try:
+    _context = multiprocessing.get_context('fork')
+except AttributeError: # python2 always forks on posix
+    _context = multiprocessing
+except ValueError: # No fork (e.g. Windows)
+    _context = None
+
+AVAILABLE = _context is not None
+NAME = 'parallel'
+
+# Set before forking the pool so that the workers can read the lists without
+# them being pickled
+_SHARED = {}
+
+_MISSING = '__PyFiSync_missing__'
+
+def _processes(processes):
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    return max(1,processes)
+
+def _map(args):
+    """
+    Compute the keys of _SHARED[name][start:stop] and partition them into
+    nshards. Returns a list (per shard) of (hash,seq) lists per keyfunc. 
+    Only the hash is sent back (cheaper). The key itself is checked in _match
+    """
+    name,start,stop,nshards = args
+    items,keyfuncs = _SHARED[name]
+    out = [[[] for _ in range(nshards)] for _ in keyfuncs]
+    for seq in range(start,stop):
+        item = items[seq]
+        for ii,keyfunc in enumerate(keyfuncs):
+            key = keyfunc(item)
+            if key is _MISSING:
+                continue
+            h = hash(key)
+            out[ii][h % nshards].append((h,seq))
+    return out
+
+def _shuffle(pool,name,nshards,nslices):
+    """
+    Run _map on the _SHARED[name] items in slices and return the partitioned
+    keys as out[keyfunc_ix][shard] = [(hash,seq),...] in order of seq.
+    """
+    items,keyfuncs = _SHARED[name]
+    N = len(items)
+    bounds = [N*ii//nslices for ii in range(nslices+1)]
+    tasks = [(name,bounds[ii],bounds[ii+1],nshards) for ii in range(nslices)]
+
+    out = [[[] for _ in range(nshards)] for _ in keyfuncs]
+    for res in pool.map(_map,tasks): # In slice order so seq stays sorted
+        for ii in range(len(keyfuncs)):
+            for shard in range(nshards):
+                out[ii][shard].extend(res[ii][shard])
+    return out
+
+def _match(args):
+    """
+    For each new (hash,seq) of check ii, find the number of matching old 
+    files and the seq of the first one. Only returns matches
+    """
+    ii,new,old = args
+    new_items,new_keyfuncs = _SHARED['new']
+    old_items,old_keyfuncs = _SHARED['old']
+
+    by_hash = {}
+    for h,seq in old: # in order of seq
+        by_hash.setdefault(h,[]).append(seq)
+
+    out = []
+    for h,seq in new:
+        if h not in by_hash:
+            continue
+        key = new_keyfuncs[ii](new_items[seq])
+        count = first = 0
+        for old_seq in by_hash[h]:
+            if old_keyfuncs[ii](old_items[old_seq]) == key:
+                if not count:
+                    first = old_seq
+                count += 1
+        if count:
+            out.append((seq,count,first))
+    return out
+
+def _pool(processes):
+    if not AVAILABLE:
+        raise Unsupported('Cannot fork worker processes')
+    return _context.Pool(processes)
+
+def _attribute_key(attributes,required):
+    attributes = list(attributes)
+    def key(item):
+        try:
+            return tuple(item[a] for a in attributes)
+        except KeyError:
+            if required:
+                raise # As the serial engine would
+            return _MISSING
+    return key
+
+def file_track(files_old,files_new,prev_attributes,move_attributes,processes=None):
+    """
+    Parallel version of the main file_track loop. The tracking attributes
+    must already be set to their defaults (and indexed) as in main.file_track.
+
+    Sets the flags on the items of files_new and files_old. Raises
+    Unsupported *before* changing anything if it cannot be done.
+    """
+    old = list(files_old)
+    new = list(files_new)
+
+    checks = [list(prev_attributes) + ['mtime'],
+              list(prev_attributes),
+              list(move_attributes)]
+
+    processes = _processes(processes)
+    nshards = nslices = 4*processes
+
+    # Must be set before the pool is forked
+    _SHARED['new'] = (new,[_attribute_key(c,True) for c in checks])
+    _SHARED['old'] = (old,[_attribute_key(c,False) for c in checks])
+    
+    pool = _pool(processes)
+    try:
+        new_keys = _shuffle(pool,'new',nshards,nslices)
+        old_keys = _shuffle(pool,'old',nshards,nslices)
+
+        tasks = [(ii,new_keys[ii][shard],old_keys[ii][shard])
+                 for ii in range(len(checks)) for shard in range(nshards)]
+        results = pool.map(_match,tasks)
+    except TypeError as E: # unhashable
+        raise Unsupported(str(E))
+    finally:
+        pool.close()
+        pool.join()
+        _SHARED.clear()
+
+    matches = [{} for _ in checks]
+    for (ii,_,_),res in zip(tasks,results):
+        for seq,count,first in res:
+            matches[ii][seq] = (count,first)
+
+    def _old_file(seq,ii):
+        # If ambiguous, this is the first in the old list as the serial engine
+        return old[matches[ii][seq][1]]
+
+    untouched,newmod,moved = matches
+    for seq,file in enumerate(new):
+        if seq in untouched:
+            file['prev_path'] = file['path']
+            file['untouched'] = True
+            _old_file(seq,0)['deleted'] = False
+        elif seq in newmod:
+            file['prev_path'] = file['path']
+            file['newmod'] = True
+            _old_file(seq,1)['deleted'] = False
+        elif seq in moved:
+            file_old = _old_file(seq,2)
+            file['prev_path'] = file_old['path']
+            file['moved'] = True
+            file_old['deleted'] = False
+            if not file_old['mtime'] == file['mtime']:
+                file['newmod'] = True
+        else:
+            file['newmod'] = True
+            file['new'] = True
+
+def _candidates(args):
+    """
+    Join A and B by path for one shard and return the candidate paths.
+    Returns None if there are duplicate paths
+    """
+    A,B,mod_attributes,mod_resolution = args
+    B = dict(B)
+    if len(B) != len(args[1]):
+        return None
+    seen = set()
+    paths = []
+    for path,valsA in A:
+        if path in seen:
+            return None
+        seen.add(path)
+        valsB = B.pop(path,None)
+        if valsB is None or not _agree(valsA,valsB,mod_attributes,mod_resolution):
+            paths.append(path)
+    paths.extend(B) # Only on B
+    return paths
+
+def _agree(valsA,valsB,mod_attributes,mod_resolution):
+    """ Whether both are untouched and agree on a mod_attribute """
+    if not (valsA[0] is True and valsB[0] is True):
+        return False
+    if _MISSING in (valsA[1],valsB[1]): # mtime is needed
+        return False
+    for ii,(attribA,attribB) in enumerate(mod_attributes):
+        valA,valB = valsA[2+ii],valsB[2+ii]
+        if _MISSING in (valA,valB):
+            return False
+        if (attribA,attribB) == ('mtime','mtime'):
+            if abs(valA - valB) <= mod_resolution:
+                return True
+        elif valA == valB:
+            return True
+    return False
+
+def _path_values(attributes):
+    """ (path,(untouched,mtime,mod values...)) for transfer_candidates"""
+    attributes = list(attributes)
+    def key(item):
+        return (item['path'],tuple(item.get(a,_MISSING) for a in attributes))
+    return key
+
+def _map_paths(args):
+    """ Like _map but partition (path,values) on path """
+    name,start,stop,nshards = args
+    items,keyfunc = _SHARED[name]
+    out = [[] for _ in range(nshards)]
+    for seq in range(start,stop):
+        path,values = keyfunc(items[seq])
+        out[hash(path) % nshards].append((path,values))
+    return out
+
+def transfer_candidates(filesA,filesB,mod_attributes,mod_resolution,processes=None):
+    """
+    Return the set of paths that determine_file_transfers must look at. See
+    main.transfer_candidates.
+    """
+    mod_attributes = [tuple(m) for m in mod_attributes]
+    if not all('untouched' in files.attributes for files in (filesA,filesB)):
+        raise Unsupported('Files are not tracked')
+
+    processes = _processes(processes)
+    nshards = nslices = 4*processes
+
+    # Must be set before the pool is forked
+    for name,files,ix in [('A',filesA,0),('B',filesB,1)]:
+        keyfunc = _path_values(['untouched','mtime'] + [m[ix] for m in mod_attributes])
+        _SHARED[name] = (list(files),keyfunc)
+
+    shards = []
+    pool = _pool(processes)
+    try:
+        for name in 'AB':
+            items,_ = _SHARED[name]
+            N = len(items)
+            bounds = [N*ii//nslices for ii in range(nslices+1)]
+            tasks = [(name,bounds[ii],bounds[ii+1],nshards) for ii in range(nslices)]
+
+            out = [[] for _ in range(nshards)]
+            for res in pool.map(_map_paths,tasks):
+                for shard in range(nshards):
+                    out[shard].extend(res[shard])
+            shards.append(out)
+
+        tasks = [(shards[0][shard],shards[1][shard],mod_attributes,mod_resolution)
+                 for shard in range(nshards)]
+        results = pool.map(_candidates,tasks)
+    except TypeError as E:
+        raise Unsupported(str(E))
+    finally:
+        pool.close()
+        pool.join()
+        _SHARED.clear()
+
+    paths = set()
+    for res in results:
+        if res is None:
+            raise Unsupported('Duplicate paths')
+        paths.update(res)
+    return paths
+
+class Engine(object):
+    """
+    The engine with a set number of processes (None for all CPUs)
+    """
+    NAME = NAME
+    def __init__(self,processes=None):
+        self.processes = processes
+
+    def file_track(self,*args,**kwargs):
+        kwargs.setdefault('processes',self.processes)
+        return file_track(*args,**kwargs)
+
+    def transfer_candidates(self,*args,**kwargs):
+        kwargs.setdefault('processes',self.processes)
+        return transfer_candidates(*args,**kwargs)
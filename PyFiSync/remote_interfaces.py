@@ -23,6 +23,14 @@ import zlib
 import shlex
 import tempfile
 import datetime
+import time
+import copy
+import stat
+import hashlib
+import contextlib
+import heapq
+import threading
+from multiprocessing.pool import ThreadPool
 
 from io import open
 
@@ -31,8 +39,42 @@ if sys.version_info[0] > 2:
     unicode = str
 
 from . import utils
-
-REMOTES = ['rsync','rclone']
+from . import filerecord
+from . import agent as _agent
+from . import listcodec
+from . import findlist
+from . import tarstream
+from . import localcopy
+from . import PFSwalk
+
+REMOTES = utils.REMOTES
+
+# rsync flags for each of the rsync_profile settings. (They are all followed
+# by the flags for links and the file list)
+SKIP_COMPRESS = ('7z/aac/avi/bz2/deb/flac/gif/gz/heic/jpeg/jpg/lz4/lzma/m4a/m4v/'
+                 'mkv/mov/mp3/mp4/ogg/png/rar/rpm/tbz/tgz/txz/webm/webp/xz/zip/zst')
+RSYNC_PROFILES = {
+    'default':'-azvi -hh',
+    'local':'-avi -hh --whole-file', # Deltas only help over a network
+    'lan':'-avi -hh',
+    'wan':'-azvi -hh --skip-compress=' + SKIP_COMPRESS,
+}
+# Fast (with hardware AES or on ARM) ciphers for 'lan'. Any are fine
+LAN_CIPHERS = '-o Ciphers=aes128-gcm@openssh.com,chacha20-poly1305@openssh.com,aes128-ctr'
+
+# 'auto' uses 'lan' at or below this round trip time and above the bandwidth
+LAN_MAX_RTT = 0.01 # s. Within a session (without the handshake)
+LAN_MIN_BANDWIDTH = 20*1024**2 # bytes/s
+PROBE_BYTES = 2*1024**2
+
+# Run on B by _probe. Echo each ping and then read the data
+_PROBE_SCRIPT = ('while read -r line && [ "$line" = ping ]; do echo pong; done; '
+                 'cat > /dev/null; echo done')
+
+try:
+    _DEVNULL = subprocess.DEVNULL
+except AttributeError: # python2
+    _DEVNULL = open(os.devnull,'wb')
 
 class remote_interface_base(object):
     def __init__(self,config,log=None):
@@ -68,10 +110,14 @@ class remote_interface_base(object):
         """
         raise NotImplementedError()
     
-    def transfer(self,tqA2B,tqB2A):
+    def transfer(self,tqA2B,tqB2A,filesA=None,filesB=None):
         """
         * Apply the trasnfer from B to A and from A to B
         * MUST maintain modification times upon transfer
+        * filesA and filesB (DictTables) are optional and may be used for the
+          file sizes
+        * May return the records (path,size,mtime,ino) of the transferred
+          files as (A2B,B2A) if known. Otherwise None
         """
         raise NotImplementedError()
 
@@ -95,6 +141,10 @@ class remote_interface_base(object):
         """
         pass
 
+class _StaleListing(Exception):
+    """ The remote sent the changes since a listing other than filesB.old """
+    pass
+
 class ssh_rsync(remote_interface_base):
     def __init__(self,config,log=None):
         self.config = config
@@ -103,17 +153,132 @@ class ssh_rsync(remote_interface_base):
         self.log = log
         self._debug = getattr(config,'_debug',False)
         
-        if config.persistant:
+        self.persistant_proc = None
+        self._ciphers = ''
+        if getattr(config,'rsync_profile','default') == 'lan': # The master sets it
+            self._ciphers = LAN_CIPHERS
+        control_persist = getattr(config,'ssh_control_persist',0)
+        if config.persistant and control_persist:
+            # Shared master that outlives this run
+            self.sm = self._shared_master(control_persist)
+        elif config.persistant:
             # Set up master connection for 600 seconds 
             self.sm = '-S /tmp/' + _randstr(5)
-            cmd = 'ssh -N -M {sm:s} -p {ssh_port:d} -q {userhost:s}'.\
-                   format(sm=self.sm,**config.__dict__)            
+            cmd = 'ssh -N -M {sm:s} {c} -p {ssh_port:d} -q {userhost:s}'.\
+                   format(sm=self.sm,c=self._ciphers,**config.__dict__)            
             
             self.persistant_proc = subprocess.Popen(shlex.split(cmd))
             
         else:
             self.sm = '' # Do nothings
         
+        self._agent_client = None # Started on first use. False if not available
+        self._legacy_apply = False # Remote does not know --backup-method
+        self._rsync_profile = None # Decided on first use
+        self._profile_lock = threading.Lock()
+        self.generation = None # Of the last remote file list
+        self.old_list = None # filesB.old if it was read for the file list
+    
+    def _shared_master(self,control_persist):
+        """
+        Reuse (or start) the master connection for this user@host:port on
+        a stable socket. It stays up for control_persist seconds after the
+        last use so later runs can skip the SSH handshake. Returns the ssh
+        flags to use it ('' to not multiplex if it can't be done safely)
+        """
+        config,log = self.config,self.log
+        socket_path = _control_path(config)
+        if socket_path is None:
+            log.add('Cannot use a shared SSH master. Not multiplexing')
+            return ''
+        sm = '-S ' + socket_path
+        base = shlex.split('ssh {sm:s} -p {ssh_port:d} -q'.format(sm=sm,**config.__dict__))
+        
+        with _control_lock(socket_path):
+            check = base + ['-O','check',config.userhost]
+            if subprocess.call(check,stdout=_DEVNULL,stderr=_DEVNULL) == 0:
+                log.add('Reusing SSH master connection')
+                return sm
+            
+            if not _remove_stale_socket(socket_path):
+                log.add('{} is in the way. Not multiplexing'.format(socket_path))
+                return ''
+            
+            # -f: background once connected (so it is ready to use)
+            start = base + ['-M','-N','-f','-o','ControlPersist={:d}'.format(int(control_persist))] \
+                         + shlex.split(self._ciphers) + [config.userhost]
+            if subprocess.call(start,stdout=_DEVNULL) != 0:
+                log.add('Could not start SSH master connection. Not multiplexing')
+                return ''
+        log.add('Started SSH master connection (persists {:d} s)'.format(int(control_persist)))
+        return sm
+    
+    def _remote_call(self,mode):
+        """
+        The remote command (as a string to be passed to ssh) for `_api mode`
+        """
+        config = self.config
+        if hasattr(config,'PyFiSync_path') and hasattr(config,'remote_program'):
+            self.log.add("DEPRECATION WARNING: 'PyFiSync_path' and 'remote_program' are deprecated. Use 'remote_exe'")
+            if len(config.PyFiSync_path) == 0:
+                return 'PyFiSync _api ' + mode
+            if any(config.PyFiSync_path.endswith('PyFiSync'+ext) for ext in ['','.py']):
+                return config.remote_program + ' ' + config.PyFiSync_path + ' _api ' + mode
+            return config.remote_program + ' ' + os.path.join(config.PyFiSync_path,'PyFiSync.py _api ' + mode)
+        return '{} _api {}'.format(config.remote_exe,mode)
+    
+    def _ssh_cmd(self,remote):
+        """
+        The command (as a list) to run `remote` on B
+        """
+        cmd = 'ssh {sm} -p {ssh_port:d} -q {userhost:s}'.format(sm=self.sm,**self.config.__dict__)
+        return shlex.split(cmd) + [remote]
+    
+    def agent(self):
+        """
+        Return the remote agent (see agent.py), starting it if needed, or None
+        to use the per-call mode
+        """
+        if self._agent_client is None:
+            self._agent_client = False
+            if not getattr(self.config,'remote_agent',True):
+                return None
+            try:
+                self._agent_client = _agent.Client(self._ssh_cmd(self._remote_call('serve')))
+            except (_agent.AgentError,OSError) as E:
+                self.log.add('Remote agent not available ({}). Using per-call mode'.format(E))
+                return None
+            self.log.add('Started remote agent (protocol version {})'.format(self._agent_client.version))
+        return self._agent_client or None
+    
+    def _disable_agent(self):
+        """ Stop the agent (e.g. after it failed) and use the per-call mode """
+        if self._agent_client:
+            self._agent_client.close(kill=True)
+        self._agent_client = False
+    
+    def _agent_request(self,cmd,**kwargs):
+        """
+        Make the request with the agent and return the response or None to 
+        use the per-call mode.
+        """
+        agent = self.agent()
+        if agent is None or cmd not in agent.commands:
+            return None
+        try:
+            resp = agent.request(cmd,**kwargs)
+        except _agent.AgentError as E:
+            resp = E
+        err = agent.stderr()
+        if len(err) > 0:
+            self.log.add('Remote Call returned warnings:')
+            self.log.space = 4
+            self.log.add(err)
+            self.log.space = 0
+        if isinstance(resp,Exception):
+            raise resp
+        return resp
+        
     def file_list(self,attributes,empty=None):
         """
         Get the file list in B (remote)
@@ -121,24 +286,12 @@ class ssh_rsync(remote_interface_base):
         attributes = list(set(attributes))
         config = self.config
         log = self.log
-
-        # Construct the command
-        cmd = 'ssh {sm} -p {ssh_port:d} -q {userhost:s} "'.format(sm=self.sm,**config.__dict__)
-
-        if hasattr(config,'PyFiSync_path') and hasattr(config,'remote_program'):
-            log.add("DEPRECATION WARNING: 'PyFiSync_path' and 'remote_program' are deprecated. Use 'remote_exe'")
-            # construct the call cmd
-            if len(config.PyFiSync_path) == 0:
-                cmd += 'PyFiSync _api file_list"'
-            else:
-                cmd += config.remote_program + ' '
-                if any(config.PyFiSync_path.endswith('PyFiSync'+ext) for ext in ['','.py']):
-                    cmd += config.PyFiSync_path + ' _api file_list"'
-                else:
-                    cmd += os.path.join(config.PyFiSync_path,'PyFiSync.py _api file_list"')
-        else:
-            cmd += '{} _api file_list"'.format(config.remote_exe)
         
+        if getattr(config,'remote_lister','python') == 'find':
+            if not any(a in utils.HASHFUNS for a in attributes):
+                return self._find_file_list(empty)
+            log.add("The 'find' remote_lister cannot compute hashes. Using PyFiSync")
+
         remote_config = dict()
         
         remote_config['path'] = config.pathB
@@ -148,43 +301,249 @@ class ssh_rsync(remote_interface_base):
         remote_config['copy_symlinks_as_links'] = config.copy_symlinks_as_links
         remote_config['use_hash_db'] = config.use_hash_db
         
+        # Ask for the streamed format (see listcodec). Remotes that do not
+        # know it will ignore this and send the full json
+        remote_config['format'] = 'stream'
+        remote_config['compression'] = getattr(config,'remote_list_compression',
+                                               listcodec.DEFAULT_LEVEL)
+        
+        object_hook = filerecord.object_hook if getattr(config,'compact_file_records',False) else None
+        
+        # Only ask for the changes since filesB.old if it is the listing of a 
+        # known generation (see agent.stream_file_list)
+        remote_config['since'] = self._load_generation()
+        self.generation = None
+        self.old_list = None
+        try:
+            return self._remote_file_list(remote_config,object_hook)
+        except _StaleListing as E:
+            # e.g. filesB.old is from before the last time the list was made
+            log.add('{}. Getting the full list'.format(E))
+            remote_config['since'] = None
+            return self._remote_file_list(remote_config,object_hook)
+    
+    def _remote_file_list(self,remote_config,object_hook):
+        """ Get the file list of remote_config (from file_list) """
+        log = self.log
+        
+        def reader(stream,check_magic=True):
+            return self._read_file_list(stream,object_hook,remote_config['since'],
+                                        check_magic=check_magic)
+        
+        try:
+            resp = self._agent_request('file_list_stream',config=remote_config)
+            if resp is not None:
+                files = self._agent_client.read_stream(reader)
+            else:
+                resp = self._agent_request('file_list',config=remote_config,
+                                           object_hook=object_hook)
+                files = resp and resp['files']
+        except _agent.AgentError as E:
+            log.add('Remote agent file list failed ({}). Using per-call mode'.format(E))
+            self._disable_agent()
+            resp = None
+        if resp is not None:
+            log.add('Received remote file list from agent')
+            return files
+        
         log.add('Calling for remote file list')
         
         # Encode the config. Just in case there is any additional cruft, add
         # a starting sentinel
         sentinel = _randstr(N=10).encode('ascii')
-        cmd = shlex.split(cmd)
-        cmd[-1] += ' ' + sentinel.decode('ascii') # Add the sentinel to the final command
+        cmd = self._ssh_cmd(self._remote_call('file_list') + ' ' + sentinel.decode('ascii'))
         
         json_config = sentinel+json.dumps(remote_config,ensure_ascii=False).encode('utf8')
         
-        # Use a tempfile to prevent a buffering issue
-        outfile =  tempfile.NamedTemporaryFile(mode='wb',delete=False)
-        
         proc = subprocess.Popen(cmd,stdin=subprocess.PIPE, 
-                                    stdout=outfile,
+                                    stdout=subprocess.PIPE,
                                     stderr=subprocess.PIPE, 
-                                    shell=False)        
-        _,err = proc.communicate(json_config)
+                                    shell=False)
+        
+        # Read stderr in the background so neither pipe can fill up and block
+        err_thread = utils.ReturnThread(target=proc.stderr.read)
+        err_thread.daemon = True
+        err_thread.start()
+        
+        try:
+            proc.stdin.write(json_config)
+            proc.stdin.close()
+        except (IOError,OSError):
+            pass # Will be caught below
+
+        # Skip anything before the sentinel and then decode the list as it 
+        # is read
+        files = stale = None
+        with proc.stdout as stdout:
+            head = b''
+            while not head.endswith(sentinel):
+                c = stdout.read(1)
+                if not c:
+                    break
+                head += c
+            try:
+                magic = stdout.read(len(listcodec.MAGIC))
+                if magic == listcodec.MAGIC:
+                    files = reader(stdout,check_magic=False)
+                else: # Older remote 
+                    out = zlib.decompress(magic + stdout.read())
+                    files = json.loads(out,object_hook=object_hook)
+            except _StaleListing as E:
+                stale = E
+            except Exception as E:
+                log.add('Could not read remote file list: {}'.format(E))
+        proc.wait()
         
+        err = err_thread.join()
         if len(err)>0:
             err = utils.to_unicode(err)
             log.add('Remote Call returned warnings:')
             log.space = 4
             log.add(err)
             log.space = 0
+        
+        if stale is not None:
+            raise stale
+        return files
 
-        # Read back the output, find the sentinel, decompress and return the output
-        with open(outfile.name,'rb') as F:
-            out = F.read()
-        out = out[out.find(sentinel) + len(sentinel):]
-
+    def _find_file_list(self,empty):
+        """
+        Get the file list in B (remote) with GNU find. See findlist.py
+        """
+        config = self.config
+        log = self.log
+        log.add('Calling for remote file list (find)')
+        self.generation = None
+        self.old_list = None
+        
+        follow = not config.copy_symlinks_as_links
+        dir_preds,file_preds,others = findlist.split_excludes(set(config.excludes))
+        compact = getattr(config,'compact_file_records',False)
+        
+        files,dirs = [],[]
+        starts = ['.']
+        for _ in range(findlist.MAX_ROUNDS):
+            links = []
+            for ii in range(0,len(starts),500): # Do not make the command too long
+                cmd = findlist.command(config.pathB,starts[ii:ii+500],dir_preds,file_preds,follow)
+                proc = subprocess.Popen(self._ssh_cmd(cmd),stdout=subprocess.PIPE,
+                                                           stderr=subprocess.PIPE,
+                                                           shell=False)
+                err_thread = utils.ReturnThread(target=proc.stderr.read)
+                err_thread.daemon = True
+                err_thread.start()
+                
+                count = 0
+                with proc.stdout as stdout:
+                    for kind,path,info in findlist.parse(stdout):
+                        count += 1
+                        if kind == 'f':
+                            info['path'] = path
+                            info['birthtime'] = 0.0 # As python on Linux
+                            if info['mtime'] == 0: # As PFSwalk
+                                info['mtime'] = time.time() + 3600
+                            files.append(filerecord.FileRecord(info) if compact else info)
+                        elif kind == 'd':
+                            dirs.append(path)
+                        elif kind == 'l':
+                            links.append('./' + path)
+                        else:
+                            log.add('ERROR: Could not find information on {}\n'.format(path) +
+                                    '       May be a BROKEN link. Skipping')
+                proc.wait()
+                err = err_thread.join()
+                if len(err)>0:
+                    log.add('Remote Call returned warnings:')
+                    log.space = 4
+                    log.add(utils.to_unicode(err))
+                    log.space = 0
+                if count == 0: # There is always at least the starting point
+                    log.add('Remote find failed. It must be GNU find')
+                    return
+            starts = links
+            if not starts:
+                break
+        else:
+            log.add('Too many levels of symlinked directories. Not following {}'.format(
+                    ', '.join(starts)))
+        
+        if others:
+            _config = copy.copy(config)
+            _config.excludes = others
+            files = PFSwalk.file_list(config.pathB,_config,log).filter_old_list(files)
+
+        # Empty directories are tracked locally since the remote may not have
+        # PyFiSync. Otherwise this is the same as PFSwalk.process_empty
+        empties = findlist.empty_dirs(dirs,(file['path'] for file in files))
+        empty_path = os.path.join(config.pathA,'.PyFiSync','empty_dirsB')
+        if empty == 'reset':
+            try:
+                os.remove(empty_path)
+            except OSError:
+                pass
+        elif empty == 'store':
+            with open(empty_path,'wt',encoding='utf8') as fobj:
+                fobj.write(utils.to_unicode(json.dumps(sorted(empties),ensure_ascii=False)))
+        elif empty == 'remove' and os.path.exists(empty_path):
+            with open(empty_path,'rt',encoding='utf8') as fobj:
+                prev = set(json.loads(fobj.read()))
+            empties = sorted(empties - prev,key=lambda a: (-len(a),a.lower()))
+            if empties:
+                cmd = 'cd {} && rmdir -p -- {} 2>/dev/null; true'.format(
+                      findlist.quote(config.pathB),' '.join(findlist.quote(e) for e in empties))
+                subprocess.call(self._ssh_cmd(cmd))
+        return files
+    
+    def _load_generation(self):
+        """
+        Return the generation of filesB.old if it was recorded (see 
+        main.reset_tracking) and filesB.old is unchanged since. Otherwise None.
+        filesB.old itself is only read if the changes are sent
+        """
+        dirpath = os.path.join(self.config.pathA,'.PyFiSync')
         try:
-            out = zlib.decompress(out)    
-        except:
-            return
+            with open(os.path.join(dirpath,'filesB.gen'),'rt') as F:
+                gen = json.loads(F.read())
+            st = os.stat(os.path.join(dirpath,'filesB.old'))
+        except (IOError,OSError,ValueError):
+            return None
+        if [gen.get('size'),gen.get('mtime')] != [st.st_size,st.st_mtime]:
+            return None
+        return gen['generation']
+        
+    def _read_file_list(self,stream,object_hook,since,check_magic=True):
+        """
+        Read the file list (see agent.stream_file_list) and, if it is only the
+        changes, apply them to filesB.old (of generation since). filesB.old
+        is kept as self.old_list so it need not be read again
+        """
+        info = {}
+        files = list(listcodec.decode(stream,object_hook=object_hook,
+                                      check_magic=check_magic,info=info))
+        self.generation = info.get('generation')
+        if info.get('base') is None:
+            return files
         
-        return json.loads(out)
+        removed = [file['path'] for file in listcodec.decode(stream)]
+        if since is None or info['base'] != since:
+            raise _StaleListing('Changes are against an unknown listing')
+        
+        self.log.add('Received {} changed and {} removed files since the last listing'.format(
+                     len(files),len(removed)))
+        changed = files
+        try:
+            with open(os.path.join(self.config.pathA,'.PyFiSync','filesB.old'),
+                      'rt',encoding='utf8') as F:
+                self.old_list = json.loads(F.read(),object_hook=object_hook)
+        except (IOError,OSError,ValueError) as E:
+            raise _StaleListing('Could not read filesB.old for the changes ({})'.format(E))
+        # Copies since the new and old lists are changed separately
+        files = dict((file['path'],file.copy()) for file in self.old_list)
+        for path in removed:
+            files.pop(path,None)
+        for file in changed:
+            files[file['path']] = file
+        return list(files.values())
 
     def apply_queue(self,queue,force=False):
         """
@@ -197,52 +556,73 @@ class ssh_rsync(remote_interface_base):
             log.add('  >> No remote actions <<')
             return
 
+        log.space=0
+        log.add('\nApplying queue on remote')
+        
+        resp = self._agent_request('apply_queue',path=config.pathB,queue=queue,
+                                   backup=config.backup,force=force,
+                                   backup_method=getattr(config,'backup_method','copy'))
+        if resp is not None:
+            log.prepend = '>  '
+            for line in resp['log']:
+                log.add(line)
+            log.prepend = ''
+            return
+        
+        # Only remotes since --backup-method was added know it. Do not send
+        # it for the default ('copy') and retry without it if not recognized
+        backup_method = getattr(config,'backup_method','copy')
+        if not config.backup or backup_method == 'copy' or self._legacy_apply:
+            backup_method = None
+        
+        returncode,head = self._apply_queue_call(queue,force,backup_method)
+        if returncode == 2 and backup_method and any('backup-method' in l for l in head):
+            log.add("Remote does not support backup_method = '{}'. Using 'copy'".format(backup_method))
+            self._legacy_apply = True
+            self._apply_queue_call(queue,force,None)
+
+    def _apply_queue_call(self,queue,force,backup_method):
+        """
+        Apply the queue with a remote call. Returns the return code and the
+        output lines outside of the log (e.g. an option error)
+        """
+        log = self.log
+        config = self.config
         sentinel = _randstr(N=10).encode('ascii')
         
         queue_bytes = json.dumps(queue,ensure_ascii=False).encode('utf8')
         
         # Construct the command
-        cmd = 'ssh {sm} -p {ssh_port:d} -q {userhost:s} "'.format(
-            sm=self.sm,**config.__dict__)
-
-        # construct the call cmd
-        if hasattr(config,'PyFiSync_path') and hasattr(config,'remote_program'):
-            log.add("DEPRECATION WARNING: 'PyFiSync_path' and 'remote_program' are deprecated. Use 'remote_exe'")
-            if len(config.PyFiSync_path) == 0:
-                cmd += 'PyFiSync _api apply_queue'
-            else:
-                cmd += config.remote_program + ' '
-                if any(config.PyFiSync_path.endswith('PyFiSync'+ext) for ext in ['','.py']):
-                    cmd += config.PyFiSync_path + ' _api apply_queue'
-                else:
-                    cmd += os.path.join(config.PyFiSync_path,'PyFiSync.py _api apply_queue')
-        else:
-            cmd += '{} _api apply_queue'.format(config.remote_exe)
+        cmd = self._remote_call('apply_queue')
         
         if force:
             cmd += ' --force '
 
         if not config.backup:
             cmd += ' --no-backup '
+        elif backup_method:
+            cmd += ' --backup-method {} '.format(backup_method)
 
-        cmd += ' ' + config.pathB + ' {}"'.format(sentinel.decode('ascii'))
+        cmd += ' ' + config.pathB + ' {}'.format(sentinel.decode('ascii'))
 
         out = ''
         err = ''
+        head = []
 
-        log.space=0
-        log.add('\nApplying queue on remote')
         log.prepend = '>  '
 
         started = False
-        cmd = shlex.split(cmd)
+        cmd = self._ssh_cmd(cmd)
         proc = subprocess.Popen(cmd,stdin=subprocess.PIPE,
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.PIPE, 
                                     shell=False)
         
-        proc.stdin.write(sentinel + queue_bytes)
-        proc.stdin.close()
+        try:
+            proc.stdin.write(sentinel + queue_bytes)
+            proc.stdin.close()
+        except (IOError,OSError):
+            pass # Exited early (e.g. bad option). See the return code
         
         with proc.stdout as stdout:
             for line in iter(stdout.readline, b''):
@@ -256,6 +636,8 @@ class ssh_rsync(remote_interface_base):
 
                 if started:
                     log.add(line.rstrip())
+                else:
+                    head.append(line.rstrip())
 
 
         with proc.stderr as stderr:
@@ -267,28 +649,180 @@ class ssh_rsync(remote_interface_base):
             log.add('Remote Call returned warnings:')
             log.space = 4
             log.add(err)
+        return proc.returncode,head
 
-    def transfer(self,tqA2B,tqB2A):
+    def rsync_profile(self):
+        """
+        The name of the rsync profile (see RSYNC_PROFILES) from 
+        config.rsync_profile. 'auto' is decided (once) from whether B is local
+        and a probe of the connection
+        """
+        with self._profile_lock: # streaming transfers may call at once
+            if self._rsync_profile is None:
+                self._rsync_profile = self._decide_profile()
+        return self._rsync_profile
+    
+    def _decide_profile(self):
+        name = getattr(self.config,'rsync_profile','default')
+        if name == 'auto':
+            name,reason = self._auto_profile()
+        elif name in RSYNC_PROFILES:
+            reason = 'set'
+        else:
+            raise ValueError('Unrecognized rsync_profile {}'.format(name))
+        
+        self.log.add('rsync profile: {} ({}). Flags: {}'.format(name,reason,RSYNC_PROFILES[name]))
+        return name
+    
+    def _auto_profile(self):
+        """ Returns the profile and why """
+        if len(self.config.userhost) == 0:
+            return 'local','B is a local path'
+        
+        cached = self._cached_profile()
+        if cached is not None:
+            return cached
+        
+        try:
+            rtt,bandwidth = self._probe()
+        except (OSError,ValueError) as E:
+            return 'wan','could not probe the connection: {}'.format(E)
+        
+        reason = 'round trip {:0.1f} ms, {:0.1f} MB/s'.format(1000*rtt,bandwidth/1024**2)
+        name = 'lan' if rtt <= LAN_MAX_RTT and bandwidth >= LAN_MIN_BANDWIDTH else 'wan'
+        self._cache_profile(name,reason)
+        return name,reason
+    
+    def _profile_cache(self):
+        """ Path of the probed profiles and the key for this host """
+        path = os.path.join(self.config.pathA,'.PyFiSync','rsync_profiles')
+        return path,'{}:{}'.format(self.config.userhost,self.config.ssh_port)
+    
+    def _cached_profile(self):
+        """ 
+        Return (profile,reason) if this host was probed within 
+        config.rsync_profile_ttl. Otherwise None
+        """
+        ttl = getattr(self.config,'rsync_profile_ttl',0)
+        if not ttl:
+            return None
+        path,key = self._profile_cache()
+        try:
+            with open(path,'rt') as F:
+                cached = json.loads(F.read())[key]
+            age = time.time() - cached['time']
+        except (IOError,OSError,ValueError,KeyError,TypeError):
+            return None
+        if not 0 <= age < ttl or cached.get('profile') not in ('lan','wan'):
+            return None
+        return cached['profile'],'{}. Probed {:0.1f} h ago'.format(cached['reason'],age/3600)
+    
+    def _cache_profile(self,name,reason):
+        """ Save the probed profile for this host. Failures are ignored """
+        if not getattr(self.config,'rsync_profile_ttl',0):
+            return
+        path,key = self._profile_cache()
+        try:
+            with open(path,'rt') as F:
+                cache = json.loads(F.read())
+        except (IOError,OSError,ValueError):
+            cache = {}
+        cache[key] = {'profile':name,'reason':reason,'time':time.time()}
+        try:
+            with open(path,'wt') as F:
+                F.write(utils.to_unicode(json.dumps(cache)))
+        except (IOError,OSError):
+            pass
+    
+    def _probe(self,nbytes=PROBE_BYTES,pings=3):
+        """
+        Measure the connection to B. Returns the round trip time (s) of a 
+        line echoed by B and the bandwidth (bytes/s) of sending nbytes. Both
+        are measured in one session after it has started so they do not 
+        include the SSH handshake or starting the remote shell.
+        """
+        proc = subprocess.Popen(self._ssh_cmd('sh -c ' + findlist.quote(_PROBE_SCRIPT)),
+                                stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                                stderr=_DEVNULL)
+        def _reply(expected):
+            if proc.stdout.readline().strip() != expected:
+                raise ValueError('probe exited with {}'.format(proc.poll()))
+        
+        def _ping():
+            t0 = time.time()
+            proc.stdin.write(b'ping\n')
+            proc.stdin.flush()
+            _reply(b'pong')
+            return time.time() - t0
+        
+        try:
+            _ping() # Waits for the session to start
+            rtt = min(_ping() for _ in range(pings))
+            
+            t0 = time.time()
+            proc.stdin.write(b'data\n')
+            proc.stdin.write(os.urandom(nbytes)) # Random so ssh can't compress it
+            proc.stdin.close()
+            _reply(b'done')
+            send = time.time() - t0
+        except (IOError,OSError) as E: # e.g. ssh exited
+            raise ValueError('probe failed: {}'.format(E))
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            for stream in (proc.stdin,proc.stdout):
+                try:
+                    stream.close()
+                except (IOError,OSError):
+                    pass
+        return rtt,nbytes/max(send - rtt,1e-6)
+    
+    def _rsync_cmd(self):
+        """
+        Return the rsync command (to be formatted with files, src, and dest)
+        and the rsync location of B
+        """
         config = self.config
-        log = self.log
-
-        pwd0 = os.getcwd()
-        os.chdir(config.pathA)
-
-        # Build the command
-        cmd = 'rsync -azvi -hh ' \
+        
+        profile = self.rsync_profile()
+        cmd = 'rsync ' + RSYNC_PROFILES[profile] + ' ' \
             + '--keep-dirlinks --copy-dirlinks ' # make directory links behave like they were folders
         
         if not config.copy_symlinks_as_links:
             cmd += '--copy-links '    
         
         if len(config.userhost) >0:
-            cmd += '-e "ssh -q -p {p:d} {sm}" '.format(p=config.ssh_port,sm=self.sm)
+            ciphers = ' ' + LAN_CIPHERS if profile == 'lan' else ''
+            cmd += '-e "ssh -q -p {p:d} {sm}{c}" '.format(p=config.ssh_port,sm=self.sm,c=ciphers)
             B = '{userhost:s}:{pathB:s}'.format(**config.__dict__)
         else:
             B = '{pathB:s}'.format(**config.__dict__)
 
         cmd += ' --files-from={files:s} {src:s}/ {dest:s}/'
+        return cmd,B
+
+    def transfer(self,tqA2B,tqB2A,filesA=None,filesB=None):
+        config = self.config
+        log = self.log
+        
+        if self._use_local_copy():
+            return self._local_copy(tqA2B,A2B=True),self._local_copy(tqB2A,A2B=False)
+        
+        tar_below = getattr(config,'tar_transfer_below',0)
+        if tar_below and filesA is not None and filesB is not None:
+            tqA2B = self._tar_transfer(tqA2B,filesA,filesB,tar_below,A2B=True)
+            tqB2A = self._tar_transfer(tqB2A,filesB,filesA,tar_below,A2B=False)
+        
+        processes = int(getattr(config,'transfer_processes',1))
+        if processes > 1:
+            return self._transfer_sharded(tqA2B,tqB2A,filesA,filesB,processes)
+
+        pwd0 = os.getcwd()
+        os.chdir(config.pathA)
+
+        # Build the command
+        cmd,B = self._rsync_cmd()
 
         log.add('(using rsync)')
 
@@ -356,6 +890,223 @@ class ssh_rsync(remote_interface_base):
         os.chdir(pwd0)
 
 
+    def _use_local_copy(self):
+        return len(self.config.userhost) == 0 \
+            and getattr(self.config,'local_transfer','rsync') == 'python'
+    
+    def _local_copy(self,paths,A2B,log=None):
+        """
+        Copy the paths between the local A and B without rsync (see 
+        localcopy.py). Returns the records of the copied files
+        """
+        config = self.config
+        if log is None:
+            log = self.log
+        name = 'A >>> B' if A2B else 'A <<< B'
+        src,dest = (config.pathA,config.pathB) if A2B else (config.pathB,config.pathA)
+        
+        log.space = 1
+        if not paths:
+            log.add('\nNo {} transfers'.format(name))
+            return []
+        log.add('\nCopying {} files {}'.format(len(paths),name))
+        log.space = 4
+        
+        records,size = [],0
+        for path,record,error in localcopy.copy_files(paths,src,dest,
+                follow_symlinks=not config.copy_symlinks_as_links,
+                threads=getattr(config,'local_copy_threads',8)):
+            if error is not None:
+                log.add('ERROR: Could not copy {}: {}'.format(path,error))
+                continue
+            log.add('Transfer  ' + path)
+            records.append(record)
+            size += record['size']
+        log.add('\nCopied {} files ({:0.2f} {})'.format(len(records),
+                                                      *utils.bytes2human(size,short=False)))
+        return records
+    
+    def _tar_transfer(self,queue,files_src,files_dest,below,A2B):
+        """
+        Send the new (not on the destination) files in the queue that are
+        smaller than `below` bytes as one tar stream. Returns the rest of the
+        queue (including any that failed) for rsync. Files that turn out to
+        exist on the destination anyway (e.g. untracked) are not replaced by
+        tar and are left to rsync (see tarstream)
+        """
+        config = self.config
+        log = self.log
+        
+        small = []
+        for path in queue:
+            file = files_src.query_one(path=path)
+            if file is None or file.get('size',below) >= below:
+                continue
+            if files_dest.query_one(path=path) is not None:
+                continue
+            small.append(path)
+        if not small:
+            return queue
+        
+        log.space = 1
+        log.add('\nSending {} small new files {} with tar'.format(len(small),
+                                                             'A >>> B' if A2B else 'A <<< B'))
+        log.space = 4
+        
+        deref = not config.copy_symlinks_as_links
+        if A2B:
+            create = ['sh','-c',tarstream.create_command(config.pathA,dereference=deref)]
+            extract = self._tar_cmd(tarstream.extract_command(config.pathB))
+        else:
+            create = self._tar_cmd(tarstream.create_command(config.pathB,dereference=deref))
+            extract = ['sh','-c',tarstream.extract_command(config.pathA)]
+        
+        try:
+            pcreate = subprocess.Popen(create,stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            pextract = subprocess.Popen(extract,stdin=pcreate.stdout,stderr=subprocess.PIPE)
+            pcreate.stdout.close() # Only read by extract
+            errs = [utils.ReturnThread(target=p.stderr.read) for p in (pcreate,pextract)]
+            for err in errs:
+                err.start()
+            
+            try:
+                pcreate.stdin.write(tarstream.encode_paths(small))
+                pcreate.stdin.close()
+            except IOError: # tar exited early. Its error is below
+                pass
+            codes = [pcreate.wait(),pextract.wait()]
+            stderrs = [utils.to_unicode(err.join()) for err in errs]
+        except OSError as E:
+            log.add('Could not run tar ({}). Using rsync'.format(E))
+            return queue
+        
+        existing,other = tarstream.existing_paths(stderrs[1])
+        smallset = set(small)
+        if codes[0] or other or (codes[1] and not existing) \
+                or not smallset.issuperset(existing):
+            stderr = ' '.join(e.strip() for e in stderrs)
+            log.add('tar failed ({}). Using rsync'.format(stderr.strip() or codes))
+            return queue
+        
+        existing = set(existing)
+        for path in small:
+            if path in existing:
+                log.add('Exists    {} (not replaced by tar. Using rsync)'.format(path))
+            else:
+                log.add('Transfer  ' + path)
+        done = smallset - existing
+        return [path for path in queue if path not in done]
+    
+    def _tar_cmd(self,remote):
+        """ Command (as a list) to run the shell command on B (even if local) """
+        if len(self.config.userhost) == 0: # Local mode
+            return ['sh','-c',remote]
+        return self._ssh_cmd(remote)
+    
+    def _transfer_sharded(self,tqA2B,tqB2A,filesA,filesB,processes):
+        """
+        Split each queue into (up to) `processes` shards of about the same
+        total size and run them all (both directions) at once. The output is
+        collected and then logged by direction
+        """
+        config = self.config
+        log = self.log
+        
+        cmd,B = self._rsync_cmd()
+        log.add('(using rsync. Up to {} processes each way)'.format(processes))
+        
+        directions = [('A >>> B',tqA2B,filesA,config.pathA,B),
+                      ('A <<< B',tqB2A,filesB,B,config.pathA)]
+        jobs = []
+        for name,queue,files,src,dest in directions:
+            dcmd = cmd.format(files='-',src=src,dest=dest)
+            for shard in _size_shards(queue,_file_sizes(queue,files),processes):
+                jobs.append((name,dcmd,shard))
+        
+        def _run(job):
+            return list(self._rsync_output(job[1],job[2]))
+        
+        outputs = []
+        if jobs:
+            pool = ThreadPool(len(jobs))
+            try:
+                outputs = pool.map(_run,jobs)
+            finally:
+                pool.close()
+        
+        for name,queue,files,src,dest in directions:
+            log.space = 1
+            runs = [(job,out) for job,out in zip(jobs,outputs) if job[0] == name]
+            if not runs:
+                log.add('\nNo {} transfers'.format(name))
+                continue
+            
+            log.add('\nRan rsync {} in {} processes'.format(name,len(runs)))
+            log.add('  cmd = ' + runs[0][0][1])
+            log.space = 4
+            
+            # Transfers (and errors) from all of them. Directories may be
+            # made by more than one
+            seen = set()
+            for _,out in runs:
+                for line in out:
+                    if line is None or _is_summary(line) or line in seen:
+                        continue
+                    seen.add(line)
+                    log.add(line)
+            
+            for ii,(job,out) in enumerate(runs):
+                log.add('\nProcess {}/{} ({} files):'.format(ii+1,len(runs),len(job[2])))
+                for line in out:
+                    if line is not None and _is_summary(line):
+                        log.add(line.strip())
+    
+    def _rsync_output(self,cmd,paths):
+        """
+        Run the rsync cmd (with --files-from=-) on paths and generate the
+        processed (see _proc_final_log) lines of its output
+        """
+        proc = subprocess.Popen(cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                                shell=True)
+        
+        # rsync reads the entire list before it starts so write it all 
+        # rather than interleave reading and writing
+        try:
+            proc.stdin.write(b'\n'.join(p.encode('utf-8') for p in paths))
+            proc.stdin.close()
+        except IOError: # rsync exited early. Its output will say why
+            pass
+        with proc.stdout:
+            for line in iter(proc.stdout.readline, b''):
+                yield self._proc_final_log(line)
+        proc.wait()
+    
+    def transfer_stream(self,paths,A2B,log=None):
+        """
+        Transfer paths in one direction with the list passed to rsync over 
+        stdin (--files-from=-). Used by the streaming pipeline so that it may
+        be called repeatedly (and from a thread) as transfers become ready.
+        """
+        config = self.config
+        if log is None:
+            log = self.log
+        
+        if self._use_local_copy():
+            self._local_copy(paths,A2B,log=log)
+            return
+
+        cmd,B = self._rsync_cmd()
+        if A2B:
+            cmd = cmd.format(files='-',src=config.pathA,dest=B)
+        else:
+            cmd = cmd.format(files='-',src=B,dest=config.pathA)
+        
+        log.add('rsync {} files. cmd = {}'.format(len(paths),cmd))
+        
+        for line in self._rsync_output(cmd,paths):
+            log.add(line)
+
     def _proc_final_log(self,line):
         line = line.strip()
         if len(line) == 0: return None
@@ -393,112 +1144,14 @@ class ssh_rsync(remote_interface_base):
 
     @staticmethod
     def cli(argv):
-        from . import PFSwalk
-        from . import main
-            
-        mode = argv[0]
-        argv = argv[1:]
-        if mode == 'file_list':
-            # Get the sentinel
-            sentinel = argv[0].encode('ascii')
-            
-            # For python3 to read bytes
-            stdin = sys.stdin
-            if hasattr(stdin,'buffer'):
-                stdin = stdin .buffer
-            stdout = sys.stdout
-            if hasattr(stdout,'buffer'):
-                stdout = stdout.buffer
-            
-            # Read the config, find and cut up to the sentinel, convert to 
-            # unicode and json load
-            
-            
-            remote_config_bytes = stdin.read()  
-            remote_config_bytes = remote_config_bytes[remote_config_bytes.find(sentinel)+len(sentinel):]
-            remote_config_bytes = remote_config_bytes.decode('utf8')
-            remote_config = json.loads(remote_config_bytes)
-            
-            # Process the input
-            path = remote_config['path']
-            config = utils.configparser()
-            config.pathA = path
-
-            empty = remote_config['empty']
-            config.copy_symlinks_as_links = remote_config['copy_symlinks_as_links']
-            config.excludes = list(set(remote_config['excludes'])) # do *not* use default excludes
-            config.use_hash_db = remote_config['use_hash_db']
-            
-            # Generate the list. This may raise errors so do not start
-            # capture until later
-            log = utils.logger(silent=True,path=None)
-            _tmp = PFSwalk.file_list(path,config,log,
-                                    attributes=remote_config['attributes'],
-                                    empty=empty,
-                                    use_hash_db=config.use_hash_db)
-            flist = _tmp.files()
-
-            out = json.dumps(flist,ensure_ascii=False)
-            out = zlib.compress(out.encode('utf8'),9) # Compress it
-            
-            stdout.write(sentinel + out) # write the bytes
-            
-        elif mode == 'apply_queue':
-            import getopt  # Even though it is "old school" use getopt here 
-                           # since it is easier and this interface is never 
-                           # exposed to the user
-            # For python3 to read bytes
-            stdin = sys.stdin
-            if hasattr(stdin,'buffer'):
-                stdin = stdin.buffer
-            stdout = sys.stdout
-            if hasattr(stdout,'buffer'):
-                stdout = stdout.buffer
-            
-            try:
-                opts, args = getopt.getopt(argv, "",['force','no-backup'])
-            except getopt.GetoptError as err:
-                print(str(err)) #print error
-                sys.exit(2)
-
-            path,sentinel = args
-
-            config = utils.configparser()
-            config.pathA = path
-
-            # Place the config into PyFiSync
-            main.config = config
-
-            force = False
-            for opt,val in opts:
-                if opt == '--force':
-                    force = True
-                if opt == '--no-backup':
-                    config.backup = False
-
-            log = utils.logger(path=path,silent=False)
-
-            sys.stdout.write('START>>>>>>>\n')
+        from . import api
+        api.cli(argv)
 
-            # Get the queue from stdin
-            sentinel = sentinel.encode('ascii')
-            queue = stdin.read()
-            queue = queue[queue.find(sentinel)+len(sentinel):]
-            queue = queue.decode('utf8')
-
-            try:
-                queue = json.loads(queue)
-            except Exception as E:
-                sys.stderr.write('could not parse input. Error: "{}"'.format(E))
-                sys.exit(2)
-
-            print('Successfully loading action queue of {:d} items'.format(len(queue)))
-
-            main.apply_action_queue(path,queue)
-
-            sys.stdout.write('\n<<<<<<<END')
     def close(self):
-        if self.config.persistant:
+        if self._agent_client:
+            self._agent_client.close()
+            self._agent_client = None
+        if self.persistant_proc is not None: # Not shared
             self.persistant_proc.terminate()
             # Remove the socket. The other connection will die soon
             try:
@@ -605,6 +1258,26 @@ class Rclone(remote_interface_base):
                 dst = os.path.join(self.config.pathB,path[1])
                 self.call(['moveto',src,dst])
                 self.log.add('move: ' + utils.move_txt(path[0],path[1]))
+            elif action == 'movedir': 
+                # Only the names since the remote directory may have untracked
+                # (e.g. excluded) files in it that should stay. One call
+                src_dir,dst_dir,names = path
+                src = os.path.join(self.config.pathB,src_dir)
+                dst = os.path.join(self.config.pathB,dst_dir)
+                self._call_files_from(['move',src,dst,'--delete-empty-src-dirs'],names)
+                self.log.add('move dir: {} ({} files)'.format(
+                    utils.move_txt(src_dir,dst_dir),len(names)))
+            elif action == 'deletedir': # Only the names like movedir
+                src_dir,names = path
+                src = os.path.join(self.config.pathB,src_dir)
+                if config.backup:
+                    dst = os.path.join(self.backup_path,src_dir)
+                    self._call_files_from(['move',src,dst,'--delete-empty-src-dirs'],names)
+                    didback = True
+                else:
+                    self._call_files_from(['delete',src,'--rmdirs'],names)
+                log.add('delete dir (w/{} backup): {} ({} files)'.format(
+                    '' if config.backup else 'o',src_dir,len(names)))
             elif action in ['backup','delete']:
                 src = os.path.join(self.config.pathB,path)
                 dst = os.path.join(self.backup_path,path)
@@ -635,7 +1308,7 @@ class Rclone(remote_interface_base):
             else:
                 log.add('\nBackups saved in {}'.format(self.backup_path))    
         
-    def transfer(self,tqA2B,tqB2A):
+    def transfer(self,tqA2B,tqB2A,filesA=None,filesB=None):
         config = self.config
         log = self.log
         
@@ -698,6 +1371,16 @@ class Rclone(remote_interface_base):
             log.add('\nNo A <<< B transfers')       
         
             
+    def _call_files_from(self,args,names):
+        """ call() with --files-from the names (relative to the source) """
+        tmp_file = '/tmp/names' + _randstr()
+        with open(tmp_file,'wt',encoding='utf8') as file:
+            file.write('\n'.join('/' + name for name in names)) # See transfer
+        try:
+            return self.call(list(args) + ['--files-from',tmp_file])
+        finally:
+            os.remove(tmp_file)
+    
     def call(self,args,echo=False):
         """
         Call rclone with the appropriate flags already set
@@ -786,6 +1469,87 @@ def get_remote_interface(config=None,name=None):
         raise ValueError()
 
 
+def _control_path(config):
+    """
+    The stable control socket for the user@host:port or None if the directory
+    for it is not safe (it must be ours and not writable by others)
+    """
+    dirpath = os.path.join(tempfile.gettempdir(),'PyFiSync-{}'.format(_uid()))
+    try:
+        os.mkdir(dirpath,0o700)
+    except OSError:
+        pass
+    try:
+        st = os.lstat(dirpath)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != _uid() or st.st_mode & 0o022:
+        return None
+    
+    # Keep it short since sockets have a length limit 
+    key = '{}:{}'.format(config.userhost,config.ssh_port)
+    return os.path.join(dirpath,hashlib.sha1(key.encode('utf8')).hexdigest()[:16])
+
+def _uid():
+    return os.getuid() if hasattr(os,'getuid') else 0
+
+def _remove_stale_socket(path):
+    """
+    Remove the (stale) socket at path. Returns False if there is something 
+    else there that shouldn't be removed
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return True # Nothing there
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != _uid():
+        return False
+    try:
+        os.remove(path)
+    except OSError:
+        return not os.path.exists(path)
+    return True
+
+@contextlib.contextmanager
+def _control_lock(socket_path):
+    """
+    Lock so that two runs don't both start a master on the same socket
+    """
+    if utils.fcntl is None:
+        yield
+        return
+    with open(socket_path + '.lock','ab') as fobj:
+        utils.fcntl.flock(fobj.fileno(),utils.fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            utils.fcntl.flock(fobj.fileno(),utils.fcntl.LOCK_UN)
+
+def _file_sizes(paths,files):
+    """ Sizes of the paths from the files (DictTable) or 1 if not known """
+    sizes = []
+    for path in paths:
+        file = files.query_one(path=path) if files is not None else None
+        sizes.append(file.get('size',1) if file is not None else 1)
+    return sizes
+
+def _size_shards(paths,sizes,nshards):
+    """
+    Split paths into up to nshards lists with about the same total size.
+    Largest first, each goes to the smallest shard so far. Each shard is
+    sorted
+    """
+    heap = [(0,ii,[]) for ii in xrange(min(nshards,len(paths)))]
+    for size,path in sorted(zip(sizes,paths),reverse=True):
+        total,ii,shard = heapq.heappop(heap)
+        shard.append(path)
+        heapq.heappush(heap,(total + max(size,1),ii,shard))
+    return [sorted(shard) for _,_,shard in sorted(heap,key=lambda s:s[1])]
+
+def _is_summary(line):
+    """ rsync's transfer summary lines """
+    return line.strip().startswith(('sent ','total size'))
+
 def _randstr(N=10):
     random.seed()
     return ''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in xrange(N))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming (pipelined) queues and transfers.
+
+Normally, all of the queues are determined, then all of the actions are
+applied on A and then B, and only then are the transfers run. In streaming
+mode, the decisions are fed to workers as they are made:
+
+* Each side has an applier thread that applies its action queue (moves first)
+  in order as it grows.
+* Each direction has a transfer thread that runs rsync (--files-from=-) on
+  the transfers that are ready while more decisions are being made. rsync
+  reads its entire file list before starting so it is run in rounds of
+  everything that became ready during the previous round.
+* A transfer is ready once there are no pending actions on its path on
+  either side. i.e., a file is not overwritten before it is backed up and a
+  tagged conflict is not sent before it is moved. A path that is still to be
+  decided is also held so that decisions made later are respected.
+
+The remote (B) applies a whole queue per call so its moves, which are known
+up front, are applied right away and the rest once all decisions are made.
+
+The logs of each worker are buffered and written in order at the end.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import utils
+
+DIRECTIONS = ['A2B','B2A']
+_LABELS = {'A2B':'A >>> B','B2A':'A <<< B'}
+
+def action_paths(action):
+    """ The paths (or directories) touched by an action queue item """
+    action,path = list(action.items())[0]
+    if action in ['move','movedir']:
+        return list(path[:2]) # movedir also has the names in it
+    if action == 'deletedir':
+        return [path[0]]
+    return [path]
+
+class Gate(object):
+    """
+    Holds transfers until there are no pending actions on their path or any
+    of its parent directories.
+
+    release(direction,path) is called (possibly from another thread) when
+    the transfer is ready.
+    """
+    def __init__(self,release):
+        self.release = release
+        self.lock = threading.Lock()
+        self.pending = {} # path: count
+        self.held = {}    # path: [(direction,transfer path),...]
+
+    def hold(self,paths):
+        """ Hold the paths until done() (in addition to any actions) """
+        with self.lock:
+            for path in paths:
+                self.pending[path] = self.pending.get(path,0) + 1
+
+    def add_action(self,action):
+        self.hold(action_paths(action))
+
+    def done(self,paths):
+        released = []
+        with self.lock:
+            for path in paths:
+                self.pending[path] -= 1
+                if self.pending[path] == 0:
+                    del self.pending[path]
+                    released.extend(self.held.pop(path,[]))
+        for direction,path in released:
+            self.add_transfer(direction,path) # May be held by a parent
+
+    def applied(self,action):
+        self.done(action_paths(action))
+
+    def add_transfer(self,direction,path):
+        with self.lock:
+            for key in [path] + utils.parent_dirs(path):
+                if key in self.pending:
+                    self.held.setdefault(key,[]).append((direction,path))
+                    return
+        self.release(direction,path)
+
+class Pipeline(object):
+    """
+    Apply the queues and transfer concurrently with determining them.
+
+    Inputs:
+        config,log
+        apply_local: apply_local(dirpath,queue,applied,log) applies an action
+                     queue (which may still be growing) on a local path and
+                     calls applied(action) on each
+        remote_interface: Must have transfer_stream(paths,A2B,log). If
+                     remote, also apply_queue(queue)
+        remote: Whether B is remote
+
+    Usage:
+        pipe.start(move_queueA,move_queueB)
+        for path in pipe.watch(paths,action_queueA,action_queueB,tqA2B,tqB2A):
+            ... # append to the queues
+        pipe.close()
+    """
+    def __init__(self,config,log,apply_local,remote_interface,remote=True):
+        self.config = config
+        self.log = log
+        self.apply_local = apply_local
+        self.remote_interface = remote_interface
+        self.remote = remote
+
+        self.gate = Gate(self._release)
+        self.actions = {'A':queue.Queue(),'B':queue.Queue()}
+        self.transfers = {d:queue.Queue() for d in DIRECTIONS}
+        self.logs = dict((k,utils.bufferedlog(log,k)) for k in 'AB')
+        self.logs.update((d,utils.bufferedlog(log,_LABELS[d])) for d in DIRECTIONS)
+        self.counts = {d:[0,0] for d in DIRECTIONS} # files,rounds
+        self.threads = {}
+        self.aborted = False
+
+        self._watched = []
+
+    def _release(self,direction,path):
+        self.transfers[direction].put(path)
+
+    def start(self,move_queueA,move_queueB):
+        for AB,move_queue in [('A',move_queueA),('B',move_queueB)]:
+            for action in move_queue:
+                self.gate.add_action(action)
+
+        targets = [('A',self._apply_local,('A',)),
+                   ('B',self._apply_remote if self.remote else self._apply_local,('B',))]
+        targets.extend((d,self._transfer,(d,)) for d in DIRECTIONS)
+        for name,target,args in targets:
+            thread = utils.ReturnThread(target=target,args=args)
+            thread.daemon = True
+            self.threads[name] = thread
+
+        # Queue the moves before starting
+        self._put('A',move_queueA)
+        if not self.remote:
+            self._put('B',move_queueB)
+        else:
+            self.remote_moves = list(move_queueB)
+
+        for thread in self.threads.values():
+            thread.start()
+
+    def watch(self,paths,action_queueA,action_queueB,tqA2B,tqB2A):
+        """
+        Yield each of the paths and, after each, send any new items in the
+        queues to the workers
+        """
+        paths = list(paths)
+        self._watched = [[action_queueA,0],[action_queueB,0],[tqA2B,0],[tqB2A,0]]
+        self.gate.hold(paths)
+        self.update()
+        for path in paths:
+            yield path
+            self.update()
+            self.gate.done([path])
+
+    def update(self):
+        """ Send new items in the watched queues (actions first) """
+        new = []
+        for item in self._watched:
+            L,ix = item
+            new.append(L[ix:])
+            item[1] = len(L)
+        actionsA,actionsB,tA2B,tB2A = new
+
+        for AB,actions in [('A',actionsA),('B',actionsB)]:
+            if not self.config.backup:
+                actions = [a for a in actions if 'backup' not in a]
+            for action in actions:
+                self.gate.add_action(action)
+            self._put(AB,actions)
+
+        for direction,paths in [('A2B',tA2B),('B2A',tB2A)]:
+            for path in paths:
+                self.gate.add_transfer(direction,path)
+
+    def _put(self,AB,actions):
+        for action in actions:
+            self.actions[AB].put(action)
+
+    def close(self,abort=False):
+        """
+        Finish applying and transferring, and write the logs. 
+        
+        If abort, stop without applying or transferring anything that has 
+        not already started. Transfers still held after an error are not run.
+        """
+        if abort:
+            self.aborted = True
+        for AB in 'AB':
+            self.actions[AB].put(None)
+        try:
+            for AB in 'AB':
+                self.threads[AB].join()
+        finally:
+            for direction in DIRECTIONS:
+                self.transfers[direction].put(None)
+            try:
+                for direction in DIRECTIONS:
+                    self.threads[direction].join()
+            finally:
+                for name in ['A','B'] + DIRECTIONS:
+                    self.logs[name].flush()
+
+        for direction in DIRECTIONS:
+            files,rounds = self.counts[direction]
+            self.log.add('{}: {} files in {} round(s)'.format(_LABELS[direction],files,rounds))
+
+    def _actions(self,AB):
+        """ Iterate the actions for AB until closed """
+        for action in iter(self.actions[AB].get,None):
+            if self.aborted:
+                return
+            yield action
+
+    def _apply_local(self,AB):
+        dirpath = self.config.pathA if AB == 'A' else self.config.pathB
+        self.apply_local(dirpath,self._actions(AB),
+                         applied=self.gate.applied,log=self.logs[AB])
+
+    def _apply_remote(self,AB):
+        # The remote applies a whole queue at once. Apply the known moves now
+        # and the rest when everything has been determined
+        remote_interface = self.remote_interface
+        log0 = remote_interface.log
+        remote_interface.log = self.logs[AB]
+        try:
+            for queue_ in [self.remote_moves,list(self._actions(AB))]:
+                if not queue_ or self.aborted:
+                    continue
+                remote_interface.apply_queue(queue_)
+                for action in queue_:
+                    self.gate.applied(action)
+        finally:
+            remote_interface.log = log0
+
+    def _transfer(self,direction):
+        transfers = self.transfers[direction]
+        log = self.logs[direction]
+        log.space = 2
+        closed = False
+        while not closed:
+            paths = [transfers.get()] # Block for the first
+            while True:
+                try:
+                    paths.append(transfers.get_nowait())
+                except queue.Empty:
+                    break
+            if None in paths:
+                closed = True
+                paths = [p for p in paths if p is not None]
+            if not paths or self.aborted:
+                continue
+            self.counts[direction][0] += len(paths)
+            self.counts[direction][1] += 1
+            self.remote_interface.transfer_stream(paths,direction == 'A2B',log=log)
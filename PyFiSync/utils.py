@@ -12,10 +12,12 @@ import sys
 import datetime
 import re
 import zlib
+import json
 from io import open
 import itertools
 import argparse
 import copy
+import shutil
 from threading import Thread
 import getpass
 from functools import partial
@@ -25,10 +27,17 @@ try:
 except ImportError:
     from Queue import Queue
 
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
 if sys.version_info >= (3,):
     unicode = str
     xrange = range
 
+REMOTES = ['rsync','rclone'] # See remote_interfaces
+
 class logger(object):
     def __init__(self,path=None,silent=False):
 
@@ -107,6 +116,46 @@ class logger(object):
     def line(self):
         self.add('='*50,end='\n')
 
+class bufferedlog(object):
+    """
+    Stand-in for a logger (e.g. for something running in a thread) that holds
+    the messages until flush() when they are all written to the log, labeled,
+    so they are not interleaved with others
+    """
+    def __init__(self,log,label):
+        self.log = log
+        self.label = label
+        self.messages = []
+        
+        self.space = 0
+        self.prepend = ''
+        
+    def add(self,text,end=u'\n',return_out=False):
+        self._append('add',text,end)
+    
+    def add_err(self,text,end=u'\n'):
+        self._append('add_err',text,end)
+    
+    def _append(self,method,text,end):
+        if text is None:
+            return
+        text = u'\n'.join(self.prepend + u' '*self.space + line 
+                          for line in to_unicode(text).split(u'\n'))
+        self.messages.append((method,text,end))
+    
+    def line(self):
+        self.add('='*50)
+    
+    def flush(self):
+        prepend0 = self.log.prepend
+        self.log.prepend = prepend0 + '{}: '.format(self.label)
+        try:
+            for method,text,end in self.messages:
+                getattr(self.log,method)(text,end=end)
+        finally:
+            self.log.prepend = prepend0
+        self.messages = []
+
 class configparser(object):
     """This will eventually be the configuration"""
     default_path = os.path.join(os.path.dirname(__file__),'config_template.py')
@@ -218,7 +267,6 @@ class configparser(object):
     @staticmethod
     def _filterconfig(config,remote='rsync'):   
         # remove anything that is not part of this remote
-        from .remote_interfaces import REMOTES
         if remote not in REMOTES:
             raise ValueError('Not a valid remote')
         for rem in REMOTES:
@@ -383,15 +431,76 @@ class ReturnThread(Thread):
         super(ReturnThread, self).__init__(target=self._target,**kwargs)
     
     def _target(self,*args,**kwargs):
-        self.q.put( self.target(*args,**kwargs) )
+        try:
+            self.q.put( (True,self.target(*args,**kwargs)) )
+        except BaseException as E: # Raise it on join
+            self.q.put( (False,E) )
     
     def join(self,**kwargs):
         super(ReturnThread, self).join(**kwargs)
-        res = self.q.get()
+        success,res = self.q.get()
         self.q.task_done()
         self.q.join()
+        if not success:
+            raise res
         return res
             
+def parent_dirs(path):
+    """ All parent directories of path: 'a/b/c' --> ['a/b','a'] """
+    parents = []
+    path = os.path.dirname(path)
+    while path:
+        parents.append(path)
+        path = os.path.dirname(path)
+    return parents
+
+BACKUP_METHODS = ['copy','reflink','hardlink','auto']
+FICLONE = 0x40049409 # linux/fs.h
+
+def backup_copy(src,dst,method='auto'):
+    """
+    Copy src to dst (for a backup) with:
+        'copy':     A regular copy (shutil.copy2)
+        'reflink':  A copy-on-write clone (Linux FICLONE on btrfs, XFS, etc)
+                    that does not copy any data
+        'hardlink': A hard link. Only safe if the file is replaced (not 
+                    modified in place) afterwards like rsync does
+        'auto':     'reflink'
+    Falls back to a copy when the method is not possible (e.g. unsupported
+    filesystem or a different device) and for links. Returns the method used
+    """
+    if method not in BACKUP_METHODS:
+        raise ValueError('Unrecognized backup method {}'.format(method))
+    
+    if not os.path.islink(src):
+        if method in ['reflink','auto'] and _reflink(src,dst):
+            return 'reflink'
+        if method == 'hardlink':
+            try:
+                os.link(src,dst)
+                return 'hardlink'
+            except OSError:
+                pass
+    
+    shutil.copy2(src,dst)
+    return 'copy'
+
+def _reflink(src,dst):
+    """ Try to clone src to dst. Return whether it worked """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        with open(src,'rb') as fsrc, open(dst,'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+    except (IOError,OSError):
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+    shutil.copystat(src,dst)
+    return True
+
 def RFC3339_to_unix(timestr):
     """
     Parses RFC3339 into a unix time
@@ -461,6 +570,52 @@ def file_summary(files):
     s = bytes2human(s)
     return "{:d} files, {:0.2f} {:s}".format(N,s[0],s[1])
 
+_JSON_WS = re.compile(r'[ \t\r\n]*')
+def iter_json_list(fobj,object_hook=None,bufsize=2**16):
+    """
+    Generate the items of the JSON list in the (text) file object without
+    loading all of it. Only one item (plus bufsize) is in memory at a time
+    so this works for the (large) old file lists regardless of how they were
+    written.
+    """
+    decoder = json.JSONDecoder(object_hook=object_hook)
+    buf,pos,eof = '',0,False
+    skip = ' \t\r\n['
+    while True:
+        if pos >= len(buf) - 1 and not eof: # Always have the next character
+            data = fobj.read(bufsize)
+            buf,pos,eof = buf[pos:] + data,0,not data
+            continue
+        
+        if pos < len(buf) and buf[pos] in skip:
+            if buf[pos] == '[':
+                skip = ' \t\r\n,'
+            pos += 1
+            continue
+        
+        if skip.endswith('['):
+            raise ValueError('Not a JSON list')
+        if pos >= len(buf):
+            raise ValueError('Unexpected end of JSON list')
+        if buf[pos] == ']':
+            return
+        
+        try:
+            item,end = decoder.raw_decode(buf,pos)
+            nxt = _JSON_WS.match(buf,end).end()
+            nxt = buf[nxt:nxt+1] # Not a copy of the rest of buf
+        except ValueError:
+            if eof:
+                raise
+            nxt = '' # Not all here yet
+        if nxt not in (',',']'):
+            if eof:
+                raise ValueError('Expected , or ] in JSON list')
+            data = fobj.read(bufsize) # Incomplete (e.g. a number)
+            buf,pos,eof = buf[pos:] + data,0,not data
+            continue
+        pos = end
+        yield item
 
 ########################### six extracted codes ###########################
 # This is pulled from the python six module (see links below) to work 
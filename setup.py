@@ -10,7 +10,7 @@ setup(
     packages=['PyFiSync'],
     long_description=open('README.md').read(),
     entry_points = {
-        'console_scripts': ['PyFiSync=PyFiSync.main:cli'],
+        'console_scripts': ['PyFiSync=PyFiSync:cli'],
     },
     version=PyFiSync.__version__,
     description='Python based intelligent file sync with automatic backups and file move/delete tracking.',
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+The remote agent (`_api serve`). ssh is replaced by running the remote
+command directly as a subprocess
+"""
+from __future__ import unicode_literals,print_function
+
+import io
+import os
+import sys
+import json
+import shlex
+
+import pytest
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync import utils
+from PyFiSync import agent
+from PyFiSync import PFSwalk
+from PyFiSync import remote_interfaces
+
+PFS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'PyFiSync.py')
+
+class LocalRemote(remote_interfaces.ssh_rsync):
+    """ ssh_rsync where "B" is run locally without ssh """
+    def _ssh_cmd(self,remote):
+        return shlex.split(remote)
+
+def _remote(tmpdir,remote_exe=None):
+    config = utils.configparser(remote='rsync')
+    config.pathA = str(tmpdir.join('A'))
+    config.pathB = str(tmpdir.join('B'))
+    config.persistant = False
+    config.remote_exe = remote_exe or '{} {}'.format(sys.executable,PFS)
+    log = utils.logger(silent=True)
+    for ii in range(20):
+        tmpdir.join('B','sub{}'.format(ii % 3),'file{}'.format(ii)).write('B'*ii,ensure=True)
+    return LocalRemote(config,log),config,log
+
+def test_frames():
+    stream = io.BytesIO()
+    small = {'cmd':'hello','version':1}
+    big = {'paths':['dir/file{}'.format(ii) for ii in range(1000)]}
+    agent.write_frame(stream,small)
+    agent.write_frame(stream,big)
+
+    raw = stream.getvalue()
+    assert raw[0:1] == b'\x00' # small is not compressed
+    assert len(raw) < len(str(big))
+
+    stream.seek(0)
+    assert agent.read_frame(stream) == small
+    assert agent.read_frame(stream) == big
+    assert agent.read_frame(stream) is None
+
+def test_agent(tmpdir):
+    remote,config,log = _remote(tmpdir)
+    try:
+        assert remote.agent() is not None
+        assert remote.agent().commands >= {'file_list','file_list_stream','apply_queue'}
+
+        attributes = ['path','size','mtime','sha1']
+        files = remote.file_list(attributes,empty='store')
+        direct = PFSwalk.file_list(config.pathB,config,log,attributes=attributes,
+                                   empty='store',use_hash_db=config.use_hash_db).files()
+        key = lambda f:f['path']
+        assert sorted(files,key=key) == sorted(direct,key=key)
+
+        remote.apply_queue([{'move':['sub0/file0','new/file0']},{'delete':'sub0/file3'}])
+        assert tmpdir.join('B','new','file0').exists()
+        assert not tmpdir.join('B','sub0','file0').exists()
+        assert not tmpdir.join('B','sub0','file3').exists()
+
+        proc = remote.agent().proc
+    finally:
+        remote.close()
+    assert proc.returncode == 0 # exited cleanly
+
+def test_agent_fallback(tmpdir):
+    """ A remote without `_api serve` uses the per-call mode """
+    old = tmpdir.join('old_PyFiSync.py')
+    old.write('\n'.join([
+        'import sys',
+        'sys.path.insert(0,{!r})'.format(os.path.dirname(PFS)),
+        "if sys.argv[1:3] == ['_api','serve']:",
+        "    print('unknown mode')",
+        '    sys.exit()',
+        'from PyFiSync import cli',
+        'cli(sys.argv[1:])']))
+
+    remote,config,log = _remote(tmpdir,'{} {}'.format(sys.executable,old))
+    try:
+        assert remote.agent() is None
+        files = remote.file_list(['path','size'],empty='store')
+        assert len(files) == 20
+
+        remote.apply_queue([{'move':['sub0/file0','new/file0']}])
+        assert tmpdir.join('B','new','file0').exists()
+    finally:
+        remote.close()
+
+def test_agent_error(tmpdir):
+    """ Errors are returned and the agent keeps running """
+    remote,config,log = _remote(tmpdir)
+    try:
+        client = remote.agent()
+        try:
+            client.request('file_list',config={'path':config.pathB})
+            assert False
+        except agent.AgentError as E:
+            assert 'KeyError' in str(E)
+        assert client.request('hello',version=agent.VERSION)['version'] == agent.VERSION
+    finally:
+        remote.close()
+
+def test_agent_stream_error(tmpdir,monkeypatch):
+    """ The stream is sent as it is made and an error partway is reported """
+    def bad_encode(files,**kwargs):
+        yield b'partial'
+        raise ValueError('bad list')
+    monkeypatch.setattr(agent.listcodec,'encode',bad_encode)
+    monkeypatch.setattr(sys,'stdout',sys.stdout) # serve() replaces it
+    
+    stdin,stdout = io.BytesIO(),io.BytesIO()
+    remote_config = {'path':str(tmpdir),'excludes':[],'attributes':['path'],
+                     'empty':'store','copy_symlinks_as_links':True,'use_hash_db':False}
+    agent.write_frame(stdin,{'cmd':'file_list_stream','config':remote_config})
+    agent.write_frame(stdin,{'cmd':'hello','version':agent.VERSION})
+    stdin.seek(0)
+    agent.serve(stdin,stdout)
+    
+    stdout.seek(len(agent.MAGIC))
+    assert agent.read_frame(stdout) == {'ok':True,'stream':True}
+    stream = agent._DataStream(stdout)
+    assert stream.read(7) == b'partial' # Before the error
+    with pytest.raises(agent.AgentError) as E:
+        stream.read(1)
+    assert 'bad list' in str(E.value)
+    stream.drain() # Already over
+    assert agent.read_frame(stdout)['ok'] # Next response
+
+def test_agent_fails_after_hello(tmpdir):
+    """ The agent's file list fails partway so the per-call mode is used """
+    broken = tmpdir.join('broken_PyFiSync.py')
+    broken.write('\n'.join([
+        'import sys',
+        'sys.path.insert(0,{!r})'.format(os.path.dirname(PFS)),
+        'from PyFiSync import cli, agent',
+        "if sys.argv[1:3] == ['_api','serve']:",
+        '    def encode(files,**kwargs):',
+        "        yield b'partial'",
+        "        raise ValueError('broken')",
+        '    agent.listcodec.encode = encode',
+        'cli(sys.argv[1:])']))
+    
+    remote,config,log = _remote(tmpdir,'{} {}'.format(sys.executable,broken))
+    logs = []
+    log.add = lambda txt,**k:logs.append(txt)
+    try:
+        assert remote.agent() is not None
+        files = remote.file_list(['path','size'],empty='store')
+        assert len(files) == 20
+        assert any('broken' in l and 'per-call' in l for l in logs)
+        assert remote.agent() is None # Not tried again
+        
+        remote.apply_queue([{'move':['sub0/file0','new/file0']}])
+        assert tmpdir.join('B','new','file0').exists()
+    finally:
+        remote.close()
+
+@pytest.mark.parametrize('force',[True,False])
+def test_agent_apply_force(tmpdir,monkeypatch,force):
+    """ force reaches the config the queue is applied with (as in _api) """
+    from PyFiSync import main
+    seen = []
+    monkeypatch.setattr(main,'apply_action_queue',
+                        lambda path,queue,log=None:seen.append(main.config.force))
+    agent.HANDLERS['apply_queue']({'path':str(tmpdir),'queue':[],'force':force})
+    assert seen == [force]
+
+@pytest.mark.parametrize('remote_agent',[True,False])
+def test_file_list_delta(tmpdir,remote_agent):
+    """ Only the changes since the last listing are sent """
+    remote,config,log = _remote(tmpdir)
+    config.remote_agent = remote_agent
+    tmpdir.join('A','.PyFiSync').ensure(dir=True)
+    attributes = ['path','size','mtime','ino']
+
+    def save(files,generation):
+        """ As main.reset_tracking """
+        old = tmpdir.join('A','.PyFiSync','filesB.old')
+        old.write(json.dumps(files))
+        st = os.stat(str(old))
+        tmpdir.join('A','.PyFiSync','filesB.gen').write(json.dumps(
+            {'generation':generation,'size':st.st_size,'mtime':st.st_mtime}))
+
+    def direct():
+        files = PFSwalk.file_list(config.pathB,config,log,attributes=attributes,
+                                  empty='store',use_hash_db=False).files()
+        return sorted(files,key=lambda f:f['path'])
+
+    logs = []
+    log.add = logs.append
+    try:
+        files = remote.file_list(attributes,empty='store')
+        assert remote.generation
+        assert not any('changed' in l for l in logs)
+        save(files,remote.generation)
+
+        tmpdir.join('B','sub0','file0').remove()
+        tmpdir.join('B','sub1','file1').write('modified')
+        tmpdir.join('B','new').write('new')
+
+        old_list = json.loads(tmpdir.join('A','.PyFiSync','filesB.old').read())
+        files = remote.file_list(attributes,empty='store')
+        assert sorted(files,key=lambda f:f['path']) == direct()
+        assert 'Received 2 changed and 1 removed files since the last listing' in logs
+        assert remote.old_list == old_list # Kept rather than read again
+        assert not any(new is old for new in files for old in remote.old_list)
+        save(files,remote.generation)
+
+        # The generation is no longer stored on the remote
+        del logs[:]
+        save(files,'20000101000000000000_00000000')
+        files = remote.file_list(attributes,empty='store')
+        assert sorted(files,key=lambda f:f['path']) == direct()
+        assert not any('changed' in l for l in logs)
+
+        # filesB.old is not what was recorded
+        save(files,remote.generation)
+        tmpdir.join('A','.PyFiSync','filesB.old').write(json.dumps(files[1:]))
+        files = remote.file_list(attributes,empty='store')
+        assert sorted(files,key=lambda f:f['path']) == direct()
+        assert not any('changed' in l for l in logs)
+        assert remote.old_list is None
+
+        # Different settings are a different listing
+        save(files,remote.generation)
+        config.excludes = config.excludes + ['file2']
+        files = remote.file_list(attributes,empty='store')
+        assert sorted(files,key=lambda f:f['path']) == direct()
+        assert not any('changed' in l for l in logs)
+        
+        # The changes can't be applied (filesB.old is gone) so get it all
+        generation = remote.generation
+        tmpdir.join('A','.PyFiSync','filesB.old').remove()
+        remote._load_generation = lambda:generation
+        files = remote.file_list(attributes,empty='store')
+        assert sorted(files,key=lambda f:f['path']) == direct()
+        assert any('Getting the full list' in l for l in logs)
+    finally:
+        remote.close()
+
+    listings = tmpdir.join('B','.PyFiSync','listings').listdir()
+    assert len(listings) == agent.KEEP_LISTINGS
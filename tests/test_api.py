@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+The lean `_api` entry point. Run this file directly for a startup-time
+benchmark of the remote modes:
+
+    python test_api.py [repeats]
+"""
+from __future__ import unicode_literals,print_function
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+import pytest
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Child that runs a remote mode and then reports the loaded modules
+CHILD = '''
+import sys, json, atexit
+sys.path.insert(0,{root!r})
+atexit.register(lambda:sys.stderr.write('MODULES' + json.dumps(list(sys.modules))))
+{entry}
+'''
+ENTRIES = {
+    'lean':'import PyFiSync; PyFiSync.cli(["_api"] + sys.argv[1:])',
+    'main':'from PyFiSync import main; main.cli(["_api"] + sys.argv[1:])', # as before
+}
+
+def _run(mode,path,entry='lean'):
+    """ Run the mode on path. Returns (stdout,loaded modules) """
+    stdin = b''
+    args = [mode]
+    if mode == 'file_list':
+        args.append('SENT')
+        remote_config = {'path':path,'excludes':['.PyFiSync/'],'attributes':['path','size'],
+                         'empty':'store','copy_symlinks_as_links':True,
+                         'use_hash_db':False,'format':'stream'}
+        stdin = b'SENT' + json.dumps(remote_config).encode('utf8')
+    elif mode == 'apply_queue':
+        args += ['--no-backup',path,'SENT']
+        stdin = b'SENT[]'
+    # serve: exits on EOF
+    
+    code = CHILD.format(root=ROOT,entry=ENTRIES[entry])
+    proc = subprocess.Popen([sys.executable,'-c',code] + args,stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    out,err = proc.communicate(stdin)
+    assert proc.returncode == 0, err
+    modules = json.loads(err.decode('utf8').split('MODULES')[-1])
+    return out,set(modules)
+
+@pytest.mark.parametrize('mode',['file_list','apply_queue','serve'])
+def test_lean_imports(tmpdir,mode):
+    tmpdir.join('file').write('file')
+    out,modules = _run(mode,str(tmpdir))
+    
+    assert 'PyFiSync.api' in modules
+    if mode != 'apply_queue': # Needs main to apply the actions
+        assert not modules & {'PyFiSync.main','PyFiSync.remote_interfaces','numpy'}
+    
+    if mode == 'file_list':
+        assert out.startswith(b'SENT')
+    if mode == 'apply_queue':
+        assert b'<<<<<<<END' in out
+
+def test_unknown_mode():
+    proc = subprocess.Popen([sys.executable,os.path.join(ROOT,'PyFiSync.py'),'_api','nope'],
+                            stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    out,err = proc.communicate()
+    assert proc.returncode == 2
+    assert b'nope' in err
+
+# Remote programs. The old one is from before --backup-method was added
+REMOTE = '''
+import sys, getopt
+sys.path.insert(0,{root!r})
+if {old!r}:
+    try:
+        getopt.getopt(sys.argv[3:],"",['force','no-backup'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        sys.exit(2)
+import PyFiSync; PyFiSync.cli(sys.argv[1:])
+'''
+
+@pytest.mark.parametrize('old',[False,True])
+def test_apply_queue_backup_method(tmpdir,old):
+    from PyFiSync import utils
+    from PyFiSync import remote_interfaces
+    
+    class LocalRemote(remote_interfaces.ssh_rsync):
+        def _ssh_cmd(self,remote):
+            return ['sh','-c',remote]
+    
+    script = tmpdir.join('remote.py')
+    script.write(REMOTE.format(root=ROOT,old=old))
+    
+    config = utils.configparser(remote='rsync')
+    config.pathA = str(tmpdir.join('A'))
+    config.pathB = str(tmpdir.join('B'))
+    config.persistant = False
+    config.remote_agent = False
+    config.userhost = 'user@host'
+    config.remote_exe = '{} {}'.format(sys.executable,script)
+    config.backup_method = 'hardlink'
+    tmpdir.join('B','file1').write('1',ensure=True)
+    tmpdir.join('B','file2').write('2',ensure=True)
+    
+    logs = []
+    log = utils.logger(silent=True)
+    log.add = lambda txt,**k:logs.append(txt)
+    remote = LocalRemote(config,log)
+    
+    remote.apply_queue([{'backup':'file1'}])
+    remote.apply_queue([{'backup':'file2'}])
+    
+    backups = tmpdir.join('B','.PyFiSync','backups')
+    for name in ['file1','file2']:
+        backup, = backups.visit(name) # May be in different directories
+        assert backup.read() == tmpdir.join('B',name).read()
+        linked = os.stat(str(tmpdir.join('B',name))).st_nlink == 2
+        assert linked != old # Still backed up without the option
+    
+    warned = [l for l in logs if 'does not support' in l]
+    assert len(warned) == (1 if old else 0) # Only tried once
+
+def benchmark(repeats=10):
+    import tempfile
+    import shutil
+    
+    path = tempfile.mkdtemp()
+    try:
+        for ii in range(100):
+            with open(os.path.join(path,'file{}'.format(ii)),'w') as F:
+                F.write('file')
+        
+        print('{:12s} {:>10s} {:>10s}'.format('mode','main (s)','lean (s)'))
+        for mode in ['file_list','apply_queue','serve']:
+            best = {}
+            for entry in ['main','lean']:
+                times = []
+                for _ in range(repeats):
+                    t0 = time.time()
+                    _run(mode,path,entry=entry)
+                    times.append(time.time() - t0)
+                best[entry] = min(times)
+            print('{:12s} {main:10.3f} {lean:10.3f}'.format(mode,**best))
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    benchmark(*[int(a) for a in sys.argv[1:]])
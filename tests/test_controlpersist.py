@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+The shared SSH control socket (ssh_control_persist). These do not need an
+SSH server
+"""
+from __future__ import unicode_literals,print_function
+
+import os
+import socket
+
+import pytest
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync import utils
+from PyFiSync import remote_interfaces
+
+def _config(**kw):
+    config = utils.configparser(remote='rsync')
+    config.userhost = kw.get('userhost','user@example.com')
+    config.ssh_port = kw.get('ssh_port',22)
+    return config
+
+def test_control_path(tmpdir,monkeypatch):
+    monkeypatch.setattr(remote_interfaces.tempfile,'gettempdir',lambda:str(tmpdir))
+    path = remote_interfaces._control_path(_config())
+    assert path is not None
+
+    # Stable per host and port and short enough for a socket
+    assert path == remote_interfaces._control_path(_config())
+    assert path != remote_interfaces._control_path(_config(ssh_port=2222))
+    assert path != remote_interfaces._control_path(_config(userhost='other@example.com'))
+    assert len(path) < 100
+
+    # Not used if others can write to the directory
+    dirpath = os.path.dirname(path)
+    assert os.stat(dirpath).st_mode & 0o777 == 0o700
+    os.chmod(dirpath,0o777)
+    assert remote_interfaces._control_path(_config()) is None
+
+@pytest.mark.skipif(not hasattr(socket,'AF_UNIX'),reason='No unix sockets')
+def test_remove_stale_socket(tmpdir):
+    path = str(tmpdir.join('sock'))
+    assert remote_interfaces._remove_stale_socket(path) # Nothing there
+
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+    finally:
+        sock.close()
+    assert os.path.exists(path) # Stale: nothing is listening
+    assert remote_interfaces._remove_stale_socket(path)
+    assert not os.path.exists(path)
+
+    # Never remove something that isn't a socket
+    tmpdir.join('sock').write('not a socket')
+    assert not remote_interfaces._remove_stale_socket(path)
+    assert tmpdir.join('sock').read() == 'not a socket'
+
+def test_control_lock(tmpdir):
+    path = str(tmpdir.join('sock'))
+    with remote_interfaces._control_lock(path):
+        pass
+    with remote_interfaces._control_lock(path): # re-acquirable
+        pass
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals,print_function
+
+import pytest #with pytest.raises(ValueError):...
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync.dicttable import DictTable
+
+def _make_files(N=10):
+    return [{'path':'dir/file{}'.format(ii),'ino':ii,'size':ii%3} for ii in range(N)]
+
+def test_update_many():
+    """ update_many should match sequential update() calls """
+    updates = [({'path':'dir/file1'},{'path':'dir/file1.moved'}),
+               ({'path':'dir/file1.moved'},{'path':'dir/file1.again'}), # chained
+               ({'size':2},{'newmod':True}),
+               ({'path':'dir/file3','ino':3},{'size':100})]
+
+    DB1 = DictTable(_make_files())
+    DB2 = DictTable(_make_files())
+
+    for query,updated_dict in updates:
+        DB1.update(updated_dict,query)
+    c0 = DB2._c
+    DB2.update_many(updates)
+    assert DB2._c == c0 + 1
+
+    assert sorted(DB1,key=lambda a:a['ino']) == sorted(DB2,key=lambda a:a['ino'])
+    for attrib in DB1.attributes:
+        assert {k:sorted(v) for k,v in DB1._lookup[attrib].items() if v} \
+            == {k:sorted(v) for k,v in DB2._lookup[attrib].items() if v}
+
+    assert {'path':'dir/file1.again','ino':1} in DB2
+    assert {'path':'dir/file1'} not in DB2
+    assert DB2.query_one(path='dir/file3')['size'] == 100
+
+    with pytest.raises(ValueError):
+        DB2.update_many([({'path':'not/there'},{'size':1})])
+
+def test_remove_many():
+    """ remove_many should match sequential remove() calls """
+    DB = DictTable(_make_files())
+    DB.remove_many([{'path':'dir/file1'},{'path':'dir/file2'},{'size':0}])
+
+    assert len(DB) == 10 - 2 - 4 # size==0: 0,3,6,9
+    assert {'path':'dir/file1'} not in DB
+    assert {'size':0} not in DB
+    assert set(f['ino'] for f in DB) == set([4,5,7,8])
+    assert DB.count(DB.Q.size == 1) == 2
+
+    with pytest.raises(ValueError):
+        DB.remove_many([{'path':'dir/file4'},{'path':'dir/file1'}])
+    assert len(DB) == 4 # Nothing removed
+
+def test_query_cache():
+    """ Cached queries are reused and invalidated on any change """
+    DB = DictTable(_make_files(),cache_size=2)
+    assert DB.query_one(path='dir/file1')['ino'] == 1
+    assert DB.query_one({'path':'dir/file1'})['ino'] == 1
+    assert DB.cache_info()['hits'] == 1
+    assert DB.cache_info()['misses'] == 1
+
+    # Query objects are never cached
+    assert DB.count(DB.Q.size == 2) == 3
+    assert DB.cache_info()['misses'] == 1
+
+    # Mutations invalidate it
+    DB.update({'path':'dir/file1.new'},path='dir/file1')
+    assert DB.query_one(path='dir/file1') is None
+    assert DB.query_one(path='dir/file1.new')['ino'] == 1
+    DB.remove(path='dir/file2')
+    assert DB.count(size=2) == 2
+
+    # Bounded LRU
+    DB.query_one(path='dir/file3')
+    DB.query_one(path='dir/file4')
+    DB.query_one(path='dir/file3')
+    DB.query_one(path='dir/file5') # evicts file4
+    assert DB.cache_info()['size'] == 2
+    hits = DB.cache_info()['hits']
+    DB.query_one(path='dir/file3')
+    assert DB.cache_info()['hits'] == hits + 1
+    DB.query_one(path='dir/file4')
+    assert DB.cache_info()['hits'] == hits + 1
+
+    # Off by default
+    DB = DictTable(_make_files())
+    DB.query_one(path='dir/file1')
+    DB.query_one(path='dir/file1')
+    assert DB.cache_info() == {'hits':0,'misses':0,'size':0,'cache_size':0}
+
+def _lookups(DB):
+    # Replace the empty placeholder since it is only equal by identity
+    return {attrib:{('EMPTY' if k is DB._empty else k):sorted(v) 
+                    for k,v in DB._lookup[attrib].items() if v} 
+            for attrib in DB.attributes}
+
+def test_bulk_and_columns():
+    """ Bulk and column-wise construction should match add() """
+    files = _make_files()
+    files[3]['tags'] = ['a','b']
+    files[4]['tags'] = []
+    
+    DB1 = DictTable()
+    for file in files:
+        DB1.add(file)
+    DB2 = DictTable(files)
+    assert _lookups(DB1) == _lookups(DB2)
+    assert {'tags':'a'} in DB2
+    assert DB2.query_one(tags=[])['ino'] == 4
+
+    columns = {'path':[f['path'] for f in files],
+               'ino':[f['ino'] for f in files],
+               'size':[f['size'] for f in files]}
+    DB3 = DictTable.from_columns(columns,fixed_attributes=['path','ino'])
+    assert DB3.attributes == ['path','ino']
+    assert list(DB3) == _make_files()
+    assert DB3.query_one(path='dir/file5')['size'] == 2
+    assert {'size':2} not in DB3 # Not indexed
+
+    with pytest.raises(ValueError):
+        DictTable.from_columns({'path':['a','b'],'ino':[1]})
+
+def test_fixed_attribute_no_duplicates():
+    DB = DictTable(_make_files(),fixed_attributes=['path'])
+    DB.add_fixed_attribute('size')
+    DB.add_fixed_attribute('size')
+    assert DB.attributes == ['path','size']
+    DB.update({'size':10},path='dir/file1')
+    assert DB.query_one(size=1,path='dir/file1') is None
+
+def test_save_load(tmpdir):
+    files = _make_files()
+    files[4]['tags'] = []
+    DB = DictTable(files,fixed_attributes=['path','size','tags'])
+    DB.remove(path='dir/file2')
+    
+    path = str(tmpdir.join('db.pkl'))
+    DB.save(path)
+    DB2 = DictTable.load(path)
+    
+    assert _lookups(DB) == _lookups(DB2)
+    assert list(DB) == list(DB2)
+    assert len(DB2) == 9
+    assert DB2.query_one(tags=[])['ino'] == 4
+    
+    # Still fully functional
+    DB2.update({'path':'new'},path='dir/file1')
+    assert DB2.query_one(path='new')['ino'] == 1
+    DB2.add({'path':'another','size':0})
+    assert DB2.count(size=0) == 5
+
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""
+Compare the reconciliation engines on random synthetic file lists. The
+decisions (queues, transfers, and final file lists) must be identical to the
+pure-python engine.
+"""
+from __future__ import unicode_literals,print_function
+
+import random
+import copy
+import json
+
+import pytest
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync import main
+from PyFiSync import utils
+from PyFiSync import extengine
+from PyFiSync import parengine
+from PyFiSync.dicttable import DictTable
+
+def _scenario(seed,N=200):
+    """ Return Aold,Bold,A,B lists with moves, deletes, mods, and new files """
+    R = random.Random(seed)
+    Aold = []
+    for ii in range(N):
+        dirname = 'd{}/s{}'.format(R.randint(0,5),R.randint(0,3))
+        Aold.append({'path':'{}/f{}.txt'.format(dirname,ii),'ino':1000+ii,
+                     'size':R.randint(0,50),'mtime':1000.0+R.randint(0,100),
+                     'birthtime':1.0*ii})
+        if ii % 10 == 0: # Existing conflict-tag names
+            for jj,name in enumerate(['machineA','machineB','machineA.1']):
+                Aold.append({'path':'{}/f{}.{}.txt'.format(dirname,ii,name),
+                             'ino':10**6 + 10*ii + jj,'size':0,
+                             'mtime':1000.0,'birthtime':1e6 + 10*ii + jj})
+    Bold = []
+    for file in Aold:
+        file = dict(file)
+        file['ino'] += 100000
+        if R.random() < 0.03: # Did not agree after the last run (failed transfer)
+            file['mtime'] += 50
+        Bold.append(file)
+
+    inodes = [500000]
+    def mutate(files,side):
+        files = copy.deepcopy(files)
+        if R.random() < 0.5: # Rename a whole directory
+            src = 'd{}/'.format(R.randint(0,5))
+            dst = 'moved{}{}/'.format(side,R.randint(0,2))
+            for file in files:
+                if file['path'].startswith(src):
+                    file['path'] = dst + file['path'][len(src):]
+        if R.random() < 0.3: # Delete a whole directory
+            dirname = 'd{}/s{}/'.format(R.randint(0,5),R.randint(0,3))
+            files = [f for f in files if not f['path'].startswith(dirname)]
+        out = []
+        for file in files:
+            r = R.random()
+            if r < 0.05:
+                continue
+            if r < 0.10:
+                file['path'] = file['path'].replace('.txt','.mv{}.txt'.format(side))
+            elif r < 0.15:
+                file['mtime'] = 5000.0 + R.randint(0,100)
+                file['size'] += 1
+            elif r < 0.17: # Same move on both sides (possible conflict)
+                file['path'] = file['path'].replace('.txt','.mv.txt')
+                file['mtime'] = 5000.0
+            out.append(file)
+        for _ in range(R.randint(0,10)):
+            inodes[0] += 1
+            out.append({'path':'new/{}.txt'.format(R.randint(0,20)),
+                        'ino':inodes[0],'size':1,'mtime':5000.0+R.randint(0,3),
+                        'birthtime':9e9+inodes[0]})
+        return list(dict((f['path'],f) for f in out).values()) # unique paths
+
+    return Aold,Bold,mutate(Aold,'A'),mutate(Bold,'B')
+
+def _run(seed,mode,engine=None,all_paths=False,external=False,collapse=False,
+         dups=False):
+    Aold,Bold,A,B = _scenario(seed)
+    if dups: # Many files share the move attributes (e.g. hardlinks)
+        for file in Aold + Bold + A + B:
+            file['ino'] //= 3
+            file['birthtime'] = 0.0
+
+    config = utils.configparser(remote='rsync')
+    config.move_attributesA = ['ino','birthtime']
+    config.move_attributesB = ['ino','birthtime']
+    config.mod_conflict = mode
+    config.last_run = 3000.0
+    main.config = config
+    main.log = utils.logger(silent=True)
+
+    if external:
+        N = len(A)
+        recon = extengine.Reconciler(config,memory_mb=0.01) # Many runs
+        for AB,files,old in [('A',A,False),('B',B,False),('A',Aold,True),('B',Bold,True)]:
+            recon.add_files(AB,files,old=old)
+        try:
+            A,B,Aold,Bold = recon.reduce()
+        finally:
+            recon.close()
+        assert len(A) < N # Actually reduced
+        filesA,filesB,filesA_old,filesB_old = [DictTable(L) for L in (A,B,Aold,Bold)]
+    else:
+        filesA,filesB,filesA_old,filesB_old = [DictTable(L) for L in (A,B,Aold,Bold)]
+        main.file_track(filesA_old,filesA,config.prev_attributesA,
+                        config.move_attributesA,engine=engine)
+        main.file_track(filesB_old,filesB,config.prev_attributesB,
+                        config.move_attributesB,engine=engine)
+
+    mqA,mqB = main.compare_queue_moves(filesA,filesB,filesA_old,filesB_old)
+    if collapse:
+        mqA = main.collapse_dir_deletes(filesA,main.collapse_dir_moves(filesA,mqA))
+        mqB = main.collapse_dir_deletes(filesB,main.collapse_dir_moves(filesB,mqB))
+        before = [set(f['path'] for f in files) for files in (filesA,filesB)]
+    mqA = main.apply_move_queues_theoretical(filesA,mqA,AB='A')
+    mqB = main.apply_move_queues_theoretical(filesB,mqB,AB='B')
+
+    paths = None
+    if engine is not None:
+        paths = engine.transfer_candidates(filesA,filesB,
+                    config.mod_attributes,config.mod_resolution)
+    if all_paths:
+        paths = set(f['path'] for f in filesA) | set(f['path'] for f in filesB)
+    aqA,aqB,tA,tB = main.determine_file_transfers(filesA,filesB,paths=paths)
+
+    # Order may differ between engines. The decisions may not
+    key = lambda a:json.dumps(a,sort_keys=True)
+    res = {'mqA':sorted(mqA,key=key),'mqB':sorted(mqB,key=key),
+           'aqA':sorted(aqA,key=key),'aqB':sorted(aqB,key=key),
+           'tA':sorted(tA),'tB':sorted(tB)}
+    if not external: # Only has the changes
+        res['A'] = sorted(filesA,key=key)
+        res['B'] = sorted(filesB,key=key)
+    if collapse:
+        res['before'] = before
+    return res
+
+def _decisions(res):
+    return {k:v for k,v in res.items() if k not in 'AB'}
+
+@pytest.mark.parametrize("mode",['both','A','newer_tag'])
+def test_transfer_candidates(mode):
+    """ Only looking at the candidates must match looking at every path """
+    for seed in range(10):
+        assert _run(seed,mode) == _run(seed,mode,all_paths=True)
+
+def _expand(queue,files,full_queue):
+    """ 
+    Replace the directory moves with the moves of the files in them and the
+    directory deletes with the deletions (from full_queue) in them
+    """
+    out = []
+    for action in queue:
+        if 'movedir' in action:
+            src,dest,names = action['movedir']
+            assert sorted(names) == sorted(path[len(src)+1:] for path in files 
+                                           if path.startswith(src + '/'))
+            for name in sorted(names):
+                out.append({'move':[src + '/' + name,dest + '/' + name]})
+        elif 'deletedir' in action:
+            dirpath,names = action['deletedir']
+            dirpath += '/'
+            assert not any(path.startswith(dirpath) for path in files)
+            deletes = [a for a in full_queue if a.get('delete','').startswith(dirpath)]
+            assert deletes
+            assert sorted(names) == sorted(a['delete'][len(dirpath):] for a in deletes)
+            out.extend(deletes)
+        else:
+            out.append(action)
+    return out
+
+@pytest.mark.parametrize("mode",['both','A','newer_tag'])
+def test_collapse_dirs(mode):
+    """ Collapsing directory moves and deletes must not change anything else """
+    ndirs = 0
+    for seed in range(20):
+        full = _run(seed,mode)
+        collapsed = _run(seed,mode,collapse=True)
+        
+        # Same files at the end (and transfers)
+        for key in ['A','B','aqA','aqB','tA','tB']:
+            assert full[key] == collapsed[key]
+        
+        # Same moves once directories are expanded
+        key = lambda a:json.dumps(a,sort_keys=True)
+        for q,paths in zip(['mqA','mqB'],collapsed['before']):
+            ndirs += sum('movedir' in a or 'deletedir' in a for a in collapsed[q])
+            assert full[q] == sorted(_expand(collapsed[q],paths,full[q]),key=key)
+    assert ndirs > 0 # Actually tested
+
+@pytest.mark.parametrize("mode",['both','A','newer_tag'])
+def test_numpy_engine(mode):
+    npengine = pytest.importorskip('PyFiSync.npengine')
+    if not npengine.AVAILABLE:
+        pytest.skip('numpy not installed')
+
+    for seed in range(10):
+        assert _run(seed,mode) == _run(seed,mode,engine=npengine)
+
+@pytest.mark.parametrize("mode",['both','A','newer_tag'])
+def test_external_engine(mode):
+    for seed in range(10):
+        assert _decisions(_run(seed,mode)) == _run(seed,mode,external=True)
+
+@pytest.mark.skipif(not parengine.AVAILABLE,reason='Cannot fork')
+@pytest.mark.parametrize("mode",['both','A','newer_tag'])
+def test_parallel_engine(mode):
+    for seed in range(5):
+        serial = _run(seed,mode)
+        assert serial == _run(seed,mode,engine=parengine.Engine(processes=2))
+        assert serial == _run(seed,mode,engine=parengine.Engine(processes=3))
+
+@pytest.mark.parametrize("mode",['both','A','newer_tag'])
+def test_engines_ambiguous(mode):
+    """ 
+    Files that match more than one old file must be resolved the same way by
+    every engine
+    """
+    engines = []
+    if parengine.AVAILABLE:
+        engines.append(parengine.Engine(processes=2))
+    try:
+        from PyFiSync import npengine
+    except ImportError:
+        npengine = None
+    if npengine is not None and npengine.AVAILABLE:
+        engines.append(npengine)
+    
+    for seed in range(5):
+        serial = _run(seed,mode,dups=True)
+        assert _decisions(serial) == _run(seed,mode,external=True,dups=True)
+        for engine in engines:
+            assert serial == _run(seed,mode,engine=engine,dups=True)
+
+@pytest.mark.skipif(not parengine.AVAILABLE,reason='Cannot fork')
+def test_parallel_engine_ambiguous():
+    """ More than one matching old file must pick the same as the serial """
+    def track(engine):
+        old = [{'path':'a{}'.format(ii),'ino':ii % 3,'mtime':1} for ii in range(12)]
+        new = [{'path':'b{}'.format(ii),'ino':ii,'mtime':1} for ii in range(3)]
+        files_old,files_new = DictTable(old),DictTable(new)
+        main.file_track(files_old,files_new,['path'],['ino'],engine=engine)
+        return list(files_new),list(files_old)
+    assert track(None) == track(parengine.Engine(processes=2))
+
+def test_external_sort(tmpdir):
+    items = [(ii,{'v':(ii*7919) % 101}) for ii in range(1000)]
+    key = extengine.keyfunc(['v'])
+    out = list(extengine.external_sort(items,key,50,str(tmpdir)))
+    assert [o[2]['v'] for o in out] == sorted(i['v'] for _,i in items)
+    assert [o[1] for o in out] == sorted(range(1000),key=lambda ii:(items[ii][1]['v'],ii))
+    assert tmpdir.listdir() == [] # runs cleaned up
+
+def test_tag_sources():
+    names = ['machineA']
+    assert extengine.tag_sources('d/f.machineA.txt',names) == set(['d/f.txt'])
+    assert extengine.tag_sources('d/f.machineA.2.txt',names) == set(['d/f.txt'])
+    assert extengine.tag_sources('d/f.machineA',names) == set(['d/f'])
+    assert extengine.tag_sources('d/f.machineA.2',names) == set(['d/f','d/f.2'])
+    assert extengine.tag_sources('d/f.machineAB.txt',names) == set()
+    assert extengine.tag_sources('d/f.txt',names) == set()
+
+def test_numpy_engine_fallback():
+    """ Unsupported lists must fall back to python and not modify anything """
+    npengine = pytest.importorskip('PyFiSync.npengine')
+    if not npengine.AVAILABLE:
+        pytest.skip('numpy not installed')
+
+    files_old = DictTable([{'path':'a','ino':1,'mtime':1,'tags':['x']}])
+    files_new = DictTable([{'path':'b','ino':1,'mtime':1,'tags':['x']}])
+    with pytest.raises(npengine.Unsupported):
+        npengine.file_track(files_old,files_new,['path','tags'],['ino'])
+
+    main.file_track(files_old,files_new,['path','tags'],['ino'],engine=npengine)
+    file = files_new.query_one(path='b')
+    assert file['moved'] and file['prev_path'] == 'a'
+
+    with pytest.raises(npengine.Unsupported):
+        npengine.transfer_candidates(DictTable([{'path':'a'},{'path':'a'}]),
+                                     DictTable(),[['mtime','mtime']],1)
+
+if __name__ == '__main__':
+    test_transfer_candidates('both')
+    test_numpy_engine('both')
+    test_external_engine('both')
+    test_parallel_engine('both')
+    test_numpy_engine_fallback()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals,print_function
+
+import pytest #with pytest.raises(ValueError):...
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+import sys
+import json
+import pickle
+
+from PyFiSync.filerecord import FileRecord, json_default, object_hook
+from PyFiSync.dicttable import DictTable
+
+def test_dict_behavior():
+    file = {'path':'some/dir/file.txt','ino':1,'size':10,'mtime':1.5,'sha1':'abc'}
+    rec = FileRecord(file)
+    
+    assert rec == file
+    assert dict(rec) == file
+    assert rec['path'] == 'some/dir/file.txt'
+    assert rec.get('birthtime') is None
+    assert 'birthtime' not in rec
+    assert 'sha1' in rec
+    with pytest.raises(KeyError):
+        rec['birthtime']
+    
+    rec['prev_path'] = rec['path']
+    rec['path'] = 'other/file.txt'
+    assert rec['prev_path'] == 'some/dir/file.txt'
+    assert rec['path'] == 'other/file.txt'
+    
+    rec.update({'new':True,'md5':'xyz'})
+    assert rec['new'] and rec['md5'] == 'xyz'
+    del rec['md5']
+    assert 'md5' not in rec
+    
+    # Top level
+    assert FileRecord(path='file')['path'] == 'file'
+    
+    # '{path}'.format(**rec)
+    assert '{path}:{size}'.format(**rec) == 'other/file.txt:10'
+
+def test_shared_dirs():
+    rec1 = FileRecord(path='a/long/directory/name/file1')
+    rec2 = FileRecord(path='a/long/directory/name/file2')
+    assert rec1._dir is rec2._dir
+    
+    # Interned by python (not kept alive by a module-level cache)
+    if sys.version_info[0] > 2:
+        assert rec1._dir is sys.intern('a/long/directory/' + 'name')
+
+def test_serialize():
+    recs = [FileRecord(path='d/f{}'.format(ii),ino=ii,size=ii) for ii in range(5)]
+    txt = json.dumps(recs,default=json_default)
+    assert json.loads(txt) == recs
+    recs2 = json.loads(txt,object_hook=object_hook)
+    assert all(isinstance(rec,FileRecord) for rec in recs2)
+    assert recs2 == recs
+    
+    recs3 = pickle.loads(pickle.dumps(recs))
+    assert recs3 == recs
+
+def test_in_dicttable():
+    recs = [FileRecord(path='d/f{}'.format(ii),ino=ii,size=ii%2) for ii in range(5)]
+    DB = DictTable(recs)
+    assert DB.attributes == ['ino','path','size']
+    assert DB.count(size=1) == 2
+    DB.update({'path':'d/moved'},path='d/f1')
+    assert DB.query_one(path='d/moved')['ino'] == 1
+    assert DB.query_one(path='d/f1') is None
+
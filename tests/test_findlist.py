@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+The GNU find remote lister must give the same list as PFSwalk. ssh is
+replaced by running the remote command with sh
+"""
+from __future__ import unicode_literals,print_function
+
+import os
+import sys
+import json
+
+import pytest
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync import utils
+from PyFiSync import PFSwalk
+from PyFiSync import findlist
+from PyFiSync import remote_interfaces
+
+class LocalRemote(remote_interfaces.ssh_rsync):
+    """ ssh_rsync where "B" is run locally without ssh """
+    def _ssh_cmd(self,remote):
+        return ['sh','-c',remote]
+
+def _tree(tmpdir):
+    B = tmpdir.join('B')
+    for path in ['file.txt','skip.tmp','sub/file.txt','sub/deep/file.dat',
+                 'sub/deep/skip.tmp','excl/file.txt','sub/excl/file.txt',
+                 'full/excl/file','keep/full/excl/file','back\\slash',
+                 'linked/file1','linked/sub/file2','.PyFiSync/hash_db.json',
+                 'spa ce/it\'s "quoted".txt','unicodé/fïle']:
+        B.join(path).write(path,ensure=True)
+    B.join('emptydir').ensure(dir=True)
+    B.join('onlyexcl','skip.tmp').write('',ensure=True)
+    os.symlink('file.txt',str(B.join('filelink')))
+    os.symlink('../linked',str(B.join('sub','dirlink')))
+    os.symlink(str(tmpdir.join('other')),str(B.join('linked','sub','otherlink'))) # two levels
+    tmpdir.join('other','deep','file.dat').write('other',ensure=True)
+    os.symlink('nowhere',str(B.join('broken')))
+    return B
+
+@pytest.mark.skipif(os.system('find / -maxdepth 0 -printf "" 2>/dev/null'),
+                    reason='needs GNU find')
+@pytest.mark.parametrize('links',[True,False])
+def test_find_lister(tmpdir,links):
+    B = _tree(tmpdir)
+    tmpdir.join('A','.PyFiSync').ensure(dir=True)
+
+    config = utils.configparser(remote='rsync')
+    config.pathA = str(tmpdir.join('A'))
+    config.pathB = str(B)
+    config.persistant = False
+    config.remote_lister = 'find'
+    config.copy_symlinks_as_links = links
+    config.excludes += ['*.tmp','excl/','/full/excl/','back\\slash','/unicodé/fïle']
+    log = utils.logger(silent=True)
+    remote = LocalRemote(config,log)
+
+    files = remote.file_list(['path','ino','size','mtime'],empty='store')
+    walker = PFSwalk.file_list(config.pathB,config,log,empty='store',use_hash_db=False)
+    direct = walker.files()
+
+    key = lambda f:f['path']
+    assert sorted(files,key=key) == sorted(direct,key=key)
+    assert any(f['path'] == 'sub/dirlink/sub/otherlink/deep/file.dat' for f in files)
+    assert not any('excl' in f['path'] for f in files)
+    
+    empties = json.loads(tmpdir.join('A','.PyFiSync','empty_dirsB').read())
+    assert set(empties) == set(os.path.relpath(e,config.pathB) for e in walker.empties)
+    assert set(empties) >= {'emptydir','onlyexcl'}
+
+    # Only remove new empty directories
+    B.join('sub','deep','file.dat').remove()
+    B.join('sub','deep','skip.tmp').remove()
+    files = remote.file_list(['path','ino','size','mtime'],empty='remove')
+    assert not B.join('sub','deep').exists()
+    assert B.join('emptydir').exists()
+
+def test_split_excludes():
+    dirs,files,others = findlist.split_excludes(['a/','/b/c/','*.x','/d/*.y','e\\f','g/h'])
+    assert dirs == [['-name','a'],['-path','./b/c']]
+    assert files == [['-name','*.x'],['-path','./d/*.y']]
+    assert others == ['e\\f']
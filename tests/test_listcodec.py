@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals,print_function
+
+import pytest #with pytest.raises(ValueError):...
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+import io
+import json
+import zlib
+
+from PyFiSync import listcodec
+from PyFiSync.filerecord import FileRecord, object_hook
+
+def _files():
+    files = []
+    for ii in range(100):
+        files.append({'path':'dir{}/sub/fïle{}.txt'.format(ii % 7,ii),'ino':1000+ii,
+                      'size':ii**5,'mtime':1.6e9 + ii/7.0,'birthtime':0.0,
+                      'sha1':'{:040x}'.format(ii)})
+    # Irregular: missing, extra, and different types
+    files[10].pop('sha1')
+    files[20]['new'] = True
+    files[30]['size'] = 3.5
+    files[40]['ino'] = -5
+    files[50]['size'] = 2**70
+    files.append({'path':'a'*500,'ino':1,'size':1,'mtime':1.0,'birthtime':0.0,'sha1':''})
+    return files
+
+@pytest.mark.parametrize('level,block_records',[(0,1),(6,7),(9,4096)])
+def test_roundtrip(level,block_records):
+    files = _files()
+    stream = io.BytesIO()
+    listcodec.dump(files,stream,level=level,block_records=block_records)
+    stream.seek(0)
+
+    decoded = list(listcodec.decode(stream))
+    assert decoded == sorted(files,key=lambda f:f['path'])
+    assert stream.read() == b'' # Read exactly to the end
+
+def test_compact():
+    files = _files()
+    data = b''.join(listcodec.encode(files,level=0))
+    assert len(data) < len(json.dumps(files).encode('utf8'))/2
+
+    data = b''.join(listcodec.encode(files,level=9))
+    assert len(data) < len(zlib.compress(json.dumps(files).encode('utf8'),9))
+
+def test_incremental():
+    """Files are decoded block-by-block as they are read"""
+    files = _files()
+    stream = io.BytesIO(b''.join(listcodec.encode(files,block_records=10)))
+    decoder = listcodec.decode(stream,object_hook=object_hook)
+    first = next(decoder)
+    assert isinstance(first,FileRecord)
+    assert 0 < stream.tell() < len(stream.getvalue())
+    assert len(list(decoder)) == len(files) - 1
+
+def test_empty_and_errors():
+    stream = io.BytesIO(b''.join(listcodec.encode([])))
+    assert list(listcodec.decode(stream)) == []
+
+    with pytest.raises(ValueError):
+        list(listcodec.decode(io.BytesIO(b'not a list')))
+
+    data = b''.join(listcodec.encode(_files()))
+    with pytest.raises(ValueError):
+        list(listcodec.decode(io.BytesIO(data[:-20]))) # truncated
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals,print_function
+
+import os
+import errno
+
+import pytest
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync import localcopy
+
+def test_copy_file(tmpdir):
+    src,dst = tmpdir.join('src'),tmpdir.join('dst')
+    src.write('new'*1000)
+    os.chmod(str(src),0o640)
+    os.utime(str(src),(1e9,1e9 + 0.123456789))
+    
+    dst.write('old')
+    tmpdir.join('backup').mklinkto(dst) # As a hardlink backup
+    
+    st = localcopy.copy_file(str(src),str(dst))
+    assert (st.st_ino,st.st_size) == (os.lstat(str(dst)).st_ino,3000)
+    assert dst.read() == 'new'*1000
+    assert tmpdir.join('backup').read() == 'old' # Replaced, not modified
+    assert st.st_mode & 0o777 == 0o640
+    assert st.st_mtime == os.stat(str(src)).st_mtime
+    assert sorted(p.basename for p in tmpdir.listdir()) == ['backup','dst','src'] # No temp files
+
+@pytest.mark.parametrize('follow',[True,False])
+def test_copy_links(tmpdir,follow):
+    tmpdir.join('target').write('target')
+    os.symlink('target',str(tmpdir.join('link')))
+    tmpdir.join('dest').ensure(dir=True)
+    
+    localcopy.copy_file(str(tmpdir.join('link')),str(tmpdir.join('dest','link')),
+                        follow_symlinks=follow)
+    assert os.path.islink(str(tmpdir.join('dest','link'))) != follow
+    if follow:
+        assert tmpdir.join('dest','link').read() == 'target'
+    else:
+        assert os.readlink(str(tmpdir.join('dest','link'))) == 'target'
+
+def test_copy_files(tmpdir):
+    src,dst = tmpdir.join('src'),tmpdir.join('dst')
+    paths = ['file{}'.format(ii) if ii % 2 else 'sub/dir{}/file{}'.format(ii % 3,ii)
+             for ii in range(50)]
+    for ii,path in enumerate(paths):
+        src.join(path).write('x'*ii,ensure=True)
+    dst.ensure(dir=True)
+    
+    results = list(localcopy.copy_files(paths + ['missing'],str(src),str(dst),threads=4))
+    errors = [path for path,record,error in results if error]
+    assert errors == ['missing']
+    
+    records = dict((path,record) for path,record,error in results if not error)
+    assert sorted(records) == sorted(paths)
+    for ii,path in enumerate(paths):
+        st = os.lstat(str(dst.join(path)))
+        assert records[path] == {'path':path,'size':ii,'mtime':st.st_mtime,'ino':st.st_ino}
+        assert st.st_mtime == os.stat(str(src.join(path))).st_mtime
+
+def test_fallback(tmpdir,monkeypatch):
+    """ A method that is not supported is dropped """
+    def unsupported(*args):
+        raise OSError(errno.EXDEV,'Cross-device link')
+    monkeypatch.setattr(localcopy,'_METHODS',['copy_file_range','sendfile'])
+    monkeypatch.setattr(localcopy.os,'copy_file_range',unsupported,raising=False)
+    monkeypatch.setattr(localcopy.os,'sendfile',unsupported,raising=False)
+    
+    tmpdir.join('src').write('data'*10000)
+    localcopy.copy_file(str(tmpdir.join('src')),str(tmpdir.join('dst')))
+    assert tmpdir.join('dst').read() == 'data'*10000
+    assert localcopy._METHODS == []
+
+def test_copy_files_dirs(tmpdir):
+    """ Made directories get the source's metadata. Failures are per path """
+    src,dst = tmpdir.join('src'),tmpdir.join('dst')
+    paths = ['new/sub/file','new/other','blocked/file','file']
+    for path in paths:
+        src.join(path).write(path,ensure=True)
+    for dirname,mode,mtime in [('new',0o750,1e9 + 0.5),('new/sub',0o700,1.1e9)]:
+        os.chmod(str(src.join(dirname)),mode)
+        os.utime(str(src.join(dirname)),(mtime,mtime))
+    dst.join('blocked').write('a file, not a directory',ensure=True)
+    
+    results = list(localcopy.copy_files(paths,str(src),str(dst),threads=4))
+    errors = sorted(path for path,record,error in results if error)
+    assert errors == ['blocked/file']
+    for path in ['new/sub/file','new/other','file']:
+        assert dst.join(path).read() == path
+    
+    for dirname in ['new','new/sub']:
+        sst,dst_st = os.stat(str(src.join(dirname))),os.stat(str(dst.join(dirname)))
+        assert dst_st.st_mode == sst.st_mode
+        assert dst_st.st_mtime == sst.st_mtime
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+rsync_profile. ssh is replaced by running the remote command locally
+"""
+from __future__ import unicode_literals,print_function
+
+import pytest
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync import utils
+from PyFiSync import remote_interfaces
+
+class LocalRemote(remote_interfaces.ssh_rsync):
+    """ ssh_rsync where "B" is run locally without ssh """
+    def _ssh_cmd(self,remote):
+        return ['sh','-c',remote]
+
+def _remote(tmpdir,profile,userhost='user@host',cls=remote_interfaces.ssh_rsync):
+    config = utils.configparser(remote='rsync')
+    config.pathA = str(tmpdir.join('A'))
+    config.pathB = str(tmpdir.join('B'))
+    config.persistant = False
+    config.userhost = userhost
+    config.rsync_profile = profile
+    logs = []
+    log = utils.logger(silent=True)
+    log.add = logs.append
+    return cls(config,log),logs
+
+@pytest.mark.parametrize('profile',['default','local','lan','wan'])
+def test_profiles(tmpdir,profile):
+    remote,logs = _remote(tmpdir,profile)
+    cmd,B = remote._rsync_cmd()
+    assert cmd.startswith('rsync ' + remote_interfaces.RSYNC_PROFILES[profile] + ' ')
+    assert ('z' in cmd.split()[1]) == (profile in ['default','wan'])
+    assert ('Ciphers=' in cmd) == (profile == 'lan')
+    assert ('--skip-compress' in cmd) == (profile == 'wan')
+    assert ('--whole-file' in cmd) == (profile == 'local')
+    
+    remote._rsync_cmd() # Only logged once
+    assert [l for l in logs if l.startswith('rsync profile:')] == \
+        ['rsync profile: {} (set). Flags: {}'.format(profile,remote_interfaces.RSYNC_PROFILES[profile])]
+
+def test_auto(tmpdir):
+    remote,logs = _remote(tmpdir,'auto',userhost='')
+    assert remote.rsync_profile() == 'local'
+    assert 'B is a local path' in logs[0]
+    
+    remote,logs = _remote(tmpdir,'auto',cls=LocalRemote)
+    rtt,bandwidth = remote._probe(nbytes=1024**2)
+    assert rtt > 0 and bandwidth > 0
+    assert remote.rsync_profile() in ['lan','wan'] # Depends on this machine
+    assert 'round trip' in logs[0]
+    
+    class Unreachable(remote_interfaces.ssh_rsync):
+        def _ssh_cmd(self,remote):
+            return ['sh','-c','exit 255']
+    remote,logs = _remote(tmpdir,'auto',cls=Unreachable)
+    assert remote.rsync_profile() == 'wan'
+    assert 'could not probe' in logs[0]
+
+def test_probe_handshake(tmpdir):
+    """ The time to start the session is not part of the round trip """
+    class SlowStart(remote_interfaces.ssh_rsync):
+        def _ssh_cmd(self,remote):
+            return ['sh','-c','sleep 0.5; ' + remote]
+    
+    remote,logs = _remote(tmpdir,'auto',cls=SlowStart)
+    rtt,bandwidth = remote._probe(nbytes=1024**2)
+    assert rtt < 0.1 # Not 0.5+
+    assert bandwidth > remote_interfaces.LAN_MIN_BANDWIDTH
+
+def test_auto_cache(tmpdir):
+    """ The probed profile is reused for the same host until it expires """
+    tmpdir.join('A','.PyFiSync').ensure(dir=True)
+    probes = []
+    class Probed(LocalRemote):
+        def _probe(self,nbytes=None):
+            probes.append(self.config.userhost)
+            return 1e-4,1e9
+    
+    remote,logs = _remote(tmpdir,'auto',cls=Probed)
+    remote.config.rsync_profile_ttl = 3600
+    assert remote.rsync_profile() == 'lan'
+    
+    remote,logs = _remote(tmpdir,'auto',cls=Probed)
+    remote.config.rsync_profile_ttl = 3600
+    assert remote.rsync_profile() == 'lan'
+    assert 'Probed 0.0 h ago' in logs[0]
+    assert probes == ['user@host']
+    
+    remote,logs = _remote(tmpdir,'auto',userhost='other@host',cls=Probed)
+    remote.config.rsync_profile_ttl = 3600
+    remote.rsync_profile()
+    assert probes == ['user@host','other@host'] # Per host
+    
+    remote,logs = _remote(tmpdir,'auto',cls=Probed)
+    remote.config.rsync_profile_ttl = 0 # Always probe
+    remote.rsync_profile()
+    assert probes == ['user@host','other@host','user@host']
+
+def test_bad_profile(tmpdir):
+    remote,logs = _remote(tmpdir,'nope')
+    with pytest.raises(ValueError):
+        remote._rsync_cmd()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Ordering of the streaming pipeline. The transfers are recorded (not run) to
+check that no file is transferred before the actions on its path are applied
+"""
+from __future__ import unicode_literals,print_function
+
+import os
+import threading
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync import main
+from PyFiSync import utils
+from PyFiSync import streaming
+
+def test_gate():
+    released = []
+    gate = streaming.Gate(lambda d,p:released.append((d,p)))
+
+    gate.hold(['a'])
+    gate.add_action({'move':['b','c']})
+    gate.add_action({'backup':'b'})
+
+    gate.add_transfer('A2B','free')
+    gate.add_transfer('A2B','b')
+    gate.add_transfer('B2A','c')
+    gate.add_transfer('B2A','a')
+    assert released == [('A2B','free')]
+
+    gate.applied({'move':['b','c']})
+    assert released == [('A2B','free'),('B2A','c')] # b still has a backup
+    gate.applied({'backup':'b'})
+    gate.done(['a'])
+    assert released == [('A2B','free'),('B2A','c'),('A2B','b'),('B2A','a')]
+    assert gate.pending == {} and gate.held == {}
+
+def test_gate_dirs():
+    released = []
+    gate = streaming.Gate(lambda d,p:released.append((d,p)))
+    gate.add_action({'movedir':['a','b/c',['f']]})
+    gate.add_action({'backup':'b/c/d/f'})
+    gate.add_transfer('A2B','b/c/d/f')
+    gate.add_transfer('A2B','b/other')
+    assert released == [('A2B','b/other')]
+    
+    gate.applied({'movedir':['a','b/c',['f']]}) # still backup
+    assert released == [('A2B','b/other')]
+    gate.applied({'backup':'b/c/d/f'})
+    assert released == [('A2B','b/other'),('A2B','b/c/d/f')]
+
+class _Recorder(object):
+    """ Record the transfers and whether the actions were applied """
+    def __init__(self,pathA,pathB):
+        self.paths = {'A':pathA,'B':pathB}
+        self.transferred = []
+        self.lock = threading.Lock()
+
+    def transfer_stream(self,paths,A2B,log=None):
+        src = self.paths['A' if A2B else 'B']
+        with self.lock:
+            for path in paths:
+                self.transferred.append(('A2B' if A2B else 'B2A',path,
+                                         os.path.exists(os.path.join(src,path))))
+
+def test_pipeline(tmpdir):
+    config = utils.configparser(remote='rsync')
+    config.pathA = str(tmpdir.join('A'))
+    config.pathB = str(tmpdir.join('B'))
+    main.config = config
+    log = utils.logger(silent=True)
+    main.log = log
+
+    for ii in range(50):
+        tmpdir.join('A','file{}'.format(ii)).write('A',ensure=True)
+        tmpdir.join('B','file{}'.format(ii)).write('B',ensure=True)
+
+    recorder = _Recorder(config.pathA,config.pathB)
+    pipe = streaming.Pipeline(config,log,main.apply_action_queue,recorder,remote=False)
+    pipe.start([{'move':['file0','moved0']}],[])
+
+    # Decide like determine_file_transfers: the transfer is queued before
+    # the action it depends on
+    aqA,aqB,tqA2B,tqB2A = [],[],[],[]
+    tqA2B.append('moved0')
+    for path in pipe.watch(['file{}'.format(ii) for ii in range(1,50)],aqA,aqB,tqA2B,tqB2A):
+        ii = int(path[4:])
+        if ii % 3 == 0: # Conflict ('both')
+            aqA.append({'move':[path,path + '.machineA']})
+            tqA2B.append(path + '.machineA')
+            aqB.append({'move':[path,path + '.machineB']})
+            tqB2A.append(path + '.machineB')
+        else:
+            tqA2B.append(path)
+            aqB.append({'backup':path})
+    pipe.close()
+
+    assert len(recorder.transferred) == 1 + 2*16 + 33
+    assert all(exists for _,_,exists in recorder.transferred) # moved first
+
+    # and backed up before transfer
+    backups = tmpdir.join('B','.PyFiSync','backups').listdir()[0]
+    assert len(backups.listdir()) == 33
+
+def test_pipeline_abort(tmpdir):
+    config = utils.configparser(remote='rsync')
+    config.pathA = str(tmpdir.join('A'))
+    config.pathB = str(tmpdir.join('B'))
+    main.config = config
+    log = utils.logger(silent=True)
+    tmpdir.join('A','file').write('A',ensure=True)
+
+    recorder = _Recorder(config.pathA,config.pathB)
+    pipe = streaming.Pipeline(config,log,main.apply_action_queue,recorder,remote=False)
+    pipe.start([],[])
+    aqA,aqB,tqA2B,tqB2A = [],[],[],[]
+    try:
+        for path in pipe.watch(['file','other'],aqA,aqB,tqA2B,tqB2A):
+            tqA2B.append(path)
+            aqB.append({'backup':path})
+            raise ValueError()
+    except ValueError:
+        pipe.close(abort=True)
+
+    assert recorder.transferred == []
@@ -9,6 +9,7 @@ except (ValueError,ImportError):
 testutils.add_module() # make sure the test are importing the NON-installed version
 
 import PyFiSync
+from PyFiSync import remote_interfaces
 
 import os
 import sys
@@ -1004,6 +1005,441 @@ def test_backups(remote): # Old test 15
     # Finally
     assert len(testutil.compare_tree()) == 0
 
+@pytest.mark.parametrize("remote", remotes)
+def test_streaming_transfer(remote):
+    """ Backups, moves, and conflicts with the streaming transfers """
+    testpath = os.path.join(os.path.abspath(os.path.split(__file__)[0]),
+            'test_dirs','test_streaming_transfer')
+    try:
+        shutil.rmtree(testpath)
+    except:
+        pass
+    os.makedirs(testpath)
+    testutil = testutils.Testutils(testpath=testpath)
+
+    # Init
+    testutil.write('A/fileAm',text='fileAm')
+    testutil.write('A/fileBm',text='fileBm')
+    testutil.write('A/conflict',text='conflict')
+    testutil.write('A/moveA',text='moveA')
+
+    # Randomize Mod times
+    testutil.modtime_all()
+
+    # Start it
+    config = testutil.get_config(remote=remote)
+    config.streaming_transfer = True
+    config.mod_conflict = 'both'
+    testutil.init(config)
+
+    # Apply actions
+    testutil.write('A/fileAm',text='am2',mode='a',time_adj=30)
+    testutil.write('B/fileBm',text='bm2',mode='a',time_adj=30)
+    testutil.write('A/conflict',text='A',mode='a',time_adj=30)
+    testutil.write('B/conflict',text='B',mode='a',time_adj=40)
+    testutil.move('A/moveA','A/sub/moveA')
+    testutil.write('A/sub/new',text='new')
+
+    # Sync
+    testutil.run(config)
+
+    # Backed up before being overwritten
+    bpA = glob(os.path.join(testpath,'A/.PyFiSync/backups/20*/'))[0]
+    assert testutil.read(os.path.join(bpA,'fileBm')) =='fileBm'
+    bpB = glob(os.path.join(testpath,'B/.PyFiSync/backups/20*/'))[0]
+    assert testutil.read(os.path.join(bpB,'fileAm')) =='fileAm'
+
+    assert testutil.read('A/fileAm') =='fileAm\nam2'
+    assert testutil.read('A/fileBm') =='fileBm\nbm2'
+    assert testutil.read('A/conflict.machineA') =='conflict\nA'
+    assert testutil.read('A/conflict.machineB') =='conflict\nB'
+    assert not testutil.exists('B/moveA')
+    assert testutil.read('B/sub/moveA') == 'moveA'
+
+    log_txt = testutil.get_log_txt()
+    assert "Applied queues and transferred (streaming)" in log_txt
+
+    # Finally
+    assert len(testutil.compare_tree()) == 0
+
+@pytest.mark.parametrize("remote", remotes)
+def test_transfer_processes(remote):
+    """ Sharded rsync in both directions at once """
+    testpath = os.path.join(os.path.abspath(os.path.split(__file__)[0]),
+            'test_dirs','test_transfer_processes')
+    try:
+        shutil.rmtree(testpath)
+    except:
+        pass
+    os.makedirs(testpath)
+    testutil = testutils.Testutils(testpath=testpath)
+
+    # Init
+    testutil.write('A/fileAm',text='fileAm')
+    testutil.write('A/fileBm',text='fileBm')
+
+    # Randomize Mod times
+    testutil.modtime_all()
+
+    # Start it
+    config = testutil.get_config(remote=remote)
+    config.transfer_processes = 3
+    testutil.init(config)
+
+    # Apply actions
+    testutil.write('A/fileAm',text='am2',mode='a',time_adj=30)
+    testutil.write('B/fileBm',text='bm2',mode='a',time_adj=30)
+    for ii in range(10):
+        testutil.write('A/sub/newA{}'.format(ii),text='A'*ii)
+        testutil.write('B/sub/newB{}'.format(ii),text='B'*ii)
+
+    # Sync
+    testutil.run(config)
+
+    assert testutil.read('B/fileAm') =='fileAm\nam2'
+    assert testutil.read('A/fileBm') =='fileBm\nbm2'
+    for ii in range(10):
+        assert testutil.read('B/sub/newA{}'.format(ii)) == 'A'*ii
+        assert testutil.read('A/sub/newB{}'.format(ii)) == 'B'*ii
+
+    log_txt = testutil.get_log_txt()
+    assert "Ran rsync A >>> B in 3 processes" in log_txt
+    assert "Ran rsync A <<< B in 3 processes" in log_txt
+    assert log_txt.count('Transfer  sub/newA3') == 1
+
+    # Finally
+    assert len(testutil.compare_tree()) == 0
+
+@pytest.mark.parametrize("remote,symlinks", list(itertools.product(remotes,[True,False])))
+def test_tar_transfer(remote,symlinks):
+    """ Small new files are sent with tar with the mtimes """
+    testpath = os.path.join(os.path.abspath(os.path.split(__file__)[0]),
+            'test_dirs','test_tar_transfer')
+    try:
+        shutil.rmtree(testpath)
+    except:
+        pass
+    os.makedirs(testpath)
+    testutil = testutils.Testutils(testpath=testpath)
+
+    # Init
+    testutil.write('A/small',text='small')
+    testutil.write('A/other/file',text='file')
+
+    # Randomize Mod times
+    testutil.modtime_all()
+
+    # Start it
+    config = testutil.get_config(remote=remote)
+    config.tar_transfer_below = 100
+    config.copy_symlinks_as_links = symlinks
+    testutil.init(config)
+
+    # Apply actions
+    testutil.write('A/small',text='mod',mode='a',time_adj=30) # not new
+    testutil.write('A/big',text='big'*100)
+    for ii in range(5):
+        testutil.write('A/sub/newA{}'.format(ii),text='A'*ii,time_adj=-100*ii)
+        testutil.write('B/sub/deep/newB{}'.format(ii),text='B'*ii,time_adj=-100*ii)
+    os.symlink('../other/file',os.path.join(testpath,'A','sub','link'))
+
+    # Sync
+    testutil.run(config)
+
+    for ii in range(5):
+        assert testutil.read('B/sub/newA{}'.format(ii)) == 'A'*ii
+        assert testutil.read('A/sub/deep/newB{}'.format(ii)) == 'B'*ii
+        for path in ['sub/newA{}'.format(ii),'sub/deep/newB{}'.format(ii)]:
+            mtimes = [os.stat(os.path.join(testpath,AB,path)).st_mtime for AB in 'AB']
+            assert abs(mtimes[0] - mtimes[1]) < 1e-3
+    assert testutil.read('B/small') == 'small\nmod'
+    assert testutil.read('B/big') == 'big'*100
+    assert testutil.read('B/sub/link') == 'file'
+    assert os.path.islink(os.path.join(testpath,'B','sub','link')) == symlinks
+
+    log_txt = testutil.get_log_txt()
+    assert "Sending 6 small new files A >>> B with tar" in log_txt
+    assert "Sending 5 small new files A <<< B with tar" in log_txt
+
+    # Finally
+    assert len(testutil.compare_tree()) == 0
+
+@pytest.mark.parametrize("streaming", [False,True])
+def test_local_copy_engine(streaming):
+    """ Local sync without rsync. Files are replaced (so hardlink backups work) """
+    testpath = os.path.join(os.path.abspath(os.path.split(__file__)[0]),
+            'test_dirs','test_local_copy_engine')
+    try:
+        shutil.rmtree(testpath)
+    except:
+        pass
+    os.makedirs(testpath)
+    testutil = testutils.Testutils(testpath=testpath)
+
+    # Init
+    testutil.write('A/fileAm',text='fileAm')
+    testutil.write('A/fileBm',text='fileBm')
+
+    # Randomize Mod times
+    testutil.modtime_all()
+
+    # Start it
+    config = testutil.get_config(remote=False)
+    config.local_transfer = 'python'
+    config.backup_method = 'hardlink'
+    config.streaming_transfer = streaming
+    testutil.init(config)
+
+    # Apply actions
+    testutil.write('A/fileAm',text='am2',mode='a',time_adj=30)
+    testutil.write('B/fileBm',text='bm2',mode='a',time_adj=30)
+    testutil.write('A/sub/deep/newA',text='newA')
+    testutil.write('B/sub/newB',text='newB')
+
+    # Sync without rsync
+    path0 = os.environ['PATH']
+    os.environ['PATH'] = ''
+    try:
+        testutil.run(config)
+    finally:
+        os.environ['PATH'] = path0
+
+    assert testutil.read('B/fileAm') == 'fileAm\nam2'
+    assert testutil.read('A/fileBm') == 'fileBm\nbm2'
+    assert testutil.read('B/sub/deep/newA') == 'newA'
+    assert testutil.read('A/sub/newB') == 'newB'
+
+    # Backups are the old files
+    bpA = glob(os.path.join(testpath,'A/.PyFiSync/backups/20*/'))[0]
+    assert testutil.read(os.path.join(bpA,'fileBm')) =='fileBm'
+    bpB = glob(os.path.join(testpath,'B/.PyFiSync/backups/20*/'))[0]
+    assert testutil.read(os.path.join(bpB,'fileAm')) =='fileAm'
+
+    log_txt = testutil.get_log_txt()
+    assert "Transfer  sub/deep/newA" in log_txt
+    assert "rsync" not in log_txt.split('Final Transfer')[-1].split('Retrieving')[0]
+
+    # Finally
+    assert len(testutil.compare_tree()) == 0
+
+def test_size_shards():
+    paths = ['f{}'.format(ii) for ii in range(10)]
+    sizes = [100,1,1,1,1,50,50,1,1,1]
+    shards = remote_interfaces._size_shards(paths,sizes,3)
+    assert len(shards) == 3
+    assert sorted(sum(shards,[])) == sorted(paths)
+    assert ['f0'] in shards # The big one is alone
+    
+    assert remote_interfaces._size_shards(['a','b'],[1,2],4) == [['b'],['a']]
+    assert remote_interfaces._size_shards([],[],4) == []
+
+@pytest.mark.parametrize("remote", remotes)
+def test_move_directory(remote):
+    """ Renamed directories are moved with one rename unless they can't be """
+    testpath = os.path.join(os.path.abspath(os.path.split(__file__)[0]),
+            'test_dirs','test_move_directory')
+    try:
+        shutil.rmtree(testpath)
+    except:
+        pass
+    os.makedirs(testpath)
+    testutil = testutils.Testutils(testpath=testpath)
+
+    # Init
+    for ii in range(5):
+        testutil.write('A/dir1/sub/file{}'.format(ii),text='dir1 {}'.format(ii))
+        testutil.write('A/dir2/file{}'.format(ii),text='dir2 {}'.format(ii))
+        testutil.write('A/dir3/file{}'.format(ii),text='dir3 {}'.format(ii))
+
+    # Randomize Mod times
+    testutil.modtime_all()
+
+    # Start it
+    config = testutil.get_config(remote=remote)
+    config.collapse_directories = True
+    config.excludes += ['*.log']
+    testutil.init(config)
+
+    # Apply actions
+    testutil.move('A/dir1','A/new/dir1_moved')
+    testutil.move('A/dir2','A/dir2_moved')
+    testutil.move('A/dir3','A/dir3_moved')
+    testutil.write('B/dir2/newB',text='newB') # So dir2 can't be moved whole
+    testutil.write('B/dir3/x.log',text='log') # Excluded so it must stay
+
+    # Sync
+    testutil.run(config)
+    
+    assert not testutil.exists('B/dir1')
+    assert testutil.read('B/new/dir1_moved/sub/file3') == 'dir1 3'
+    assert testutil.read('A/dir2/newB') == 'newB'
+    assert testutil.read('B/dir2_moved/file3') == 'dir2 3'
+    assert testutil.read('B/dir3/x.log') == 'log'
+    assert not testutil.exists('B/dir3/file3')
+    assert testutil.read('B/dir3_moved/file3') == 'dir3 3'
+    assert not testutil.exists('B/dir3_moved/x.log')
+    
+    log_txt = testutil.get_log_txt()
+    assert 'move dir: dir1 --> new/dir1_moved' in log_txt
+    assert 'move: dir2/file3 --> dir2_moved/file3' in log_txt
+    assert 'move: dir3/file3 --> dir3_moved/file3' in log_txt
+
+    # Finally
+    assert testutil.compare_tree() == [('missing_inA','dir3/x.log')]
+
+@pytest.mark.parametrize("remote", remotes)
+def test_external_engine(remote):
+    """ The external engine streams the lists to disk and gets the same result """
+    testpath = os.path.join(os.path.abspath(os.path.split(__file__)[0]),
+            'test_dirs','test_external_engine')
+    try:
+        shutil.rmtree(testpath)
+    except:
+        pass
+    os.makedirs(testpath)
+    testutil = testutils.Testutils(testpath=testpath)
+
+    # Init
+    for ii in range(50):
+        testutil.write('A/dir{}/file{}'.format(ii % 5,ii),text='file {}'.format(ii))
+    testutil.write('A/skip/file.txt',text='skip')
+    testutil.write('A/dir0/old.log',text='log')
+
+    # Randomize Mod times
+    testutil.modtime_all()
+
+    # Start it
+    config = testutil.get_config(remote=remote)
+    config.reconcile_engine = 'external'
+    config.reconcile_memory_mb = 0.001 # Many sort runs
+    config.exclude_if_present = '.nosync'
+    testutil.init(config)
+
+    # Apply actions
+    testutil.move('A/dir1/file6','A/dir2/file6_moved')
+    testutil.remove('A/dir3/file8')
+    testutil.write('A/dir4/file9',text='mod',mode='a',time_adj=30)
+    testutil.write('B/dir0/newB',text='newB')
+    testutil.write('B/skip/.nosync',text='')
+    testutil.write('B/skip/newskip',text='not synced')
+    config.excludes += ['*.log'] # Changed. Filtered from the old lists too
+    testutil.remove('A/dir0/old.log')
+
+    # Sync
+    testutil.run(config)
+    
+    assert testutil.read('B/dir2/file6_moved') == 'file 6'
+    assert not testutil.exists('B/dir1/file6')
+    assert not testutil.exists('B/dir3/file8')
+    assert testutil.read('B/dir4/file9') == 'file 9\nmod'
+    assert testutil.read('A/dir0/newB') == 'newB'
+    assert testutil.exists('B/dir0/old.log') # Excluded so not deleted
+    assert not testutil.exists('A/skip/newskip')
+    
+    log_txt = testutil.get_log_txt()
+    assert 'external (bounded-memory) engine' in log_txt
+    assert 'move: dir1/file6 --> dir2/file6_moved' in log_txt
+    
+    # Nothing left behind
+    assert not glob(os.path.join(testpath,'A/.PyFiSync/PyFiSync_reconcile_*'))
+
+@pytest.mark.parametrize("remote,backup", list(itertools.product(remotes,[True,False])))
+def test_delete_directory(remote,backup):
+    """ Deleted directories are deleted (or backed up) at once if possible """
+    testpath = os.path.join(os.path.abspath(os.path.split(__file__)[0]),
+            'test_dirs','test_delete_directory')
+    try:
+        shutil.rmtree(testpath)
+    except:
+        pass
+    os.makedirs(testpath)
+    testutil = testutils.Testutils(testpath=testpath)
+
+    # Init
+    for ii in range(5):
+        testutil.write('A/dir1/sub/file{}'.format(ii),text='dir1 {}'.format(ii))
+        testutil.write('A/dir2/file{}'.format(ii),text='dir2 {}'.format(ii))
+        testutil.write('A/dir3/file{}'.format(ii),text='dir3 {}'.format(ii))
+
+    # Randomize Mod times
+    testutil.modtime_all()
+
+    # Start it
+    config = testutil.get_config(remote=remote)
+    config.backup = backup
+    config.collapse_directories = True
+    config.excludes += ['*.log']
+    testutil.init(config)
+
+    # Apply actions
+    shutil.rmtree(os.path.join(testpath,'A/dir1'))
+    shutil.rmtree(os.path.join(testpath,'A/dir2'))
+    shutil.rmtree(os.path.join(testpath,'A/dir3'))
+    testutil.write('B/dir2/newB',text='newB') # So dir2 can't be deleted whole
+    testutil.write('B/dir3/x.log',text='log') # Excluded so it must stay
+
+    # Sync
+    testutil.run(config)
+    
+    assert not testutil.exists('B/dir1')
+    assert testutil.read('B/dir2/newB') == 'newB'
+    assert not testutil.exists('B/dir2/file3')
+    assert testutil.read('B/dir3/x.log') == 'log'
+    assert not testutil.exists('B/dir3/file3')
+    
+    log_txt = testutil.get_log_txt()
+    if backup:
+        bpB = glob(os.path.join(testpath,'B/.PyFiSync/backups/20*/'))[0]
+        assert testutil.read(os.path.join(bpB,'dir1/sub/file3')) == 'dir1 3'
+        assert testutil.read(os.path.join(bpB,'dir2/file3')) == 'dir2 3'
+        assert testutil.read(os.path.join(bpB,'dir3/file3')) == 'dir3 3'
+        assert not os.path.exists(os.path.join(bpB,'dir3/x.log'))
+        assert 'delete dir (w/ backup): dir1' in log_txt
+        assert 'delete (w/ backup): dir2/file3' in log_txt
+        assert 'delete (w/ backup): dir3/file3' in log_txt
+    else:
+        assert 'delete dir (w/o backup): dir1' in log_txt
+        assert 'delete (w/o backup): dir3/file3' in log_txt
+
+    # Finally
+    assert testutil.compare_tree() == [('missing_inA','dir3/x.log')]
+
+def test_rclone_directory_actions(tmpdir):
+    """ A collapsed directory action is one rclone call of just its files """
+    calls = []
+    class Recorder(remote_interfaces.Rclone):
+        def call(self,args,echo=False):
+            args = list(args)
+            if '--files-from' in args:
+                with open(args[args.index('--files-from') + 1]) as F:
+                    args.append(sorted(F.read().split('\n')))
+            calls.append(args)
+            return ''
+    
+    config = PyFiSync.utils.configparser(remote='rclone')
+    config.pathA = str(tmpdir.join('A'))
+    config.pathB = 'remote:B'
+    config.rclone_flags = []
+    config.backup = True
+    log = PyFiSync.utils.logger(silent=True)
+    remote = Recorder(config,log)
+    
+    del calls[:] # --version
+    remote.apply_queue([{'movedir':['d','e/f',['a','sub/b']]}])
+    assert calls == [['move','remote:B/d','remote:B/e/f','--delete-empty-src-dirs',
+                      '--files-from',calls[0][5],['/a','/sub/b']]]
+    
+    del calls[:]
+    remote.apply_queue([{'deletedir':['d',['a','sub/b']]}])
+    assert calls == [['move','remote:B/d',os.path.join(remote.backup_path,'d'),
+                      '--delete-empty-src-dirs','--files-from',calls[0][5],['/a','/sub/b']]]
+    
+    del calls[:]
+    config.backup = False
+    remote.apply_queue([{'deletedir':['d',['a','sub/b']]}])
+    assert calls == [['delete','remote:B/d','--rmdirs','--files-from',calls[0][4],
+                      ['/a','/sub/b']]]
+
 @pytest.mark.parametrize("remote", remotes + rclone)
 def test_exclusions(remote): # Old test 16
     """ test exclusion """
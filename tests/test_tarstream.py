@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals,print_function
+
+import os
+import subprocess
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync import tarstream
+
+def test_commands(tmpdir):
+    src,dest = tmpdir.join('src dir'),tmpdir.join('dest')
+    dest.ensure(dir=True)
+    paths = ['file','sub/dir/fïle','not listed']
+    for ii,path in enumerate(paths):
+        src.join(path).write('text{}'.format(ii),ensure=True)
+        os.utime(str(src.join(path)),(1e9,1e9 + ii + 0.25))
+    
+    create = subprocess.Popen(['sh','-c',tarstream.create_command(str(src))],
+                              stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+    extract = subprocess.Popen(['sh','-c',tarstream.extract_command(str(dest))],
+                               stdin=create.stdout)
+    create.stdout.close()
+    create.stdin.write(tarstream.encode_paths(paths[:2]))
+    create.stdin.close()
+    assert create.wait() == 0 and extract.wait() == 0
+    
+    for ii,path in enumerate(paths[:2]):
+        assert dest.join(path).read() == 'text{}'.format(ii)
+        assert os.stat(str(dest.join(path))).st_mtime == 1e9 + ii + 0.25
+    assert not dest.join('not listed').exists()
+
+def test_existing_not_replaced(tmpdir):
+    src,dest = tmpdir.join('src'),tmpdir.join('dest')
+    for path in ['new','fïle exists']:
+        src.join(path).write('src',ensure=True)
+    dest.join('fïle exists').write('untracked',ensure=True)
+    
+    create = subprocess.Popen(['sh','-c',tarstream.create_command(str(src))],
+                              stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+    extract = subprocess.Popen(['sh','-c',tarstream.extract_command(str(dest))],
+                               stdin=create.stdout,stderr=subprocess.PIPE)
+    create.stdout.close()
+    create.stdin.write(tarstream.encode_paths(['new','fïle exists']))
+    create.stdin.close()
+    err = extract.stderr.read().decode('utf8')
+    create.wait(),extract.wait()
+    
+    assert dest.join('new').read() == 'src'
+    assert dest.join('fïle exists').read() == 'untracked'
+    if extract.returncode: # GNU tar. bsdtar skips them silently
+        assert tarstream.existing_paths(err) == (['fïle exists'],[])
+
+def test_tar_transfer_existing(tmpdir):
+    """ Files on the destination that are not in its list are left to rsync """
+    from PyFiSync import utils
+    from PyFiSync import remote_interfaces
+    from PyFiSync.dicttable import DictTable
+    
+    config = utils.configparser(remote='rsync')
+    config.pathA = str(tmpdir.join('A'))
+    config.pathB = str(tmpdir.join('B'))
+    config.persistant = False
+    config.userhost = ''
+    for path in ['small','untracked']:
+        tmpdir.join('A',path).write('A',ensure=True)
+    tmpdir.join('B','untracked').write('B',ensure=True)
+    
+    logs = []
+    log = utils.logger(silent=True)
+    log.add = lambda txt,**k:logs.append(txt)
+    remote = remote_interfaces.ssh_rsync(config,log)
+    
+    files_src = DictTable([{'path':'small','size':1},{'path':'untracked','size':1}])
+    queue = remote._tar_transfer(['small','untracked'],files_src,DictTable([]),100,A2B=True)
+    
+    assert tmpdir.join('B','small').read() == 'A'
+    assert tmpdir.join('B','untracked').read() == 'B' # Not replaced
+    assert queue == ['untracked']
+    assert any('Exists    untracked' in l for l in logs)
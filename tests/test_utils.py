@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals,print_function
+
+import os
+
+import pytest
+
+try:
+    from . import testutils
+except (ValueError,ImportError):
+    import testutils
+testutils.add_module()
+
+from PyFiSync import utils
+from PyFiSync import main
+from PyFiSync import PFSwalk
+
+class _ListLog(utils.logger):
+    """ Logger that keeps the lines """
+    def __init__(self):
+        super(_ListLog,self).__init__(silent=True)
+        self.lines = []
+    def add(self,text,end='\n',return_out=False):
+        self.lines.extend(self.prepend + ' '*self.space + l for l in text.split('\n'))
+    add_err = add
+
+def test_bufferedlog():
+    log = _ListLog()
+    log.prepend = '  '
+    blog = utils.bufferedlog(log,'A')
+    blog.add('one')
+    blog.add_err('two\nthree')
+    assert log.lines == []
+
+    blog.flush()
+    assert log.lines == ['  A: one','  A: two','  A: three']
+    assert log.prepend == '  '
+
+def test_returnthread_raises():
+    def fail():
+        raise ValueError('bad')
+    thread = utils.ReturnThread(target=fail)
+    thread.start()
+    with pytest.raises(ValueError):
+        thread.join()
+
+def test_local_walks(tmpdir):
+    config = utils.configparser(remote='rsync')
+    log = _ListLog()
+    walkers = []
+    for AB in 'AB':
+        for ii in range(3):
+            tmpdir.join(AB,'sub','file{}.txt'.format(ii)).write('text',ensure=True)
+        os.symlink('/not/there',str(tmpdir.join(AB,'broken')))
+        walkers.append(PFSwalk.file_list(str(tmpdir.join(AB)),config,log,empty='reset'))
+
+    filesA,filesB = main.local_walks(*walkers)
+    assert sorted(f['path'] for f in filesA) == ['sub/file0.txt','sub/file1.txt','sub/file2.txt']
+    assert sorted(f['path'] for f in filesB) == sorted(f['path'] for f in filesA)
+
+    # Errors (broken links) are labeled, in order, and the logs restored
+    assert [l[:2] for l in log.lines if 'broken' in l] == ['A:','B:']
+    assert all(walker.log is log for walker in walkers)
+
+def test_apply_queues(tmpdir):
+    config = utils.configparser(remote='rsync')
+    config.pathA = str(tmpdir.join('A'))
+    config.pathB = str(tmpdir.join('B'))
+    main.config = config
+    main.log = log = _ListLog()
+    
+    for AB in 'AB':
+        for ii in range(3):
+            tmpdir.join(AB,'file{}'.format(ii)).write(AB,ensure=True)
+    
+    main.apply_queues([{'move':['file0','moved0']},{'backup':'file1'}],
+                      [{'delete':'file2'}],remote=False)
+    
+    assert sorted(os.listdir(config.pathA)) == ['.PyFiSync','file1','file2','moved0']
+    assert sorted(os.listdir(config.pathB)) == ['.PyFiSync','file0','file1']
+    
+    # Each side is together and A is first
+    labels = [l[:2] for l in log.lines if l.strip()]
+    assert labels == sorted(labels) and labels[0] == 'A:' and labels[-1] == 'B:'
+    assert any('delete (w/ backup): file2' in l for l in log.lines)
+
+def _tree(path):
+    out = {}
+    for dirpath,_,filenames in os.walk(path):
+        for filename in filenames:
+            full = os.path.join(dirpath,filename)
+            rel = os.path.relpath(full,path).split(os.sep)
+            if rel[0] == '.PyFiSync' and len(rel) > 2 and rel[1] == 'backups':
+                rel = rel[:2] + rel[3:] # Remove the date
+            out['/'.join(rel)] = open(full).read()
+    return out
+
+@pytest.mark.parametrize("backup",[True,False])
+def test_apply_parallel(tmpdir,backup):
+    """ Parallel must be the same as in order """
+    queue = [{'move':['a','b']},
+             {'move':['c','a']},       # Destination is an earlier source
+             {'backup':'c2'},
+             {'move':['c2','c']},      # Backup and then move onto it
+             {'move':['d','e']},       # File moved away then made a dir
+             {'move':['f','d/g']},
+             {'delete':'h/i'},         # Emptied and then a file 
+             {'move':['j','h/i']}]
+    queue += [{'delete':'many/file{}'.format(ii)} for ii in range(50)]
+    queue += [{'move':['other/file{}'.format(ii),'moved/file{}'.format(ii)]}
+              for ii in range(50)]
+
+    results = []
+    for threads in [1,8]:
+        root = tmpdir.join(str(threads))
+        for path in ['a','c','c2','d','f','h/i','j']:
+            root.join(path).write(path,ensure=True)
+        for ii in range(50):
+            root.join('many','file{}'.format(ii)).write('many',ensure=True)
+            root.join('other','file{}'.format(ii)).write('other',ensure=True)
+
+        config = utils.configparser(remote='rsync')
+        config.backup = backup
+        main.config = config
+        log = _ListLog()
+        main.apply_action_queue(str(root),queue,log=log,threads=threads)
+        lines = [l for l in log.lines if str(root) not in l] # Only the paths differ
+        results.append((_tree(str(root)),lines))
+    
+    assert results[0] == results[1]
+    assert results[0][0]['b'] == 'a' and results[0][0]['d/g'] == 'f'
+
+def test_apply_parallel_error(tmpdir):
+    config = utils.configparser(remote='rsync')
+    main.config = config
+    tmpdir.join('a').write('a')
+    queue = [{'move':['missing','x']},{'move':['x','y']},{'move':['a','b']}]
+    with pytest.raises(IOError):
+        main.apply_action_queue(str(tmpdir),queue,log=_ListLog(),threads=2)
+    assert not tmpdir.join('y').exists()
+
+@pytest.mark.parametrize("method",utils.BACKUP_METHODS)
+def test_backup_copy(tmpdir,method):
+    src = tmpdir.join('src')
+    src.write('data')
+    os.utime(str(src),(1000,1000))
+    dst = tmpdir.join('dst')
+    
+    used = utils.backup_copy(str(src),str(dst),method=method)
+    assert used in [method,'copy'] or (method,used) == ('auto','reflink')
+    assert dst.read() == 'data'
+    assert os.stat(str(dst)).st_mtime == 1000
+    
+    # Replacing the file (like rsync) must not change the backup
+    tmpdir.join('new').write('new')
+    os.rename(str(tmpdir.join('new')),str(src))
+    assert dst.read() == 'data'
+    
+    if used == 'hardlink':
+        assert os.stat(str(dst)).st_nlink == 1 # No longer linked
+    
+    with pytest.raises(ValueError):
+        utils.backup_copy(str(src),str(dst),method='bad')
+
+@pytest.mark.parametrize("bufsize",[1,7,2**16])
+def test_iter_json_list(bufsize):
+    import io
+    import json
+    data = [{'path':'d/f{}'.format(ii),'mtime':1000.5 + ii,'size':ii*100} for ii in range(50)]
+    data += [1,2.5e-7,'s',None,[1,[2]],{}]
+    for txt in [json.dumps(data),json.dumps(data,indent=1),' [ ] ']:
+        expected = json.loads(txt)
+        assert list(utils.iter_json_list(io.StringIO(txt),bufsize=bufsize)) == expected
+    
+    for bad in ['','{}','[1,','[{"a":1}','[1 2]']:
+        with pytest.raises(ValueError):
+            list(utils.iter_json_list(io.StringIO(bad),bufsize=bufsize))
+
+def test_iter_json_list_bufsize():
+    """ The time per item must not grow with the buffer size """
+    import io
+    import json
+    import time
+    txt = json.dumps([{'path':'d/f{}'.format(ii),'size':ii} for ii in range(50000)])
+    times = []
+    for bufsize in [2**14,2**20]:
+        t0 = time.time()
+        for _ in utils.iter_json_list(io.StringIO(txt),bufsize=bufsize):
+            pass
+        times.append(time.time() - t0)
+    assert times[1] < 3*times[0] + 0.2, times # Was more than 30x
+
+@pytest.mark.parametrize("backup",[True,False])
+def test_apply_parallel_dirs(tmpdir,backup):
+    """ Directory actions in parallel must be the same as in order """
+    queue = [{'move':['p','k/q']},      # Makes k
+             {'movedir':['k','l',['q']]}, # and then k is moved away
+             {'move':['r','k/s']},      # so it must be made again
+             {'move':['t','n/u']},
+             {'deletedir':['n',['u']]}, # Must wait for the move into it
+             {'move':['v','n/w']}]
+    queue += [{'move':['l/f{}'.format(ii),'x/f{}'.format(ii)]} for ii in range(20)]
+    queue += [{'move':['other/file{}'.format(ii),'moved/file{}'.format(ii)]}
+              for ii in range(50)]
+    
+    results = []
+    for threads,stream in [(1,False),(8,False),(8,True)]:
+        root = tmpdir.join('{}{}'.format(threads,stream))
+        for path in ['p','r','t','v']:
+            root.join(path).write(path,ensure=True)
+        for ii in range(20):
+            root.join('l','f{}'.format(ii)).write('l',ensure=True)
+        for ii in range(50):
+            root.join('other','file{}'.format(ii)).write('other',ensure=True)
+        
+        config = utils.configparser(remote='rsync')
+        config.backup = backup
+        main.config = config
+        log = _ListLog()
+        main.apply_action_queue(str(root),iter(queue) if stream else queue,
+                                log=log,threads=threads)
+        lines = [l for l in log.lines if str(root) not in l]
+        results.append((_tree(str(root)),lines))
+    
+    assert results[0] == results[1] == results[2]
+    tree = results[0][0]
+    assert tree['l/q'] == 'p' and tree['k/s'] == 'r' and tree['n/w'] == 'v'
+    assert 'n/u' not in tree